@@ -1,17 +1,129 @@
 # app.py
+import asyncio
 import datetime
-from fastapi import FastAPI, HTTPException
-from typing import Dict
+import logging
+import os
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Header, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import ValidationError
+from typing import Dict, Optional
+from urllib.parse import quote
 from datetime import date
 
-from models import PRODUCTS, InventoryUpdate, LeftoverUpsert, DeliveryRequest, ConfirmDelivery, MoveTaskRequest, UpdateTaskQtyRequest
-from db import SessionLocal, init_db, Inventory, Leftover, DeliveryPlan, ScheduleTask
-from logic import generate_schedule, weekday_to_datetype, fetch_weather_label, calc_base_delivery, apply_leftover_deduction, format_delivery_plan
+from models import InventoryUpdate, LeftoverUpsert, DeliveryRequest, ConfirmDelivery, MoveTaskRequest, UpdateTaskQtyRequest, BulkImport, BatchRequest, SyncPush, SimulationRequest, CalendarDayIn, InventoryWriteResult, LeftoverWriteResult, ProductRuleIn
+from sqlalchemy import select, text
+from db import (SessionLocal, engine, describe_url, InventoryMovement, DeliveryPlan,
+                CALENDAR, CATALOG, DATA_EPOCH, DEMAND_MODEL, stamp_versions, table_key)
+import idempotency
+import ledger
+import cache
+import events
+from bus import bus
+import metrics
+from metrics import phase
+from compression import CompressionMiddleware
+from serialization import FastJSONResponse, dumps
+from logic import ensure_schedule, weekday_to_datetype, fetch_weather_label, calc_base_delivery, apply_leftover_deduction, format_delivery_plan, forecast_range, demand_model, refresh_models
+import catalog
+import migrations
+from holidays import holiday_calendar
+import changelog
+import rollups
+import simulate
+import sync
+import transfer
+from weather import weather_service
+import services
+from services import read_inventory, read_leftovers
 
 
 from fastapi.middleware.cors import CORSMiddleware
 
-app = FastAPI(title="Inventory API", version="0.2.0")
+logger = logging.getLogger(__name__)
+
+
+async def _checkpoint_once():
+    async with SessionLocal() as s:
+        if await ledger.checkpoint(s):
+            await s.commit()
+    async with SessionLocal() as s:
+        if await changelog.prune(s):
+            await s.commit()
+    async with SessionLocal() as s:
+        if await idempotency.purge_expired(s):
+            await s.commit()
+
+async def _checkpoint_loop(interval: float = 300.0):
+    # 庫存快照、過期資料的清理在背景做，不佔寫入路徑
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await _checkpoint_once()
+        except Exception as e:
+            logger.warning("ledger checkpoint failed: %s", e)
+            metrics.BACKGROUND_ERRORS.inc(task="checkpoint")
+
+# 啟動狀態：/healthz/ready 在暖機完成前回 503，負載平衡器不會把第一個請求送進來
+startup = {"stage": "starting", "ready": False, "migrations": []}
+
+async def _warm_up():
+    """
+    第一個請求會用到的東西先做好：連線池、排程（輸入有變才會重排）、明天的提貨係數、天氣
+    失敗不影響服務（請求進來時照常會做），只是第一個請求比較慢
+    """
+    try:
+        async with SessionLocal() as s:
+            await idempotency.purge_expired(s)
+            await s.commit()
+            await ensure_schedule(s)
+        tomorrow = date.today() + datetime.timedelta(days=1)
+        calc_base_delivery(weekday_to_datetype(tomorrow), weather_service.peek_label(), 1.0)
+        await weather_service.get_label()
+    except Exception as e:
+        logger.warning("warm-up failed: %s", e)
+        metrics.BACKGROUND_ERRORS.inc(task="warm_up")
+    startup.update(stage="ready", ready=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.info("Using DATABASE_URL = %s", describe_url())
+    # 資料庫結構 / 預設資料：只在有新 migration 時做（多個 worker 也只有一個做）
+    startup["stage"] = "migrating"
+    startup["migrations"] = await migrations.migrate()
+    if startup["migrations"]:
+        logger.info("applied migrations: %s", ", ".join(startup["migrations"]))
+    startup["stage"] = "loading"
+    # 先接上 bus 再讀版本：中間別的 worker 的寫入不會漏掉
+    await bus.start()
+    async with SessionLocal() as s:
+        interrupted = await simulate.fail_interrupted(s)
+        await s.commit()
+    if interrupted:
+        logger.warning("marked %d interrupted simulation jobs as failed", interrupted)
+    async with SessionLocal() as s:
+        await cache.warm_versions(s)
+        await catalog.catalog.load(s)
+        await holiday_calendar.load(s)
+        await demand_model.load(s)
+    # 天氣快取：綁定事件迴圈；暖機在背景做，liveness 馬上可以回應
+    weather_service.bind_loop(asyncio.get_running_loop())
+    startup["stage"] = "warming"
+    warm_up = asyncio.ensure_future(_warm_up())
+    checkpoints = asyncio.ensure_future(_checkpoint_loop())
+    yield
+    events.hub.close()
+    warm_up.cancel()
+    checkpoints.cancel()
+    # 等取消真的完成（手上的連線還回連線池）再關連線池，否則 dispose 會中斷還在用的連線
+    await asyncio.gather(warm_up, checkpoints, return_exceptions=True)
+    await bus.close()
+    simulate.shutdown()
+    await weather_service.aclose()
+    await engine.dispose()
+
+app = FastAPI(title="Inventory API", version="0.2.0", lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # CORS 設定 - 允許前端應用連接
 app.add_middleware(
@@ -20,104 +132,223 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "ETag"],
 )
 
-init_db(PRODUCTS)
+# 大的讀取（歷史、區間預測）壓縮：br（有裝 brotli）/ gzip
+app.add_middleware(CompressionMiddleware)
+
+# 每個請求的 SQL 數 / DB 時間 / 各階段耗時 → Server-Timing 標頭與 /metrics
+metrics.instrument_engine(engine)
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.register(metrics.Gauge(
+    "read_cache_events_total", "Read cache lookups by result",
+    lambda: {(k,): float(v) for k, v in cache.read_cache.stats().items() if k in ("hits", "misses", "not_modified")},
+    ["result"], kind="counter"))
+metrics.register(metrics.Gauge(
+    "read_cache_hit_ratio", "Read cache hit ratio since start",
+    lambda: {(): cache.read_cache.stats()["hit_rate"]}))
+metrics.register(metrics.Gauge(
+    "events_subscribers", "Open /events streams", lambda: {(): float(events.hub.stats()["subscribers"])}))
+metrics.register(metrics.Gauge(
+    "events_published_total", "Change events published", lambda: {(): float(events.hub.published)},
+    kind="counter"))
 
 @app.get("/healthz")
-def health():
+@app.get("/healthz/live")
+async def health():
+    """liveness：行程還活著就回 200（不碰資料庫）"""
     return {"ok": True}
 
+READY_DB_TIMEOUT = 2.0
+
+@app.get("/healthz/ready")
+async def readiness():
+    """readiness：migration / 載入 / 暖機都完成、資料庫連得上才回 200"""
+    if not startup["ready"]:
+        return FastJSONResponse({"ready": False, "stage": startup["stage"]}, status_code=503)
+    try:
+        async with SessionLocal() as s:
+            await asyncio.wait_for(s.execute(text("SELECT 1")), READY_DB_TIMEOUT)
+    except Exception as e:
+        return FastJSONResponse({"ready": False, "stage": "database", "error": type(e).__name__}, status_code=503)
+    return {"ready": True, "schema_version": migrations.LATEST}
+
+@app.get("/events")
+async def change_events(types: Optional[str] = None, last_event_id: Optional[str] = Header(None)):
+    """
+    變更通知（SSE）：inventory / leftovers / schedule 有異動時推送差異，收到 resync 請重抓
+    types：只訂閱某些種類（逗號分隔）；斷線重連時瀏覽器會自動帶 Last-Event-ID
+    """
+    try:
+        sub = events.hub.subscribe(types.split(",") if types else None, last_event_id)
+    except events.TooManySubscribers:
+        raise HTTPException(503, "too many event subscribers")
+    return StreamingResponse(events.hub.stream(sub), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {**cache.read_cache.stats(), "versions": cache.versions.snapshot(), "bus": bus.stats(),
+            "delivery": delivery_memo.stats()}
+
 @app.get("/inventory")
-def get_inventory() -> Dict[str, Dict[str, float]]:
-    with SessionLocal() as s:
-        rows = s.query(Inventory).all()
-        return {
-            r.item: {
-                "qty": r.qty,
-                "danger_level": r.danger_level
-            } for r in rows
-        }
+async def get_inventory(request: Request, as_of: Optional[datetime.datetime] = Query(None)):
+    """as_of（UTC）：回傳該時間點的庫存（最近快照 + 異動重播）"""
+    if as_of is not None:
+        if as_of.tzinfo is not None:
+            as_of = as_of.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        async with SessionLocal() as s:
+            return {item: {"qty": qty} for item, qty in (await ledger.stock_as_of(s, as_of)).items()}
+
+    async def load():
+        async with SessionLocal() as s:
+            return await read_inventory(s)
+    return await cache.cached_json(request, "inventory", cache.make_etag("inventory", ["inventory"]), load)
+
+@app.get("/inventory/movements")
+async def get_movements(item: Optional[str] = None, after_id: int = 0, limit: int = Query(200, le=1000)):
+    """異動帳（依 id 遞增，after_id 作為下一頁游標）"""
+    async with SessionLocal() as s:
+        q = select(InventoryMovement).where(InventoryMovement.id > after_id)
+        if item:
+            q = q.where(InventoryMovement.item == item)
+        rows = (await s.scalars(q.order_by(InventoryMovement.id).limit(limit))).all()
+        return [
+            {"id": m.id, "ts": m.ts.isoformat(), "item": m.item, "kind": m.kind,
+             "delta": m.delta, "qty_after": m.qty_after, "ref": m.ref}
+            for m in rows
+        ]
+
+# 寫入路由：預設回傳整張表（舊客戶端）；?delta=true 只回 changed + version
+async def _with_version(s, result: Dict, table: str) -> Dict:
+    """version = 該表寫入後的資料版本；版本號 commit 前才遞增，放在 commit 前最後一步送出"""
+    result["version"] = (await stamp_versions(s))[table_key(table)]
+    return result
+
+@app.post("/inventory/update", response_model=InventoryWriteResult, response_model_exclude_none=True)
+async def update_inventory(update: InventoryUpdate, idempotency_key: Optional[str] = Header(None),
+                           delta: bool = False):
+    async with SessionLocal() as s:
+        replay = await idempotency.begin(s, idempotency_key, "inventory/update")
+        if replay is not None:
+            return replay
+        result = await services.update_inventory(s, update)
+        if not delta:
+            result["inventory"] = await read_inventory(s)
+        await _with_version(s, result, "inventory")
+        await idempotency.finish(s, idempotency_key, result)
+        await s.commit()
+    return result
 
-@app.post("/inventory/update")
-def update_inventory(update: InventoryUpdate):
-    if not update.updates:
-        raise HTTPException(400, "updates 不可為空")
-    with SessionLocal() as s:
-        for item, qty in update.updates.items():
-            row = s.query(Inventory).filter_by(item=item).first()
-            if row:
-                row.qty = max(float(qty), 0.0)
-            else:
-                s.add(Inventory(item=item, qty=max(float(qty), 0.0)))
-        s.commit()
-    return {"message": "inventory updated", "inventory": get_inventory()}
-
-@app.post("/inventory/danger")
-def update_danger_levels(payload: Dict[str, float]):
-    if not payload:
-        raise HTTPException(400, "danger_levels 不可為空")
-
-    with SessionLocal() as s:
-        for item, danger in payload.items():
-            row = s.query(Inventory).filter_by(item=item).first()
-            if row:
-                row.danger_level = float(danger)
-            else:
-                s.add(Inventory(item=item, qty=0.0, danger_level=float(danger)))
-        s.commit()
-
-    return {"message": "danger levels updated", "inventory": get_inventory()}
+@app.post("/inventory/danger", response_model=InventoryWriteResult, response_model_exclude_none=True)
+async def update_danger_levels(payload: Dict[str, float], delta: bool = False):
+    async with SessionLocal() as s:
+        result = await _with_version(s, await services.update_danger_levels(s, payload), "inventory")
+        await s.commit()
+        if not delta:
+            result["inventory"] = await read_inventory(s)
+    return result
 
+RANGE_MAX_DAYS = 366
+
+def _range_params(start: date, end: date, items: Optional[str]):
+    if end < start:
+        raise HTTPException(400, "to 不可早於 from")
+    if (end - start).days + 1 > RANGE_MAX_DAYS:
+        raise HTTPException(400, f"區間最多 {RANGE_MAX_DAYS} 天")
+    return [i.strip() for i in items.split(",") if i.strip()] if items else None
+
+@app.get("/leftovers")
+async def get_leftover_range(request: Request, start: date = Query(..., alias="from"), end: date = Query(..., alias="to"),
+                             items: Optional[str] = None, cursor: Optional[str] = None,
+                             limit: int = Query(services.RANGE_PAGE_SIZE, ge=1, le=5000)):
+    """
+    區間剩料（欄式）：{days, items, qty: [[每天 × 每個品項]], next}
+    items：逗號分隔（只取這些品項，欄位照這個順序）；next 不是 null 就帶 cursor=next 取下一頁
+    """
+    names = _range_params(start, end, items)
+
+    async def load():
+        async with SessionLocal() as s:
+            return await services.read_leftover_range(s, start, end, names, cursor, limit)
+    params = [start.isoformat(), end.isoformat(), quote(items or ""), quote(cursor or ""), str(limit)]
+    etag = cache.make_etag("leftover-range", ["leftovers"], params)
+    return await cache.cached_json(request, "leftovers:range:" + "|".join(params), etag, load)
 
 @app.get("/leftovers/{day}")
-def get_leftovers(day: date):
-    with SessionLocal() as s:
-        rows = s.query(Leftover).filter_by(day=day).all()
-        return {r.item: r.qty for r in rows}
-
-@app.post("/leftovers")
-def upsert_leftovers(payload: LeftoverUpsert):
-    with SessionLocal() as s:
-        for item, qty in payload.leftovers.items():
-            row = s.query(Leftover).filter_by(day=payload.day, item=item).first()
-            if row: row.qty = max(float(qty), 0.0)
-            else:   s.add(Leftover(day=payload.day, item=item, qty=max(float(qty), 0.0)))
-        s.commit()
-    return {"message": "leftovers upserted", "leftovers": get_leftovers(payload.day)}
+async def get_leftovers(day: date, request: Request):
+    async def load():
+        async with SessionLocal() as s:
+            return await read_leftovers(s, day)
+    etag = cache.make_etag("leftovers", ["leftovers"], [day.isoformat()])
+    return await cache.cached_json(request, f"leftovers:{day.isoformat()}", etag, load)
+
+@app.post("/leftovers", response_model=LeftoverWriteResult, response_model_exclude_none=True)
+async def upsert_leftovers(payload: LeftoverUpsert, delta: bool = False):
+    async with SessionLocal() as s:
+        result = await _with_version(s, await services.upsert_leftovers(s, payload), "leftovers")
+        await s.commit()
+        if not delta:
+            result["leftovers"] = await read_leftovers(s, payload.day)
+    return result
+
+# 提貨計畫的結果：剩料、任務、確認提貨、品項目錄、需求模型、日曆沒變之前，同樣的參數算出來都一樣
+DELIVERY_DEPENDS = (DATA_EPOCH, table_key("leftovers"), table_key("delivery_plans"), table_key("schedule_tasks"),
+                    CATALOG, DEMAND_MODEL, CALENDAR)
+delivery_memo = cache.Memo(DELIVERY_DEPENDS, max_entries=int(os.getenv("DELIVERY_MEMO_SIZE", "256")))
 
 @app.post("/delivery")
 async def compute_delivery(payload: DeliveryRequest):
-    day=payload.day
-    with SessionLocal() as s:
+    """
+    同樣的 (日期, 天氣, 安全係數) 同時進來只算一次，算好的結果放在 delivery_memo
+    （扣的是「今天」的剩料，所以今天的日期也算在 key 裡）
+    """
+    # 天氣先決定才知道 key（weather_service 自己有快取）
+    with phase("weather"):
+        weather_label = payload.weather or await fetch_weather_label()
+    day, safety_factor = payload.day, payload.safety_factor
+    return await delivery_memo.get((day, weather_label, safety_factor, date.today()),
+                                   lambda: _compute_delivery(day, weather_label, safety_factor))
+
+async def _compute_delivery(day: date, weather_label: str, safety_factor: float):
+    async with SessionLocal() as s:
         # ✅ 先查今天的 confirmed 提貨紀錄
-        confirmed_rows = s.query(DeliveryPlan).filter_by(day=day, confirmed=True).all()
+        confirmed_rows = (await s.execute(
+            select(DeliveryPlan.item, DeliveryPlan.planned_qty).filter_by(day=day, confirmed=True)
+        )).all()
         if confirmed_rows:
-            print("已有確認提貨紀錄，回傳既有版本")
-            raw_data = {r.item: r.planned_qty for r in confirmed_rows}
+            logger.debug("%s 已有確認提貨紀錄，回傳既有版本", day)
+            raw_data = {item: planned_qty for item, planned_qty in confirmed_rows}
             # 對已確認的數據也應用格式化邏輯
-            formatted_data = format_delivery_plan(raw_data, s, day)
+            with phase("format"):
+                formatted_data = await format_delivery_plan(raw_data, s, day)
             return {
                 "confirmed": True,
                 # "date": day.isoformat(),
                 "final_plan": formatted_data,
             }
+        # 品項目錄 / 需求模型被改過就重新載入
+        await refresh_models(s)
         # 1) 自動判定平/假日
-        dt = weekday_to_datetype(payload.day)
-        # 2) 天氣：若未指定，呼叫 API 自動偵測
-        weather_label = payload.weather or await fetch_weather_label()
+        dt = weekday_to_datetype(day)
+        # 2) 天氣：呼叫端已決定（未指定時由 API 自動偵測）
         # 3) 計算基本計畫
-        plan = calc_base_delivery(dt, weather_label, payload.safety_factor)
+        with phase("base_plan"):
+            plan = calc_base_delivery(dt, weather_label, safety_factor)
         # 4) 扣除「當日剩料」（用今天日期）
-        today = date.today()
-        with SessionLocal() as s2:
-            todays = s2.query(Leftover).filter_by(day=today).all()
-            leftovers = {r.item: r.qty for r in todays}
-        raw_final_plan = apply_leftover_deduction(plan, leftovers)
-        
+        with phase("leftovers"):
+            leftovers = await read_leftovers(s, date.today())
+            raw_final_plan = apply_leftover_deduction(plan, leftovers)
+
         # 5) 格式化顯示邏輯
-        final_plan = format_delivery_plan(raw_final_plan, s, day)
-        
+        with phase("format"):
+            final_plan = await format_delivery_plan(raw_final_plan, s, day)
+
         return {
             "confirmed": False,
             "date_type": dt,
@@ -127,133 +358,418 @@ async def compute_delivery(payload: DeliveryRequest):
             "final_plan": final_plan
         }
 
-@app.post("/delivery/confirm")
-def confirm_delivery(payload: ConfirmDelivery):
-    # 寫入/更新 DeliveryPlan，並同步更新庫存（提貨到庫存 -）
-    with SessionLocal() as s:
-        # upsert plans
-        for item, qty in payload.items.items():
-            row = s.query(DeliveryPlan).filter_by(day=payload.day, item=item).first()
-            if row:
-                row.planned_qty = float(qty)
-                row.confirmed = True
-            else:
-                s.add(DeliveryPlan(day=payload.day, item=item, planned_qty=float(qty), confirmed=True))
-            # 更新庫存 + planned
-            inv = s.query(Inventory).filter_by(item=item).first()
-            if inv: inv.qty = max(inv.qty - float(qty), 0.0)
-            else:   s.add(Inventory(item=item, qty=max(float(qty), 0.0)))
-        s.commit()
-    return {"message": "delivery confirmed & inventory updated", "inventory": get_inventory()}
+# 多日預測：最長一年，串流時每 31 天查一次資料庫
+FORECAST_MAX_DAYS = 366
+FORECAST_CHUNK_DAYS = 31
+
+@app.get("/delivery/forecast")
+async def delivery_forecast(start: date = Query(..., alias="from"), end: date = Query(..., alias="to"),
+                            safety_factor: float = 1.0, stream: bool = False):
+    """
+    區間提貨預測：日期類型權重 × 逐日天氣 × 前一天剩料，整段一次算
+    stream=true 時以 NDJSON 逐日輸出
+    """
+    if end < start:
+        raise HTTPException(400, "to 不可早於 from")
+    n_days = (end - start).days + 1
+    if n_days > FORECAST_MAX_DAYS:
+        raise HTTPException(400, f"區間最多 {FORECAST_MAX_DAYS} 天")
+    days = [start + datetime.timedelta(days=i) for i in range(n_days)]
+    with phase("weather"):
+        weather = await weather_service.daily_labels(start, end)
+
+    if not stream:
+        async with SessionLocal() as s:
+            await refresh_models(s)
+            return await forecast_range(s, days, weather, safety_factor)
+
+    async def lines():
+        async with SessionLocal() as s:
+            await refresh_models(s)
+            for k in range(0, n_days, FORECAST_CHUNK_DAYS):
+                chunk = await forecast_range(s, days[k:k + FORECAST_CHUNK_DAYS], weather, safety_factor)
+                items = chunk["items"]
+                for i, day in enumerate(chunk["days"]):
+                    yield dumps({
+                        "day": day,
+                        "date_type": chunk["date_type"][i],
+                        "weather": chunk["weather"][i],
+                        "confirmed": chunk["confirmed"][i],
+                        "base_plan": dict(zip(items, chunk["base"][i])),
+                        "final_plan": dict(zip(items, chunk["final"][i])),
+                    }) + b"\n"
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+# =========================================================
+# 分析：只讀 usage_rollups（寫入端維護的日 / 週 / 月彙總）
+# =========================================================
+ANALYTICS_MAX_PERIODS = 400
+
+@app.get("/analytics/usage")
+async def analytics_usage(request: Request, grain: str = Query(rollups.DAY, pattern="^(day|week|month)$"),
+                          start: Optional[date] = Query(None, alias="from"),
+                          end: Optional[date] = Query(None, alias="to"), item: Optional[str] = None):
+    """
+    各期間每個品項的 提貨 / 剩料 / 備料 / 用量（提貨 - 剩料）/ 剩料率
+    預設：到今天為止的 30 天（day）/ 12 週（week）/ 12 個月（month）
+    """
+    end = end or date.today()
+    start = start or {rollups.DAY: end - datetime.timedelta(days=29),
+                      rollups.WEEK: end - datetime.timedelta(weeks=11),
+                      rollups.MONTH: rollups.period_start(rollups.MONTH, end - datetime.timedelta(days=335))}[grain]
+    if end < start:
+        raise HTTPException(400, "to 不可早於 from")
+    if (end - start).days + 1 > ANALYTICS_MAX_PERIODS * {"day": 1, "week": 7, "month": 31}[grain]:
+        raise HTTPException(400, f"一次最多 {ANALYTICS_MAX_PERIODS} 個期間")
+
+    async def load():
+        async with SessionLocal() as s:
+            return {"grain": grain, "from": start.isoformat(), "to": end.isoformat(),
+                    "rows": await rollups.series(s, grain, start, end, item)}
+    params = [grain, start.isoformat(), end.isoformat(), quote(item or "")]
+    etag = cache.make_etag("analytics-usage", ["usage_rollups"], params)
+    return await cache.cached_json(request, "analytics:usage:" + "|".join(params), etag, load)
+
+@app.get("/analytics/totals")
+async def analytics_totals(request: Request, start: Optional[date] = Query(None, alias="from"),
+                           end: Optional[date] = Query(None, alias="to"), item: Optional[str] = None):
+    """
+    區間內每個品項的合計，依剩料率高到低（預設：本月 1 號到今天）
+    例：上個月魚肚多訂了多少 → ?from=2025-05-01&to=2025-05-31&item=魚肚
+    """
+    end = end or date.today()
+    start = start or rollups.period_start(rollups.MONTH, end)
+    if end < start:
+        raise HTTPException(400, "to 不可早於 from")
+
+    async def load():
+        async with SessionLocal() as s:
+            return await rollups.totals(s, start, end, item)
+    params = [start.isoformat(), end.isoformat(), quote(item or "")]
+    etag = cache.make_etag("analytics-totals", ["usage_rollups"], params)
+    return await cache.cached_json(request, "analytics:totals:" + "|".join(params), etag, load)
+
+@app.get("/demand/model")
+async def get_demand_model():
+    """需求模型目前的統計量與係數（各 品項 × 日期類型 × 天氣）"""
+    async with SessionLocal() as s:
+        await refresh_models(s)
+    return {"version": demand_model.version, "prior_weight": demand_model.prior_weight,
+            "cells": demand_model.describe()}
+
+@app.get("/catalog")
+async def get_catalog():
+    """品項目錄：各品項的提貨 / 排程規則"""
+    async with SessionLocal() as s:
+        await refresh_models(s)
+    return catalog.catalog.describe()
+
+@app.put("/catalog/{item}")
+async def put_catalog_rule(item: str, payload: ProductRuleIn):
+    """
+    新增 / 修改品項規則，立即生效（不用重新部署）：
+    有庫存的品項自動建庫存列，改成虛擬品項則移除庫存列；排程會依新規則重新產生
+    """
+    rule = {"item": item, **payload.model_dump()}
+    if payload.task_levels:
+        rule["task_levels"] = [list(level) for level in payload.task_levels]
+    async with SessionLocal() as s:
+        await catalog.upsert_rule(s, rule)
+        await s.commit()
+        await refresh_models(s)
+    return catalog.catalog.rules[item].as_dict()
+
+# =========================================================
+# 工作日曆：國定假日 / 臨時休息 / 補班（其他日子照每週規則，見 holidays.py）
+# =========================================================
+@app.get("/calendar")
+async def get_calendar(start: date = Query(..., alias="from"), end: date = Query(..., alias="to")):
+    """區間內每一天的類型：[{day, date_type, name, override}]"""
+    _range_params(start, end, None)
+    async with SessionLocal() as s:
+        await refresh_models(s)
+    return holiday_calendar.describe(start, end)
+
+@app.put("/calendar/{day}")
+async def put_calendar_day(day: date, payload: CalendarDayIn):
+    """設定某天的類型（提貨基準、需求模型、排程分配都跟著改）"""
+    async with SessionLocal() as s:
+        result = await services.set_calendar_day(s, day, payload)
+        await s.commit()
+        await refresh_models(s)
+    return result
+
+@app.delete("/calendar/{day}")
+async def delete_calendar_day(day: date):
+    """刪掉例外，回到每週規則"""
+    async with SessionLocal() as s:
+        result = await services.set_calendar_day(s, day, None)
+        await s.commit()
+        await refresh_models(s)
+    return result
+
+@app.get("/delivery/plans")
+async def get_delivery_plans(request: Request, start: date = Query(..., alias="from"), end: date = Query(..., alias="to"),
+                             items: Optional[str] = None, confirmed: Optional[bool] = None,
+                             cursor: Optional[str] = None,
+                             limit: int = Query(services.RANGE_PAGE_SIZE, ge=1, le=5000)):
+    """
+    區間提貨計畫（欄式）：{days, items, planned_qty, confirmed, weather: [[每天 × 每個品項]], next}
+    confirmed=true 只列已確認的；分頁同 GET /leftovers
+    """
+    names = _range_params(start, end, items)
+
+    async def load():
+        async with SessionLocal() as s:
+            return await services.read_plan_range(s, start, end, names, confirmed, cursor, limit)
+    params = [start.isoformat(), end.isoformat(), quote(items or ""), str(confirmed), quote(cursor or ""), str(limit)]
+    etag = cache.make_etag("plan-range", ["delivery_plans"], params)
+    return await cache.cached_json(request, "plans:range:" + "|".join(params), etag, load)
+
+@app.post("/delivery/confirm", response_model=InventoryWriteResult, response_model_exclude_none=True)
+async def confirm_delivery(payload: ConfirmDelivery, idempotency_key: Optional[str] = Header(None),
+                           delta: bool = False):
+    # 天氣先查好再開交易（查預報可能要等上游）
+    if payload.weather is None:
+        payload.weather = (await weather_service.daily_labels(payload.day, payload.day))[payload.day]
+    async with SessionLocal() as s:
+        replay = await idempotency.begin(s, idempotency_key, "delivery/confirm")
+        if replay is not None:
+            return replay
+        result = await services.confirm_delivery(s, payload)
+        if not delta:
+            result["inventory"] = await read_inventory(s)
+        await _with_version(s, result, "inventory")
+        await idempotency.finish(s, idempotency_key, result)
+        await s.commit()
+    return result
+
+@app.post("/bulk/import")
+async def bulk_import(payload: BulkImport):
+    """
+    大量匯入庫存 / 剩料 / 提貨計畫（每張表一個批次 upsert）
+    """
+    async with SessionLocal() as s:
+        result = await services.bulk_import(s, payload)
+        await s.commit()
+    return result
+
+# =========================================================
+# 整批匯出 / 匯入（串流，見 transfer.py）
+# =========================================================
+def _attachment(name: str) -> Dict[str, str]:
+    return {"Content-Disposition": f'attachment; filename="{name}"'}
+
+@app.get("/export")
+async def export_all(tables: Optional[str] = None):
+    """多張表（預設全部）匯出成 NDJSON，每行 {"table", "row"}"""
+    names = transfer.parse_tables(tables)
+    return StreamingResponse(transfer.export_tables(names), media_type=transfer.MEDIA_TYPES[transfer.NDJSON],
+                             headers=_attachment(f"export-{date.today().isoformat()}.ndjson"))
+
+@app.get("/export/{table}")
+async def export_table(table: str, format: str = Query(transfer.NDJSON, pattern="^(csv|ndjson)$")):
+    transfer.model_of(table)
+    return StreamingResponse(transfer.export_table(table, format), media_type=transfer.MEDIA_TYPES[format],
+                             headers=_attachment(f"{table}-{date.today().isoformat()}.{format}"))
+
+@app.post("/import")
+async def import_all(request: Request, mode: str = Query(transfer.APPEND, pattern="^(append|replace)$")):
+    """GET /export 的輸出（NDJSON {"table", "row"}）原樣匯回；replace 先清空出現的表"""
+    async with SessionLocal() as s:
+        result = await transfer.import_rows(s, request.stream(), mode=mode)
+        await s.commit()
+    return result
+
+@app.post("/import/{table}")
+async def import_table(request: Request, table: str,
+                       format: str = Query(transfer.NDJSON, pattern="^(csv|ndjson)$"),
+                       mode: str = Query(transfer.APPEND, pattern="^(append|replace)$")):
+    """一張表的 CSV（第一行表頭）或 NDJSON（每行一列）"""
+    async with SessionLocal() as s:
+        result = await transfer.import_rows(s, request.stream(), table, format, mode)
+        await s.commit()
+    return result
 
 @app.get("/schedule")
-def get_schedule():
+async def get_schedule(request: Request, start: Optional[date] = Query(None, alias="from"),
+                       end: Optional[date] = Query(None, alias="to")):
     """
-    讀取排程（讀之前先自動生成）
-    回傳: [{id, weekday, task, item, qty, done}, ...]
+    讀取排程（輸入有變動或跨日時才重新生成，否則直接讀）
+    from / to：只取這段日期的任務（都不給 = 全部，含過期未完成的）
+    回傳: [{id, day, weekday, task, item, qty, done}, ...]（依日期排序；weekday 由 day 推出）
     """
-    with SessionLocal() as s:
-        generate_schedule(s)  # 先根據當前庫存低於危險量情形產生
-        tasks = s.query(ScheduleTask).order_by(ScheduleTask.id).all()
-        return [
-            {"id": t.id, "weekday": t.weekday, "task": t.task, "item": t.item, "qty": t.qty, "done": t.done}
-            for t in tasks
-        ]
+    if start is not None and end is not None:
+        _range_params(start, end, None)
+    params = [start.isoformat() if start else "", end.isoformat() if end else ""]
+    hit = cache.not_modified(request, cache.schedule_etag(date.today(), params))
+    if hit is not None:
+        return hit
+    async with SessionLocal() as s:
+        await ensure_schedule(s)  # 庫存/剩料/任務有變動才根據危險量重新產生
+        # 重新產生後版本可能變了，etag 在這之後才算
 
+        async def load():
+            return await services.read_schedule(s, start, end)
+        return await cache.cached_json(request, "schedule:" + "|".join(params),
+                                       cache.schedule_etag(date.today(), params), load)
 
-@app.post("/schedule/complete/{task_id}")
-def complete_task(task_id: int):
-    """
-    完成任務：
-      - 刪除這筆排程（或你想改 done=True 也行）
-      - 依任務數量更新庫存（完成備料 → 庫存增加）
-    """
-    with SessionLocal() as s:
-        task = s.query(ScheduleTask).filter_by(id=task_id).first()
-        if not task:
-            raise HTTPException(404, "Task not found")
-
-        # 特殊處理：剝魚肉任務
-        if task.item == "魚肉" and "剝魚肉" in task.task:
-            # 剝一次產出 3包魚肉 + 4包魚皮
-            # 更新魚肉庫存
-            fish_meat_inv = s.query(Inventory).filter_by(item="魚肉").first()
-            if fish_meat_inv:
-                fish_meat_inv.qty = fish_meat_inv.qty + 3.0
-            else:
-                s.add(Inventory(item="魚肉", qty=3.0))
-            
-            # 更新魚皮庫存
-            fish_skin_inv = s.query(Inventory).filter_by(item="魚皮").first()
-            if fish_skin_inv:
-                fish_skin_inv.qty = fish_skin_inv.qty + 4.0
-            else:
-                s.add(Inventory(item="魚皮", qty=4.0))
-            
-            message = f"任務 [{task.task}] 已完成，已增加魚肉 3.0 包、魚皮 4.0 包"
-        else:
-            # 一般任務：完成備料 → 庫存加 qty
-            inv = s.query(Inventory).filter_by(item=task.item).first()
-            if inv:
-                inv.qty = max(inv.qty + float(task.qty), 0.0)
-            else:
-                s.add(Inventory(item=task.item, qty=max(float(task.qty), 0.0)))
-            message = f"任務 [{task.task}] 已完成，已更新 {task.item} 庫存 {task.qty}"
-
-        # 刪除任務（或改 task.done = True；這裡依你規格用刪除）
-        s.delete(task)
-        s.commit()
-        return {"message": message}
 
+@app.post("/schedule/complete/{task_id}")
+async def complete_task(task_id: int, idempotency_key: Optional[str] = Header(None)):
+    """完成任務：刪除排程並把產出加回庫存（見 services.complete_task）"""
+    async with SessionLocal() as s:
+        replay = await idempotency.begin(s, idempotency_key, f"schedule/complete/{task_id}")
+        if replay is not None:
+            return replay
+        result = await services.complete_task(s, task_id)
+        await idempotency.finish(s, idempotency_key, result)
+        await s.commit()
+        return result
 
 @app.post("/schedule/delete/{task_id}")
-def delete_task(task_id: int):
+async def delete_task(task_id: int):
     """
     刪除任務：不更新庫存
     """
-    with SessionLocal() as s:
-        task = s.query(ScheduleTask).filter_by(id=task_id).first()
-        if not task:
-            raise HTTPException(404, "Task not found")
-        s.delete(task)
-        s.commit()
-        return {"message": f"任務 [{task.task}] 已刪除"}
+    async with SessionLocal() as s:
+        result = await services.delete_task(s, task_id)
+        await s.commit()
+        return result
 
 
 @app.post("/schedule/move/{task_id}")
-def move_task(task_id: int, payload: MoveTaskRequest):
+async def move_task(task_id: int, payload: MoveTaskRequest):
     """
-    移動任務到不同星期幾
+    移動任務到另一天：{"new_day": "YYYY-MM-DD"}（舊版前端的 {"new_weekday": "Monday"} = 今天起最近的星期一）
     """
-    valid_weekdays = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-    if payload.new_weekday not in valid_weekdays:
-        raise HTTPException(400, f"Invalid weekday. Must be one of: {valid_weekdays}")
-    
-    with SessionLocal() as s:
-        task = s.query(ScheduleTask).filter_by(id=task_id).first()
-        if not task:
-            raise HTTPException(404, "Task not found")
-        
-        old_weekday = task.weekday
-        task.weekday = payload.new_weekday
-        s.commit()
-        return {"message": f"任務已從 {old_weekday} 移動到 {payload.new_weekday}"}
+    async with SessionLocal() as s:
+        result = await services.move_task(s, task_id, payload)
+        await s.commit()
+        return result
 
 
 @app.post("/schedule/update_qty/{task_id}")
-def update_task_qty(task_id: int, payload: UpdateTaskQtyRequest):
+async def update_task_qty(task_id: int, payload: UpdateTaskQtyRequest):
     """
     更新任務數量
     """
-    with SessionLocal() as s:
-        task = s.query(ScheduleTask).filter_by(id=task_id).first()
-        if not task:
-            raise HTTPException(404, "Task not found")
-        
-        old_qty = task.qty
-        task.qty = max(float(payload.new_qty), 0.0)
-        s.commit()
-        return {"message": f"任務數量已從 {old_qty} 更新為 {task.qty}"}
+    async with SessionLocal() as s:
+        result = await services.update_task_qty(s, task_id, payload.new_qty)
+        await s.commit()
+        return result
+
+
+# =========================================================
+# 批次：多個操作一次送來，同一個交易（全部成功或全部不算）
+# =========================================================
+MAX_BATCH_OPERATIONS = 50
+
+@app.post("/batch")
+async def run_batch(payload: BatchRequest, idempotency_key: Optional[str] = Header(None)):
+    """
+    依序執行多個寫入操作（對應各個單一路由），同一個資料庫交易：
+      - 任何一個失敗 → 整批 rollback，回傳該操作的狀態碼與 index
+      - 全部成功 → 回傳每個操作的結果、各表寫入後的版本 + 一份最終狀態（庫存 / 有動到的剩料日 / 排程）
+    body: {"operations": [{"op": "upsert_leftovers", "args": {...}}, {"op": "complete_task", "args": {"task_id": 3}}]}
+    """
+    if not payload.operations:
+        raise HTTPException(400, "operations 不可為空")
+    if len(payload.operations) > MAX_BATCH_OPERATIONS:
+        raise HTTPException(400, f"一次最多 {MAX_BATCH_OPERATIONS} 個操作")
+    unknown = [o.op for o in payload.operations if o.op not in services.OPERATIONS]
+    if unknown:
+        raise HTTPException(400, f"不支援的操作：{', '.join(unknown)}")
+
+    await services.resolve_weather(payload.operations)
+    async with SessionLocal() as s:
+        result = await idempotency.begin(s, idempotency_key, "batch")
+        if result is None:
+            results = []
+            for i, operation in enumerate(payload.operations):
+                try:
+                    results.append({"op": operation.op,
+                                    "result": await services.OPERATIONS[operation.op](s, operation.args)})
+                except HTTPException as e:
+                    raise HTTPException(e.status_code, {"index": i, "op": operation.op, "detail": e.detail})
+                except ValidationError as e:
+                    raise HTTPException(422, {"index": i, "op": operation.op,
+                                              "detail": jsonable_encoder(e.errors(include_url=False))})
+            # 各表寫入後的資料版本（版本號 commit 前才遞增：整批一次，不在每個操作的結果裡）
+            versions = await stamp_versions(s)
+            result = {"results": results,
+                      "versions": {t: versions[table_key(t)] for t in changelog.TABLES if table_key(t) in versions}}
+            await idempotency.finish(s, idempotency_key, result)
+            await s.commit()
+
+    # 重送（同一個 Idempotency-Key）不再執行，但最終狀態照樣回傳目前的
+    if payload.include_state:
+        days = sorted({LeftoverUpsert(**o.args).day for o in payload.operations if o.op == "upsert_leftovers"}
+                      or {date.today()})
+        async with SessionLocal() as s:
+            await ensure_schedule(s)  # 批次可能改到排程輸入，跟 GET /schedule 一樣先確保排程是新的
+            result = {**result, "state": {
+                "inventory": await read_inventory(s),
+                "leftovers": {d.isoformat(): await read_leftovers(s, d) for d in days},
+                "schedule": await services.read_schedule(s),
+            }}
+    return result
+
+
+# =========================================================
+# 模擬：改參數之前先跑 Monte Carlo（背景執行，結果存在資料庫）
+# =========================================================
+@app.post("/simulations", status_code=202)
+async def create_simulation(payload: SimulationRequest):
+    """
+    body 見 SimulationRequest（danger_levels / task_levels / K / safety_factor 覆蓋目前的設定）
+    回傳 job id，用 GET /simulations/{id} 查進度與結果
+    """
+    try:
+        simulate.check_size(payload)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    return {"id": await simulate.submit(payload), "status": "queued"}
+
+@app.get("/simulations/{job_id}")
+async def get_simulation(job_id: str):
+    async with SessionLocal() as s:
+        job = await simulate.get_job(s, job_id)
+    if job is None:
+        raise HTTPException(404, "Simulation not found")
+    return job
+
+
+# =========================================================
+# 離線同步：游標之後的變更 / 上傳離線時累積的操作
+# =========================================================
+MAX_SYNC_OPERATIONS = 200
+
+@app.get("/sync")
+async def get_sync(since: int = Query(0, ge=0), limit: int = Query(changelog.PAGE_SIZE, ge=1, le=10000)):
+    """
+    since 之後有變的列（每列只給最新值；刪除的任務放在 deleted）
+    回傳 {cursor, reset, more, changes: {table: {key: row}}, deleted: {table: [key]}}
+      - more=true：還有，拿 cursor 再呼叫一次
+      - reset=true（第一次同步或游標太舊）：整批重抓 /inventory、/schedule ...，之後從 cursor 繼續
+    """
+    async with SessionLocal() as s:
+        return await changelog.changes_since(s, since, limit)
+
+@app.post("/sync/push")
+async def push_sync(payload: SyncPush):
+    """
+    依序套用裝置離線時累積的操作，每個操作各自回報 applied / duplicate / conflict / error
+    回應同時附上 payload.cursor 之後的變更（包含這批自己的寫入），裝置套用後更新游標
+    """
+    if len(payload.operations) > MAX_SYNC_OPERATIONS:
+        raise HTTPException(400, f"一次最多 {MAX_SYNC_OPERATIONS} 個操作")
+    await services.resolve_weather(payload.operations)
+    async with SessionLocal() as s:
+        results = await sync.apply_operations(s, payload.device, payload.operations)
+        await s.commit()
+    async with SessionLocal() as s:
+        return {"results": results, "sync": await changelog.changes_since(s, payload.cursor)}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,345 @@
+# bus.py
+"""
+跨行程的失效 / 通知匯流排（多個 uvicorn worker、多台機器共用同一個資料庫時）：
+  - 本行程 commit 後：遞增過的版本號（db.on_commit）與 SSE 事件（events.hub.forward）放進待送區，
+    背景工作合併成一則訊息送出
+  - 收到別的行程的訊息：cache.versions.observe()（讀取快取 / ETag / 品項目錄 / 需求模型都依版本判斷，
+    馬上就不會再用舊的），事件轉給本行程的 SSE 訂閱者
+  - 訊息可能漏（斷線、超過大小）：重新從資料庫讀版本，SSE 送 resync；另外每 RECONCILE_SECONDS 也會對一次
+後端（BUS_BACKEND）：
+  memory   單一行程（或測試：同一個行程內的多個 bus 互通）
+  sqlite   同一台機器：另一個 SQLite 檔（BUS_PATH）當訊息佇列，各 worker 輪詢，不佔主資料庫的寫入鎖
+  postgres LISTEN / NOTIFY（多台機器）
+未指定時：Postgres → postgres；SQLite 檔案 → sqlite；其他 → memory
+"""
+import abc
+import asyncio
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy.engine import make_url
+
+from db import DATABASE_URL, SessionLocal, engine, on_commit
+import cache
+import events
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "inventory_bus"
+POLL_SECONDS = float(os.getenv("BUS_POLL_SECONDS", "0.05"))
+RECONCILE_SECONDS = float(os.getenv("BUS_RECONCILE_SECONDS", "30"))
+# NOTIFY 的 payload 上限約 8000 bytes；超過就只送版本號，事件改成 resync
+MAX_PAYLOAD = 7500
+# sqlite 後端保留多久的訊息
+RETENTION_SECONDS = 60.0
+# postgres 重連失敗時的等待：每次加倍，最多到這裡
+RECONNECT_MAX_SECONDS = float(os.getenv("BUS_RECONNECT_MAX_SECONDS", "30"))
+
+Message = Dict
+
+
+def apply(message: Message) -> None:
+    """套用別的行程送來的訊息"""
+    cache.versions.observe(message.get("versions") or {})
+    for type, data in message.get("events") or []:
+        events.hub.publish(type, data)
+    if message.get("resync"):
+        events.hub.publish(events.RESYNC, {})
+
+
+class Bus(abc.ABC):
+    """後端只要實作 send / listen（connect / disconnect 視需要）；少實作的在建立時就會失敗"""
+    name = "base"
+
+    def __init__(self, handler: Callable[[Message], None] = apply):
+        self.origin = secrets.token_hex(4)
+        self.handler = handler
+        self.sent = 0
+        self.received = 0
+        self._versions: Dict[str, int] = {}
+        self._events: List = []
+        self._wake: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+
+    # ---------- 本行程 → 其他行程 ----------
+    def publish_versions(self, versions: Dict[str, int]) -> None:
+        if self._wake is None:
+            return
+        for key, version in versions.items():
+            if version > self._versions.get(key, -1):
+                self._versions[key] = version
+        self._wake.set()
+
+    def publish_event(self, type: str, data: Dict) -> None:
+        if self._wake is None:
+            return
+        self._events.append((type, data))
+        self._wake.set()
+
+    def _take(self) -> Message:
+        message = {"origin": self.origin, "versions": self._versions, "events": self._events}
+        self._versions, self._events = {}, []
+        return message
+
+    async def _sender(self) -> None:
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            message = self._take()
+            if not message["versions"] and not message["events"]:
+                continue
+            payload = json.dumps(message, ensure_ascii=False, separators=(",", ":"), default=str)
+            if len(payload.encode()) > MAX_PAYLOAD:
+                payload = json.dumps({**message, "events": [], "resync": bool(message["events"])},
+                                     separators=(",", ":"))
+            try:
+                await self.send(payload)
+                self.sent += 1
+            except Exception as e:
+                logger.warning("send failed: %s", e)
+                metrics.BUS_ERRORS.inc(op="send")
+
+    # ---------- 其他行程 → 本行程 ----------
+    def receive(self, payload: str) -> None:
+        message = json.loads(payload)
+        if message.get("origin") == self.origin:
+            return
+        self.received += 1
+        self.handler(message)
+
+    async def reconcile(self) -> None:
+        """可能漏了訊息：直接讀資料庫的版本號，SSE 訂閱者重抓"""
+        async with SessionLocal() as s:
+            await cache.warm_versions(s)
+        self.handler({"resync": True})
+
+    async def _reconciler(self) -> None:
+        while True:
+            await asyncio.sleep(RECONCILE_SECONDS)
+            try:
+                async with SessionLocal() as s:
+                    await cache.warm_versions(s)
+            except Exception as e:
+                logger.warning("reconcile failed: %s", e)
+                metrics.BUS_ERRORS.inc(op="reconcile")
+
+    # ---------- 後端實作 ----------
+    async def connect(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def send(self, payload: str) -> None:
+        """送一則訊息給其他行程"""
+
+    @abc.abstractmethod
+    async def listen(self) -> None:
+        """收訊息直到被取消"""
+
+    async def disconnect(self) -> None:
+        pass
+
+    # ---------- 生命週期 ----------
+    async def start(self) -> None:
+        await self.connect()
+        self._wake = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._sender()), asyncio.ensure_future(self.listen()),
+                       asyncio.ensure_future(self._reconciler())]
+
+    async def close(self) -> None:
+        self._wake = None
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.disconnect()
+
+    def stats(self) -> Dict:
+        return {"backend": self.name, "origin": self.origin, "sent": self.sent, "received": self.received}
+
+
+class MemoryBus(Bus):
+    """同一個行程內的 bus 互通（單一 worker 時等於不送；測試時可以開兩個模擬兩個 worker）"""
+    name = "memory"
+    _members: List["MemoryBus"] = []
+
+    async def connect(self) -> None:
+        MemoryBus._members.append(self)
+
+    async def send(self, payload: str) -> None:
+        for member in list(MemoryBus._members):
+            if member is not self:
+                member.receive(payload)
+
+    async def listen(self) -> None:
+        """send 直接交給其他成員，不用收"""
+
+    async def disconnect(self) -> None:
+        if self in MemoryBus._members:
+            MemoryBus._members.remove(self)
+
+
+class SQLiteBus(Bus):
+    """
+    同一台機器的 worker 共用一個 SQLite 檔（WAL）：送 = INSERT，收 = 每 POLL_SECONDS 查 id 比上次大的
+    sqlite3 是同步的，放到 thread 跑；連線的使用與關閉都在 _io 鎖內
+    """
+    name = "sqlite"
+
+    def __init__(self, path: str, handler: Callable[[Message], None] = apply):
+        super().__init__(handler)
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._last_id = 0
+        self._pruned_at = 0.0
+        self._io = threading.Lock()   # send / poll 在不同的 thread，共用一條連線
+
+    def _open(self) -> None:
+        self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS bus_messages ("
+                           "id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL, payload TEXT NOT NULL)")
+        self._last_id = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM bus_messages").fetchone()[0]
+
+    async def connect(self) -> None:
+        await asyncio.to_thread(self._open)
+
+    def _insert(self, payload: str) -> None:
+        now = time.time()
+        with self._io:
+            if self._conn is None:
+                return
+            self._conn.execute("INSERT INTO bus_messages (ts, payload) VALUES (?, ?)", (now, payload))
+            if now - self._pruned_at > RETENTION_SECONDS:
+                self._pruned_at = now
+                self._conn.execute("DELETE FROM bus_messages WHERE ts < ?", (now - RETENTION_SECONDS,))
+
+    async def send(self, payload: str) -> None:
+        await asyncio.to_thread(self._insert, payload)
+
+    def _poll(self) -> List:
+        with self._io:
+            if self._conn is None:
+                return []
+            rows = self._conn.execute("SELECT id, payload FROM bus_messages WHERE id > ? ORDER BY id",
+                                      (self._last_id,)).fetchall()
+        if rows:
+            self._last_id = rows[-1][0]
+        return rows
+
+    async def listen(self) -> None:
+        while True:
+            await asyncio.sleep(POLL_SECONDS)
+            try:
+                for _, payload in await asyncio.to_thread(self._poll):
+                    self.receive(payload)
+            except sqlite3.Error as e:
+                logger.warning("poll failed: %s", e)
+                metrics.BUS_ERRORS.inc(op="poll")
+
+    def _close(self) -> None:
+        # 取消 send / listen 不會停掉已經在 thread 裡跑的 _insert / _poll：拿到鎖才關，不在用到一半時關
+        with self._io:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    async def disconnect(self) -> None:
+        await asyncio.to_thread(self._close)
+
+
+class PostgresBus(Bus):
+    """
+    LISTEN / NOTIFY：佔一條連線（不還給連線池），送也走這條
+    連線斷掉：重新連上、LISTEN，並 reconcile（斷線期間的通知收不到）
+    """
+    name = "postgres"
+
+    def __init__(self, handler: Callable[[Message], None] = apply):
+        super().__init__(handler)
+        self._conn = None
+        self._driver = None
+        self._lock = asyncio.Lock()
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        self.receive(payload)
+
+    async def connect(self) -> None:
+        self._conn = await engine.connect()
+        try:
+            raw = await self._conn.get_raw_connection()
+            self._driver = raw.driver_connection
+            await self._driver.add_listener(CHANNEL, self._on_notify)
+        except Exception:
+            # 連到一半失敗：不留下沒 LISTEN 的連線（否則 listen 會以為還連著）
+            await self.disconnect()
+            raise
+
+    def _connected(self) -> bool:
+        # 重連失敗時 _driver 是 None，一樣當成斷線
+        return self._driver is not None and not self._driver.is_closed()
+
+    async def send(self, payload: str) -> None:
+        async with self._lock:
+            if not self._connected():
+                raise ConnectionError("bus not connected")
+            await self._driver.execute("SELECT pg_notify($1, $2)", CHANNEL, payload)
+
+    async def listen(self) -> None:
+        # 通知由 asyncpg 直接回呼 _on_notify；這裡只負責發現斷線並重連（失敗就加倍等待再試）
+        delay = 1.0
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                if self._connected():
+                    continue
+                async with self._lock:
+                    await self.disconnect()
+                    await self.connect()
+                await self.reconcile()
+                delay = 1.0
+            except Exception as e:
+                delay = min(delay * 2, RECONNECT_MAX_SECONDS)
+                logger.warning("reconnect failed (retry in %.0fs): %s", delay, e)
+                metrics.BUS_ERRORS.inc(op="reconnect")
+
+    async def disconnect(self) -> None:
+        if self._conn is None:
+            return
+        try:
+            if self._connected():
+                await self._driver.remove_listener(CHANNEL, self._on_notify)
+            await self._conn.invalidate()
+        except Exception:
+            pass
+        self._conn = self._driver = None
+
+
+def create(backend: Optional[str] = None) -> Bus:
+    url = make_url(DATABASE_URL)
+    backend = backend or os.getenv("BUS_BACKEND")
+    if backend is None:
+        if url.get_backend_name() in ("postgres", "postgresql"):
+            backend = "postgres"
+        elif url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:"):
+            backend = "sqlite"
+        else:
+            backend = "memory"
+    if backend == "postgres":
+        return PostgresBus()
+    if backend == "sqlite":
+        return SQLiteBus(os.getenv("BUS_PATH") or f"{url.database}.bus")
+    if backend == "memory":
+        return MemoryBus()
+    raise ValueError(f"unknown BUS_BACKEND: {backend}")
+
+
+bus = create()
+on_commit(bus.publish_versions)
+events.hub.forward = bus.publish_event
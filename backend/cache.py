@@ -0,0 +1,199 @@
+# cache.py
+"""
+讀取快取 + ETag：
+  - 每張表有一個資料版本（meta_versions 的 table:<name>），寫入端在交易內 +1
+  - 本行程在 commit 後更新記憶體中的版本（db.on_commit），讀取端不用查資料庫就知道資料有沒有變
+  - ETag 由版本組成；If-None-Match 相同 → 直接 304，不碰資料庫
+  - Memo：計算結果（不是 HTTP 回應）的 LRU + single-flight，給 POST /delivery 這類讀取用
+"""
+import asyncio
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from fastapi import Request, Response
+
+from db import DATA_EPOCH, SCHEDULE_INPUTS, load_versions, on_commit, table_key
+from serialization import dumps
+
+
+class DataVersions:
+    """記憶體中的版本表（只會往前，不會倒退）"""
+
+    def __init__(self):
+        self._versions: Dict[str, int] = {}
+
+    def observe(self, versions: Dict[str, int]) -> None:
+        for key, version in versions.items():
+            if version > self._versions.get(key, -1):
+                self._versions[key] = version
+
+    def get(self, key: str) -> int:
+        return self._versions.get(key, 0)
+
+    def tables(self, *tables: str) -> Tuple[int, ...]:
+        return tuple(self.get(table_key(t)) for t in tables)
+
+    def snapshot(self) -> Dict[str, int]:
+        return dict(self._versions)
+
+
+class ReadCache:
+    """key → (etag, body)；etag 不同就視為過期"""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: Dict[str, Tuple[str, bytes]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def get(self, key: str, etag: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == etag:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, key: str, etag: str, body: bytes) -> None:
+        if key not in self._entries and len(self._entries) >= self.max_entries:
+            # 最舊的先丟（dict 保持插入順序）
+            self._entries.pop(next(iter(self._entries)))
+        self._entries[key] = (etag, body)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "entries": len(self._entries),
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class Memo:
+    """
+    計算結果的 LRU（最多 max_entries 筆）+ single-flight：
+      - key = 參數 + depends 的資料版本：相關資料寫入後版本 +1，舊結果不會再被拿到（別的 worker 寫的也一樣）
+      - 本行程 commit 時 depends 有變就直接清空，不用等 LRU 擠掉
+      - 同一個 key 正在算：後到的請求等同一個計算；計算在獨立的 task 裡跑，
+        第一個請求斷線也不會讓等著的請求一起被取消
+      - 出錯不快取，等著的請求收到同一個例外
+    """
+
+    def __init__(self, depends: Iterable[str], max_entries: int = 256):
+        self.depends = tuple(depends)
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, Any]" = OrderedDict()
+        self._inflight: Dict[Tuple, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.invalidations = 0
+        on_commit(self._on_commit)
+
+    def _versions(self) -> Tuple[int, ...]:
+        return tuple(versions.get(k) for k in self.depends)
+
+    def _on_commit(self, changed: Dict[str, int]) -> None:
+        if self._entries and any(k in changed for k in self.depends):
+            self._entries.clear()
+            self.invalidations += 1
+
+    async def get(self, params: Tuple, compute: Callable[[], Awaitable]) -> Any:
+        key = (params, self._versions())
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = self._inflight[key] = asyncio.ensure_future(compute())
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key: Tuple, task: asyncio.Future) -> None:
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        # 算的途中資料變了：結果已經舊了，不放進去
+        if key[1] != self._versions():
+            return
+        self._entries[key] = task.result()
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "invalidations": self.invalidations,
+            "entries": len(self._entries),
+            "inflight": len(self._inflight),
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+        }
+
+
+versions = DataVersions()
+read_cache = ReadCache()
+on_commit(versions.observe)
+
+
+async def warm_versions(session) -> None:
+    versions.observe(await load_versions(session))
+
+
+def make_etag(name: str, tables: Iterable[str], extra: Iterable[str] = ()) -> str:
+    parts = [name, str(versions.get(DATA_EPOCH))]
+    parts += [f"{t}.{v}" for t, v in zip(tables, versions.tables(*tables))]
+    parts += list(extra)
+    return '"' + "-".join(parts) + '"'
+
+
+def schedule_etag(today: date, params: Iterable[str] = ()) -> str:
+    # 排程還取決於「排程輸入」與日期（跨日要重排）；params：查詢的日期區間
+    return make_etag("schedule", ["schedule_tasks"],
+                     [f"in.{versions.get(SCHEDULE_INPUTS)}", today.isoformat(), *params])
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    match = request.headers.get("if-none-match")
+    # 壓縮過的回應 ETag 會變成弱比對（W/"..."），比對時忽略前綴
+    if match and etag in [m.strip().removeprefix("W/") for m in match.split(",")]:
+        read_cache.not_modified += 1
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return None
+
+
+def render(data) -> bytes:
+    return dumps(data)
+
+
+def json_response(body: bytes, etag: str) -> Response:
+    return Response(content=body, media_type="application/json",
+                    headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+async def cached_json(request: Request, key: str, etag: str, loader: Callable[[], Awaitable]) -> Response:
+    """
+    304 → 快取 → loader()；etag 要在 loader 之前算好，
+    讀取中途有人寫入也只會讓「新資料配舊 etag」，下一次請求就會更新
+    """
+    hit = not_modified(request, etag)
+    if hit is not None:
+        return hit
+    body = read_cache.get(key, etag)
+    if body is None:
+        body = render(await loader())
+        read_cache.put(key, etag, body)
+    return json_response(body, etag)
@@ -0,0 +1,261 @@
+# catalog.py
+"""
+品項目錄（product_rules 表）：
+  - 每個品項的 提貨基準量 / 進位方式 / 顯示條件、合併群組、排程批量與強度門檻、完成產出
+  - 載入時編譯成查表用的 dict / frozenset，請求路徑上不再比對字串
+  - 目錄有異動時 catalog 版本 +1；各行程 refresh 時看到版本不同就重新載入（不用重啟）
+  - 第一次 migration 時寫入 DEFAULT_RULES（原本寫死在程式裡的規則）
+"""
+import json
+import math
+from dataclasses import dataclass
+from typing import Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+
+from sqlalchemy import delete, func, select
+
+from db import CATALOG, SCHEDULE_INPUTS, Inventory, MetaVersion, ProductRule, bump_version, dialect_insert, table_key
+import changelog
+import stock
+
+# 原本散在 models / logic / planner 的規則；順序即提貨計畫的欄位順序
+DEFAULT_RULES: List[Dict] = [
+    {"item": "魚肚", "base_delivery": 3.0, "light_task": True, "intensity_coeff": 1.2,
+     "task_levels": [[0.85, "魚肚", 6.0], [0.65, "魚肚", 5.0], [0.45, "魚肚", 4.0], [0.0, "魚肚", 3.0]]},
+    {"item": "魚皮", "base_delivery": 2.0, "intensity_coeff": 1.1, "restock_item": "魚肉"},
+    # 剝一次產出 3包魚肉 + 4包魚皮；隔天要做丸子才需要提魚肉
+    {"item": "魚肉", "base_delivery": 3.0, "light_task": True, "delivery_decimals": 0, "delivery_truncate": True,
+     "delivery_requires": "ball", "task_levels": [[0.0, "剝魚肉", 1.0]], "task_yield": {"魚肉": 3.0, "魚皮": 4.0}},
+    {"item": "粉蒸", "base_delivery": 2.0, "task_levels": [[0.0, "粉蒸", 8.0]]},
+    {"item": "Q腸", "base_delivery": 1.0, "merge_into": "腸子"},
+    {"item": "豬腸", "base_delivery": 1.0, "merge_into": "腸子"},
+    {"item": "燕餃", "base_delivery": 1.0},
+    {"item": "蝦丸", "base_delivery": 1.0, "merge_into": "蝦肉丸", "tags": ["ball"]},
+    {"item": "肉丸", "base_delivery": 0.5, "merge_into": "蝦肉丸", "tags": ["ball"]},
+    {"item": "肉燥", "base_delivery": 0.5, "task_levels": [[0.0, "肉燥", 8.0]]},
+    {"item": "骨頭", "base_delivery": 1.0},
+    # 排程用的虛擬品項（沒有庫存列、不提貨）；腸子、蝦肉丸的數量由現場決定
+    {"item": "腸子", "stocked": False, "intensity_coeff": 0.9, "task_levels": [[0.0, "腸子", 0.0]]},
+    {"item": "蝦肉丸", "stocked": False, "intensity_coeff": 1.1, "tags": ["ball"],
+     "task_levels": [[0.0, "蝦肉丸", 0.0]]},
+    {"item": "脆丸", "stocked": False, "intensity_coeff": 1.3, "tags": ["ball"],
+     "task_levels": [[0.8, "脆丸9", 5.5], [0.5, "脆丸8", 5.0], [0.0, "脆丸7", 4.5]]},
+]
+
+DEFAULT_PRODUCTS: List[str] = [r["item"] for r in DEFAULT_RULES if r.get("stocked", True)]
+
+
+@dataclass(frozen=True)
+class Rule:
+    item: str
+    position: int = 0
+    stocked: bool = True
+    base_delivery: Optional[float] = None
+    delivery_decimals: int = 1
+    delivery_truncate: bool = False
+    delivery_requires: Optional[str] = None
+    tags: FrozenSet[str] = frozenset()
+    merge_into: Optional[str] = None
+    restock_item: Optional[str] = None
+    light_task: bool = False
+    intensity_coeff: float = 1.0
+    task_levels: Tuple[Tuple[float, str, float], ...] = ()   # 依最低強度由大到小
+    task_yield: Optional[Dict[str, float]] = None
+
+    def as_dict(self) -> Dict:
+        return {
+            "item": self.item, "position": self.position, "stocked": self.stocked,
+            "base_delivery": self.base_delivery, "delivery_decimals": self.delivery_decimals,
+            "delivery_truncate": self.delivery_truncate, "delivery_requires": self.delivery_requires,
+            "tags": sorted(self.tags), "merge_into": self.merge_into, "restock_item": self.restock_item,
+            "light_task": self.light_task, "intensity_coeff": self.intensity_coeff,
+            "task_levels": [list(level) for level in self.task_levels], "task_yield": self.task_yield,
+        }
+
+
+def rule_from_row(row: ProductRule) -> Rule:
+    levels = json.loads(row.task_levels) if row.task_levels else []
+    return Rule(
+        item=row.item, position=row.position or 0, stocked=bool(row.stocked),
+        base_delivery=row.base_delivery,
+        delivery_decimals=row.delivery_decimals if row.delivery_decimals is not None else 1,
+        delivery_truncate=bool(row.delivery_truncate), delivery_requires=row.delivery_requires or None,
+        tags=frozenset(t.strip() for t in (row.tags or "").split(",") if t.strip()),
+        merge_into=row.merge_into or None, restock_item=row.restock_item or None,
+        light_task=bool(row.light_task),
+        intensity_coeff=row.intensity_coeff if row.intensity_coeff is not None else 1.0,
+        task_levels=tuple(sorted(((float(m), str(n), float(q)) for m, n, q in levels), key=lambda x: -x[0])),
+        task_yield={k: float(v) for k, v in json.loads(row.task_yield).items()} if row.task_yield else None,
+    )
+
+
+def row_values(rule: Dict, position: int) -> Dict:
+    """DEFAULT_RULES / API 的格式 → product_rules 一列"""
+    return {
+        "item": rule["item"],
+        "position": rule.get("position", position),
+        "stocked": rule.get("stocked", True),
+        "base_delivery": rule.get("base_delivery"),
+        "delivery_decimals": rule.get("delivery_decimals", 1),
+        "delivery_truncate": rule.get("delivery_truncate", False),
+        "delivery_requires": rule.get("delivery_requires"),
+        "tags": ",".join(rule.get("tags") or []),
+        "merge_into": rule.get("merge_into"),
+        "restock_item": rule.get("restock_item"),
+        "light_task": rule.get("light_task", False),
+        "intensity_coeff": rule.get("intensity_coeff", 1.0),
+        "task_levels": json.dumps(rule["task_levels"], ensure_ascii=False) if rule.get("task_levels") else None,
+        "task_yield": json.dumps(rule["task_yield"], ensure_ascii=False) if rule.get("task_yield") else None,
+    }
+
+
+class Catalog:
+    def __init__(self):
+        self.version = -1
+        self._listeners: List[Callable[["Catalog"], None]] = []
+        # 載入資料庫前先用預設規則（測試 / 工具程式不用連資料庫也能用）
+        self.compile([rule_from_row(ProductRule(**row_values(r, i))) for i, r in enumerate(DEFAULT_RULES)])
+
+    def on_reload(self, fn: Callable[["Catalog"], None]):
+        """重新編譯後通知（例如需求模型換基準量）"""
+        self._listeners.append(fn)
+        fn(self)
+        return fn
+
+    # ---------- 編譯 ----------
+    def compile(self, rules: List[Rule]) -> None:
+        rules = sorted(rules, key=lambda r: (r.position, r.item))
+        self.rules: Dict[str, Rule] = {r.item: r for r in rules}
+        self.products: List[str] = [r.item for r in rules if r.stocked]
+        # 需要提貨的品項（提貨計畫 / 預測的欄位）
+        self.delivery_items: List[str] = [r.item for r in rules if r.base_delivery is not None]
+        self.base_delivery: Dict[str, float] = {r.item: r.base_delivery for r in rules if r.base_delivery is not None}
+        groups: Dict[str, List[str]] = {}
+        for r in rules:
+            if r.merge_into:
+                groups.setdefault(r.merge_into, []).append(r.item)
+        self.merge_groups: Dict[str, Tuple[str, ...]] = {g: tuple(parts) for g, parts in groups.items()}
+        self.light: FrozenSet[str] = frozenset(r.item for r in rules if r.light_task)
+        tagged: Dict[str, Set[str]] = {}
+        for r in rules:
+            for tag in r.tags:
+                tagged.setdefault(tag, set()).add(r.item)
+        self.tagged: Dict[str, FrozenSet[str]] = {t: frozenset(items) for t, items in tagged.items()}
+        for fn in self._listeners:
+            fn(self)
+
+    async def load(self, session) -> None:
+        rows = (await session.scalars(select(ProductRule))).all()
+        self.version = (await session.scalar(select(MetaVersion.version).where(MetaVersion.key == CATALOG))) or 0
+        self.compile([rule_from_row(r) for r in rows])
+
+    async def refresh(self, session, version: int) -> None:
+        """目錄版本對不上（本行程或別的行程改過）才重新載入"""
+        if version != self.version:
+            await self.load(session)
+
+    # ---------- 查表 ----------
+    def tagged_items(self, tag: str) -> FrozenSet[str]:
+        return self.tagged.get(tag, frozenset())
+
+    def intensity_coeff(self, item: str) -> float:
+        rule = self.rules.get(item)
+        return rule.intensity_coeff if rule else 1.0
+
+    def task_for(self, item: str, intensity: float) -> Tuple[str, float]:
+        """(工作名稱, 數量)：取強度達到門檻的最高一級；自己沒設定就用合併群組的，都沒有則 (品項, 0)"""
+        rule = self.rules.get(item)
+        if rule is not None and not rule.task_levels and rule.merge_into:
+            rule = self.rules.get(rule.merge_into)
+        if rule is None or not rule.task_levels:
+            return (item, 0.0)
+        for threshold, name, qty in rule.task_levels:
+            if intensity >= threshold:
+                return (name, qty)
+        _, name, qty = rule.task_levels[-1]
+        return (name, qty)
+
+    def delivery_qty(self, item: str, qty: float, target_items: Set[str]) -> Optional[float]:
+        """
+        提貨量的顯示值；None 表示不顯示
+          target_items：目標日的未完成任務品項（delivery_requires 的條件）
+        """
+        rule = self.rules.get(item)
+        if rule is None:
+            return round(qty, 1)
+        if rule.base_delivery is None:
+            return None
+        if rule.delivery_requires and not (target_items & self.tagged_items(rule.delivery_requires)):
+            return None
+        if rule.delivery_truncate:
+            scale = 10 ** rule.delivery_decimals
+            return float(math.floor(qty * scale) / scale)
+        return round(qty, rule.delivery_decimals)
+
+    def task_yield(self, item: str, qty: float) -> Dict[str, float]:
+        """完成一次任務的產出；沒設定 = 該品項 × 任務數量"""
+        rule = self.rules.get(item)
+        if rule is not None and rule.task_yield:
+            return dict(rule.task_yield)
+        return {item: float(qty)}
+
+    def describe(self) -> Dict:
+        return {"version": self.version, "rules": [r.as_dict() for r in self.rules.values()]}
+
+
+catalog = Catalog()
+
+
+# =========================================================
+# 資料庫端：預設規則、庫存列同步、單筆修改
+# =========================================================
+async def seed(session) -> None:
+    """寫入預設規則（一句批次 INSERT，已有的品項不動），再同步庫存列"""
+    stmt = dialect_insert(session)(ProductRule).on_conflict_do_nothing(index_elements=["item"])
+    added = (await session.execute(stmt.returning(ProductRule.item),
+                                   [row_values(r, i) for i, r in enumerate(DEFAULT_RULES)])).all()
+    if added:
+        bump_version(session, CATALOG)
+    await sync_inventory(session)
+
+
+async def sync_inventory(session) -> bool:
+    """
+    有庫存的品項補上庫存列（qty=0），虛擬品項的庫存列刪掉
+    回傳是否有變動（有的話 inventory 與排程輸入版本 +1）
+    """
+    rules = (await session.execute(select(ProductRule.item, ProductRule.stocked))).all()
+    stocked = [item for item, s in rules if s]
+    virtual = [item for item, s in rules if not s]
+    changed = False
+    if stocked:
+        stmt = dialect_insert(session)(Inventory).on_conflict_do_nothing(index_elements=["item"])
+        added = (await session.execute(stmt.returning(*stock.ROW),
+                                       [{"item": item, "qty": 0.0} for item in stocked])).all()
+        changed = bool(stock.emit_inventory(session, added))
+    if virtual:
+        removed = (await session.scalars(
+            delete(Inventory).where(Inventory.item.in_(virtual)).returning(Inventory.item)
+            .execution_options(synchronize_session=False))).all()
+        changelog.record(session, changelog.INVENTORY, deleted=removed)
+        changed = changed or bool(removed)
+    if changed:
+        bump_version(session, SCHEDULE_INPUTS, table_key("inventory"))
+    return changed
+
+
+async def upsert_rule(session, rule: Dict) -> None:
+    """新增 / 修改一個品項的規則（同一個交易內同步庫存列）；commit 後各行程 refresh 時重新編譯"""
+    position = rule.get("position")
+    if position is None:
+        existing = await session.scalar(select(ProductRule.position).where(ProductRule.item == rule["item"]))
+        if existing is None:
+            existing = (await session.scalar(select(func.max(ProductRule.position)))) or 0
+            existing += 1
+        position = existing
+    values = row_values({**rule, "position": position}, position)
+    stmt = dialect_insert(session)(ProductRule)
+    stmt = stmt.on_conflict_do_update(index_elements=["item"],
+                                      set_={k: stmt.excluded[k] for k in values if k != "item"})
+    await session.execute(stmt, [values])
+    await sync_inventory(session)
+    bump_version(session, CATALOG, SCHEDULE_INPUTS)
@@ -0,0 +1,138 @@
+# changelog.py
+"""
+離線同步的變更紀錄：
+  - 寫入端把寫入後的整列記下來（刪除記墓碑），先放在 session 上
+  - commit 前才拿這個交易的 seq（meta_versions 的 change_seq，與其他版本號同一句 UPDATE），
+    再一句 INSERT 整批寫進 change_log；change_seq 那一列從這裡鎖到 commit，
+    所以 seq 的順序就是 commit 的順序：看得到 seq N 就表示 N 之前的都 commit 了
+  - GET /sync?since=<seq>：只回傳之後有變的列（同一列只給最後的值）
+  - 太舊的紀錄定期清掉；游標比清理點還舊 → reset，客戶端整批重抓
+"""
+import json
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import delete, func, select, tuple_, update
+
+from db import CHANGE_FLOOR, CHANGE_SEQ, ChangeLog, MetaVersion, before_commit, bump_version
+
+INVENTORY = "inventory"
+LEFTOVERS = "leftovers"
+DELIVERY_PLANS = "delivery_plans"
+SCHEDULE_TASKS = "schedule_tasks"
+TABLES = (INVENTORY, LEFTOVERS, DELIVERY_PLANS, SCHEDULE_TASKS)
+
+# 一次最多回傳幾筆（同一個 seq 不會被切開）
+PAGE_SIZE = 1000
+# 紀錄保留多久（更舊的游標要整批重抓）
+RETENTION = timedelta(days=30)
+
+
+def day_key(day: date, item: str) -> str:
+    return f"{day.isoformat()}|{item}"
+
+
+def record(session, table: str, upserts: Optional[Dict[str, dict]] = None, deleted: Iterable = ()) -> None:
+    """記下這個交易寫入後的列（key → 整列）與刪除的 key；commit 前才寫入（_write）"""
+    upserts = upserts or {}
+    deleted = [str(k) for k in deleted]
+    if not upserts and not deleted:
+        return
+    now = datetime.utcnow()
+    rows = _pending(session)
+    rows += [{"table_name": table, "key": str(k), "ts": now,
+              "data": json.dumps(v, ensure_ascii=False, default=str)} for k, v in upserts.items()]
+    rows += [{"table_name": table, "key": k, "ts": now, "data": None} for k in deleted]
+
+
+def _pending(session) -> List[dict]:
+    rows = session.info.get("change_log")
+    if rows is None:
+        rows = session.info["change_log"] = []
+        bump_version(session, CHANGE_SEQ)
+        before_commit(session, _write)
+    return rows
+
+
+def _write(session, versions: Dict[str, int]) -> None:
+    """commit 前：這個交易的所有變更用同一個 seq 一次寫入；reset 過就把清理點推到這個 seq"""
+    seq = versions[CHANGE_SEQ]
+    rows = session.info.pop("change_log", [])
+    if rows:
+        session.execute(ChangeLog.__table__.insert(), [{**r, "seq": seq} for r in rows])
+    if session.info.pop("change_reset", False):
+        session.execute(update(MetaVersion).where(MetaVersion.key == CHANGE_FLOOR, MetaVersion.version < seq)
+                        .values(version=seq))
+
+
+async def _meta(session, key: str) -> int:
+    return (await session.scalar(select(MetaVersion.version).where(MetaVersion.key == key))) or 0
+
+
+async def changes_since(session, since: int, limit: int = PAGE_SIZE) -> Dict:
+    """
+    since 之後的變更（每列只留最後的值）
+    回傳 {cursor, reset, more, changes: {table: {key: row}}, deleted: {table: [key]}}
+    since <= 0 或比清理點舊 → reset=True（請整批重抓後從 cursor 繼續）
+    """
+    if since <= 0 or since < await _meta(session, CHANGE_FLOOR):
+        return {"cursor": await _meta(session, CHANGE_SEQ), "reset": True, "more": False,
+                "changes": {}, "deleted": {}}
+    rows = (await session.execute(
+        select(ChangeLog.seq, ChangeLog.table_name, ChangeLog.key, ChangeLog.data)
+        .where(ChangeLog.seq > since).order_by(ChangeLog.id).limit(limit + 1)
+    )).all()
+    more = len(rows) > limit
+    if more:
+        # 最後一個 seq 可能沒拿完：切在它之前；只有一個 seq（超大交易）就整個拿
+        last = rows[limit].seq
+        rows = [r for r in rows if r.seq < last]
+        if not rows:
+            rows = (await session.execute(
+                select(ChangeLog.seq, ChangeLog.table_name, ChangeLog.key, ChangeLog.data)
+                .where(ChangeLog.seq == last).order_by(ChangeLog.id)
+            )).all()
+
+    latest: Dict[Tuple[str, str], Optional[str]] = {}
+    for r in rows:
+        latest.pop((r.table_name, r.key), None)   # 保持「最後一次變動」的順序
+        latest[(r.table_name, r.key)] = r.data
+    changes: Dict[str, Dict[str, dict]] = {}
+    deleted: Dict[str, List[str]] = {}
+    for (table, key), data in latest.items():
+        if data is None:
+            deleted.setdefault(table, []).append(key)
+        else:
+            changes.setdefault(table, {})[key] = json.loads(data)
+    return {"cursor": rows[-1].seq if rows else since, "reset": False, "more": more,
+            "changes": changes, "deleted": deleted}
+
+
+async def changed_since(session, since: int, targets: Sequence[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """
+    targets（(table, key)）裡 since 之後被改過的（衝突偵測用）
+    自己這個交易的變更還沒寫進 change_log（commit 前才寫），不會被算進來
+    """
+    if not targets:
+        return []
+    stmt = (select(ChangeLog.table_name, ChangeLog.key).distinct()
+            .where(ChangeLog.seq > since, tuple_(ChangeLog.table_name, ChangeLog.key).in_(list(targets))))
+    return [(t, k) for t, k in (await session.execute(stmt)).all()]
+
+
+def reset(session) -> None:
+    """資料整批換過（還原 / 大量匯入，沒有逐列紀錄）：commit 時清理點推到這個交易的 seq，所有客戶端下次都整批重抓"""
+    _pending(session)
+    session.info["change_reset"] = True
+
+
+async def prune(session, now: Optional[datetime] = None) -> int:
+    """刪掉超過保留期間的紀錄，並把清理點往前推"""
+    cutoff = (now or datetime.utcnow()) - RETENTION
+    floor = await session.scalar(select(func.max(ChangeLog.seq)).where(ChangeLog.ts < cutoff))
+    if floor is None:
+        return 0
+    removed = (await session.execute(delete(ChangeLog).where(ChangeLog.seq <= floor))).rowcount
+    await session.execute(update(MetaVersion).where(MetaVersion.key == CHANGE_FLOOR,
+                                                    MetaVersion.version < floor).values(version=floor))
+    return removed
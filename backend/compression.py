@@ -0,0 +1,133 @@
+# compression.py
+"""
+回應壓縮（ASGI middleware）：
+  - Accept-Encoding 有 br 且裝了 brotli → br；否則 gzip；都沒有就原樣
+  - 小於 COMPRESS_MIN_SIZE 的一次性回應不壓（壓了反而更大、還多花 CPU）
+  - 串流回應（NDJSON 預測）逐段壓縮並 flush，客戶端照樣逐行收到
+  - SSE（text/event-stream）、304、已經有 Content-Encoding 的不處理
+  - 壓縮後 ETag 改成弱 ETag（W/"..."），cache.not_modified 比對時會忽略前綴
+"""
+import os
+import zlib
+from typing import List, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli 是選配
+    brotli = None
+
+MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))
+
+COMPRESSIBLE = (b"application/json", b"application/x-ndjson", b"text/plain", b"text/csv", b"text/html")
+
+
+class _Gzip:
+    def __init__(self):
+        self._z = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def chunk(self, data: bytes) -> bytes:
+        return self._z.compress(data) + self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._z.compress(data) + self._z.flush(zlib.Z_FINISH)
+
+
+class _Brotli:
+    def __init__(self):
+        self._c = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def chunk(self, data: bytes) -> bytes:
+        return self._c.process(data) + self._c.flush()
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._c.process(data) + self._c.finish()
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0"):
+            continue
+        accepted.add(name.strip())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+def _header(headers: List[Tuple[bytes, bytes]], name: bytes) -> Optional[bytes]:
+    for k, v in headers:
+        if k.lower() == name:
+            return v
+    return None
+
+
+class CompressionMiddleware:
+    def __init__(self, app, min_size: int = MIN_SIZE):
+        self.app = app
+        self.min_size = min_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        accept = b""
+        for k, v in scope.get("headers", []):
+            if k == b"accept-encoding":
+                accept = v
+                break
+        encoding = choose_encoding(accept.decode("latin-1"))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None         # 暫存的 http.response.start（等看到第一段 body 才決定壓不壓）
+        compressor = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                headers = message.get("headers", [])
+                content_type = _header(headers, b"content-type") or b""
+                if (message["status"] in (204, 304) or _header(headers, b"content-encoding") is not None
+                        or not content_type.startswith(COMPRESSIBLE)):
+                    passthrough = True
+                    return await send(message)
+                start = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                return await send(message)
+
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+            if start is not None:
+                if not more and len(body) < self.min_size:
+                    passthrough = True
+                    await send(start)
+                    start = None
+                    return await send(message)
+                compressor = _Brotli() if encoding == "br" else _Gzip()
+                headers = [(k, v) for k, v in start.get("headers", []) if k.lower() != b"content-length"]
+                headers.append((b"content-encoding", encoding.encode()))
+                vary = _header(headers, b"vary")
+                if vary is None:
+                    headers.append((b"vary", b"Accept-Encoding"))
+                elif b"accept-encoding" not in vary.lower():
+                    headers = [(k, v + b", Accept-Encoding" if k.lower() == b"vary" else v) for k, v in headers]
+                headers = [(k, b"W/" + v if k.lower() == b"etag" and not v.startswith(b"W/") else v)
+                           for k, v in headers]
+                if not more:
+                    data = compressor.finish(body)
+                    headers.append((b"content-length", str(len(data)).encode()))
+                    await send({**start, "headers": headers})
+                    start = None
+                    return await send({"type": "http.response.body", "body": data})
+                await send({**start, "headers": headers})
+                start = None
+            data = compressor.chunk(body) if more else compressor.finish(body)
+            await send({"type": "http.response.body", "body": data, "more_body": more})
+
+        await self.app(scope, receive, send_compressed)
@@ -1,7 +1,13 @@
 # db.py
+import copy
 import os
-from sqlalchemy import create_engine, Column, Integer, Float, String, Date, Boolean, UniqueConstraint
-from sqlalchemy.orm import sessionmaker, declarative_base
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional, Sequence
+from sqlalchemy import event, false, select, update, func, Column, Integer, Float, String, Date, DateTime, Boolean, Text, UniqueConstraint, Index
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, declarative_base
 
 
 # DB_URL = "sqlite:///./app.db"
@@ -20,15 +26,54 @@ if not DATABASE_URL:
     # 先不要默默 fallback，直接讓它爆錯，才不會用到 SQLite 又不知道
     raise RuntimeError("DATABASE_URL is not set. Please configure it on Render!")
 
-print(f"[DB] Using DATABASE_URL = {DATABASE_URL}")  # ← 啟動時會印出來
+def describe_url() -> str:
+    """啟動時印出用（密碼遮掉）；import 時不印、不連線"""
+    return make_url(DATABASE_URL).render_as_string(hide_password=True)
 
-engine = create_engine(
-    DATABASE_URL,
+def to_async_url(url: str):
+    """
+    換成 async driver：Postgres → asyncpg，SQLite → aiosqlite
+    asyncpg 不認得 sslmode 參數，轉成 connect_args["ssl"]
+    回傳 (url, connect_args)
+    """
+    connect_args = {}
+    u = make_url(url)
+    if u.drivername in ("postgres", "postgresql", "postgresql+psycopg2"):
+        u = u.set(drivername="postgresql+asyncpg")
+    elif u.drivername == "sqlite":
+        u = u.set(drivername="sqlite+aiosqlite")
+    if u.drivername == "postgresql+asyncpg" and "sslmode" in u.query:
+        sslmode = u.query["sslmode"]
+        u = u.difference_update_query(["sslmode"])
+        if sslmode != "disable":
+            connect_args["ssl"] = "require" if sslmode in ("require", "prefer", "allow") else sslmode
+    return u.render_as_string(hide_password=False), connect_args
+
+def _pool_options(url: str) -> Dict:
+    # 連線池大小可由環境變數調整（SQLite 不適用）
+    if url.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    }
+
+ASYNC_DATABASE_URL, _connect_args = to_async_url(DATABASE_URL)
+
+engine = create_async_engine(
+    ASYNC_DATABASE_URL,
     pool_pre_ping=True,
-    # 如果你用的是 Postgres，不要放 sqlite 的 connect_args
+    connect_args=_connect_args,
+    **_pool_options(ASYNC_DATABASE_URL),
 )
 
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+class AppSession(Session):
+    """交易內要遞增的版本號記在 info["pending_versions"]，commit 前一次送出，commit 後通知 on_commit 的監聽者"""
+
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, sync_session_class=AppSession,
+                                  autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 class Inventory(Base):
@@ -37,47 +82,346 @@ class Inventory(Base):
     item = Column(String, unique=True, index=True, nullable=False)
     qty = Column(Float, default=0)
     danger_level = Column(Float, default=5.0)  # ⚠️ 新增：危險庫存警戒值
+    version = Column(Integer, nullable=False, default=0, server_default="0")  # 每次寫入 +1（樂觀鎖）
 
 class Leftover(Base):
     __tablename__ = "leftovers"
     id = Column(Integer, primary_key=True)
-    day = Column(Date, index=True, nullable=False)
+    day = Column(Date, nullable=False)
     item = Column(String, nullable=False)
     qty = Column(Float, default=0)
-    __table_args__ = (UniqueConstraint('day', 'item', name='uq_leftovers_day_item'),)
+    prev_qty = Column(Float, nullable=True)          # 上一次 upsert 前的 qty（RETURNING 取回算彙總差額，見 rollups.py）
+    # 區間讀取（GET /leftovers?from=&to=）只掃索引，不回表
+    __table_args__ = (UniqueConstraint('day', 'item', name='uq_leftovers_day_item'),
+                      Index("ix_leftovers_day_item_qty", "day", "item", "qty"))
 
 class DeliveryPlan(Base):
     __tablename__ = "delivery_plans"
     id = Column(Integer, primary_key=True)
-    day = Column(Date, index=True, nullable=False)   # 計畫要「哪一天」的提貨量
+    day = Column(Date, nullable=False)               # 計畫要「哪一天」的提貨量
     item = Column(String, nullable=False)
     planned_qty = Column(Float, default=0)
     confirmed = Column(Boolean, default=False)
-    __table_args__ = (UniqueConstraint('day', 'item', name='uq_plan_day_item'),)
+    weather = Column(String, nullable=True)          # 確認時的天氣（需求模型學習用）
+    prev_delivered = Column(Float, nullable=True)    # 上一次 upsert 前的提貨量（已確認才算；見 rollups.py）
+    # 區間讀取（GET /delivery/plans?from=&to=）只掃索引，不回表
+    __table_args__ = (UniqueConstraint('day', 'item', name='uq_plan_day_item'),
+                      Index("ix_plans_day_item_cover", "day", "item", "confirmed", "planned_qty", "weather"))
 
 class ScheduleTask(Base):
     __tablename__ = "schedule_tasks"
 
     id = Column(Integer, primary_key=True, index=True)
-    weekday = Column(String)      # 星期幾
+    day = Column(Date, nullable=False)   # 哪一天做（排程往後排 SCHEDULE_HORIZON_DAYS 天）
     task = Column(String)         # 工作內容（例如「製作脆丸」）
     item = Column(String)         # 品項
     qty = Column(Float, default=0)
     done = Column(Boolean, default=False)
+    # 區間讀取（GET /schedule?from=&to=）與某天的未完成任務
+    __table_args__ = (Index("ix_schedule_tasks_day_done", "day", "done"),)
+
+class CalendarDay(Base):
+    """工作日曆的例外日（國定假日、臨時休息、補班日）；其他日子照每週規則（見 holidays.py）"""
+    __tablename__ = "calendar_days"
+    day = Column(Date, primary_key=True)
+    date_type = Column(String, nullable=False)   # weekday / holiday / restday
+    name = Column(String, nullable=True)
+
+class MetaVersion(Base):
+    """持久化的版本號（例如排程輸入版本），寫入端 +1，讀取端比對"""
+    __tablename__ = "meta_versions"
+    key = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_on = Column(Date, nullable=True)
+
+class InventoryMovement(Base):
+    """庫存異動帳（只新增不修改）：delta 為要求的加減量，qty_after 為異動後庫存"""
+    __tablename__ = "inventory_movements"
+    id = Column(Integer, primary_key=True)
+    ts = Column(DateTime, nullable=False, index=True)
+    item = Column(String, nullable=False)
+    kind = Column(String, nullable=False)        # delivery / production / stocktake / opening
+    delta = Column(Float, nullable=True)         # stocktake / opening 為直接設定，沒有 delta
+    qty_after = Column(Float, nullable=False)
+    ref = Column(String, nullable=True)          # 來源，例如 delivery:2025-01-01、task:12
+    __table_args__ = (Index("ix_movements_item_id", "item", "id"),)
+
+class InventoryCheckpoint(Base):
+    """庫存快照：套用到 movement_id（含）為止的所有異動後的庫存"""
+    __tablename__ = "inventory_checkpoints"
+    id = Column(Integer, primary_key=True)
+    movement_id = Column(Integer, nullable=False, index=True)
+    as_of = Column(DateTime, nullable=False, index=True)
+    item = Column(String, nullable=False)
+    qty = Column(Float, nullable=False)
+    __table_args__ = (UniqueConstraint("movement_id", "item", name="uq_checkpoint_item"),)
+
+class IdempotencyKey(Base):
+    """重送保護：同一個 Idempotency-Key 只執行一次，之後回傳存下的結果"""
+    __tablename__ = "idempotency_keys"
+    key = Column(String, primary_key=True)
+    endpoint = Column(String, nullable=False)
+    response = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False, index=True)
+
+class DemandStat(Base):
+    """需求模型的充分統計量：每個 (品項, 日期類型, 天氣) 的觀測數 / 總和 / 平方和"""
+    __tablename__ = "demand_stats"
+    id = Column(Integer, primary_key=True)
+    item = Column(String, nullable=False)
+    date_type = Column(String, nullable=False)
+    weather = Column(String, nullable=False, default="")   # "" = 未記錄天氣
+    n = Column(Integer, nullable=False, default=0)
+    total = Column(Float, nullable=False, default=0.0)
+    total_sq = Column(Float, nullable=False, default=0.0)
+    __table_args__ = (UniqueConstraint("item", "date_type", "weather", name="uq_demand_stat_key"),)
+
+class DemandObservation(Base):
+    """已計入統計量的每日需求（提貨 + 前一天剩料 - 當天剩料），資料修正時用來扣回舊值"""
+    __tablename__ = "demand_observations"
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    item = Column(String, nullable=False)
+    date_type = Column(String, nullable=False)
+    weather = Column(String, nullable=False, default="")
+    qty = Column(Float, nullable=False)
+    __table_args__ = (UniqueConstraint("day", "item", name="uq_demand_obs_day_item"),)
+
+class ChangeLog(Base):
+    """
+    變更紀錄（離線同步用）：每個寫入交易一個遞增的 seq，記下寫入後的整列
+    data 為 NULL 表示刪除（墓碑）；key：庫存=item、剩料 / 提貨=day|item、任務=id
+    """
+    __tablename__ = "change_log"
+    id = Column(Integer, primary_key=True)
+    seq = Column(Integer, nullable=False, index=True)
+    table_name = Column(String, nullable=False)
+    key = Column(String, nullable=False)
+    data = Column(Text, nullable=True)
+    ts = Column(DateTime, nullable=False, index=True)
+
+class UsageRollup(Base):
+    """
+    每個品項每日 / 週 / 月的提貨、剩料、備料量（寫入端在同一個交易內加上差額，見 rollups.py）
+    period 為期間的第一天（週：星期一；月：1 號）
+    """
+    __tablename__ = "usage_rollups"
+    id = Column(Integer, primary_key=True)
+    grain = Column(String, nullable=False)      # day / week / month
+    period = Column(Date, nullable=False)
+    item = Column(String, nullable=False)
+    delivered = Column(Float, nullable=False, default=0.0)   # 已確認的提貨量
+    leftover = Column(Float, nullable=False, default=0.0)    # 剩料
+    produced = Column(Float, nullable=False, default=0.0)    # 完成任務的入庫量
+    __table_args__ = (UniqueConstraint("grain", "period", "item", name="uq_rollup_grain_period_item"),
+                      Index("ix_rollups_grain_item_period", "grain", "item", "period"))
+
+class SimulationJob(Base):
+    """模擬工作（POST /simulations）：背景執行，結果存在這裡，哪個 worker 都查得到"""
+    __tablename__ = "simulation_jobs"
+    id = Column(String, primary_key=True)
+    status = Column(String, nullable=False)      # queued / running / done / failed
+    params = Column(Text, nullable=False)
+    result = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False, index=True)
+    finished_at = Column(DateTime, nullable=True)
+
+class SchemaMigration(Base):
+    """已套用的資料庫 migration（見 migrations.py）"""
+    __tablename__ = "schema_migrations"
+    version = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    applied_at = Column(DateTime, nullable=False)
+
+class ProductRule(Base):
+    """
+    品項目錄：每個品項的提貨 / 排程規則，改資料就生效，不用重新部署（見 catalog.py）
+    stocked=False 的是排程用的虛擬品項（腸子、蝦肉丸、脆丸），不建庫存列
+    """
+    __tablename__ = "product_rules"
+    item = Column(String, primary_key=True)
+    position = Column(Integer, nullable=False, default=0)            # 排列順序
+    stocked = Column(Boolean, nullable=False, default=True)
+    base_delivery = Column(Float, nullable=True)                     # 提貨基準量；NULL = 不需提貨
+    delivery_decimals = Column(Integer, nullable=False, default=1)   # 提貨量顯示到小數第幾位
+    delivery_truncate = Column(Boolean, nullable=False, default=False)  # True：捨去而非四捨五入
+    delivery_requires = Column(String, nullable=True)   # 目標日有此標籤的任務才顯示提貨（魚肉 → ball）
+    tags = Column(String, nullable=False, default="")   # 逗號分隔
+    merge_into = Column(String, nullable=True)          # 排程時合併成這個品項（Q腸 → 腸子）
+    restock_item = Column(String, nullable=True)        # 低於危險量時另外排這個品項的任務（魚皮 → 魚肉）
+    light_task = Column(Boolean, nullable=False, default=False)   # 非繁重工作
+    intensity_coeff = Column(Float, nullable=False, default=1.0)
+    task_levels = Column(Text, nullable=True)   # JSON [[最低強度, 工作名稱, 數量], ...]
+    task_yield = Column(Text, nullable=True)    # JSON {品項: 數量}：完成一次的產出；NULL = 自己 × 任務數量
+
+# 排程輸入版本：庫存量 / 危險量 / 剩料 / 任務完成或刪除 時 +1
+SCHEDULE_INPUTS = "schedule_inputs"
+# 上次產生排程時採用的輸入版本與日期
+SCHEDULE_GENERATED = "schedule_generated"
+# 資料庫識別：建立時隨機產生，避免重建資料庫後 ETag 撞號
+DATA_EPOCH = "data_epoch"
+# 需求模型統計量有異動時 +1（其他行程據此重新載入）
+DEMAND_MODEL = "demand_model"
+# 品項目錄有異動時 +1（各行程據此重新編譯規則）
+CATALOG = "catalog"
+# 工作日曆（calendar_days）
+CALENDAR = "calendar"
+# 變更序號：每個有寫入的交易 +1（同一列鎖住到 commit，序號順序 = commit 順序）
+CHANGE_SEQ = "change_seq"
+# 變更紀錄清理到哪個 seq（游標比這個舊的客戶端要整批重抓）
+CHANGE_FLOOR = "change_floor"
+
+def table_key(table: str) -> str:
+    """各資料表的資料版本（寫入端 +1，讀取快取 / ETag 依此判斷）"""
+    return f"table:{table}"
+
+TABLE_KEYS = [table_key(t) for t in ("inventory", "leftovers", "delivery_plans", "schedule_tasks",
+                                            "usage_rollups")]
+
+def bump_version(session, *keys: str) -> None:
+    """
+    本交易要把這些版本號 +1：先記在 session 上，commit 前才一次送出（_stamp，一句 UPDATE ... RETURNING）
+    meta_versions 的列（schedule_inputs、table:* 幾乎每個寫入都會碰到）只在 commit 那一下被鎖住，
+    寫入交易的其他部分可以同時進行，不會一個接一個排隊
+    需要遞增後的值（回應要帶版本）：await stamp_versions(session)
+    """
+    session.info.setdefault("pending_versions", {}).update(dict.fromkeys(keys))
+
+def before_commit(session, fn: Callable[[Session, Dict[str, int]], None]) -> None:
+    """commit 前（版本號遞增之後，同一個交易內）執行 fn(sync_session, 這次遞增後的版本)"""
+    session.info.setdefault("before_commit", []).append(fn)
+
+def _stamp(session) -> Dict[str, int]:
+    """送出 bump_version 累積的版本號（一句 UPDATE ... RETURNING），再執行 before_commit 的動作"""
+    keys = list(session.info.pop("pending_versions", {}))
+    bumped: Dict[str, int] = {}
+    if keys:
+        bumped = dict(session.execute(
+            update(MetaVersion).where(MetaVersion.key.in_(keys))
+            .values(version=MetaVersion.version + 1)
+            .returning(MetaVersion.key, MetaVersion.version)
+            .execution_options(synchronize_session=False)
+        ).all())
+        missing = [key for key in keys if key not in bumped]
+        if missing:
+            session.execute(MetaVersion.__table__.insert(), [{"key": key, "version": 1} for key in missing])
+            bumped.update(dict.fromkeys(missing, 1))
+        session.info.setdefault("versions", {}).update(bumped)
+    for fn in session.info.pop("before_commit", []):
+        fn(session, bumped)
+    return bumped
+
+@event.listens_for(AppSession, "before_commit")
+def _stamp_on_commit(session):
+    # SAVEPOINT 的 commit 也會觸發，只在最外層送
+    if not session.in_nested_transaction():
+        _stamp(session)
+
+async def stamp_versions(session) -> Dict[str, int]:
+    """現在就送出本交易累積的版本號，回傳本交易遞增後的所有版本（之後 commit 不會再遞增一次）"""
+    await session.run_sync(_stamp)
+    return dict(session.info.get("versions", {}))
+
+async def begin_write(session) -> None:
+    """
+    SQLite：pysqlite 到第一句 INSERT / UPDATE / DELETE 才送 BEGIN，
+    在那之前開 SAVEPOINT 的話 RELEASE 會直接 commit；先送一句不改任何列的 UPDATE 把交易開起來
+    """
+    if session.get_bind().dialect.name == "sqlite":
+        await session.execute(update(MetaVersion).where(false()).values(version=MetaVersion.version))
+
+def touch(session, *tables: str) -> None:
+    """標記資料表有異動"""
+    bump_version(session, *(table_key(t) for t in tables))
+
+async def load_versions(session) -> Dict[str, int]:
+    rows = (await session.execute(select(MetaVersion.key, MetaVersion.version))).all()
+    return {key: version for key, version in rows}
+
+_commit_listeners: List[Callable[[Dict[str, int]], None]] = []
+
+def on_commit(fn: Callable[[Dict[str, int]], None]):
+    """註冊 commit 後的版本通知（參數為本交易遞增過的 {key: 新版本}）"""
+    _commit_listeners.append(fn)
+    return fn
+
+def after_commit(session, fn: Callable[[], None]) -> None:
+    """本交易 commit 成功後才執行 fn（rollback 就丟掉），用來更新記憶體狀態"""
+    session.info.setdefault("after_commit", []).append(fn)
+
+@event.listens_for(AppSession, "after_commit")
+def _publish_versions(session):
+    versions = session.info.pop("versions", None)
+    if versions:
+        for fn in _commit_listeners:
+            fn(versions)
+    for fn in session.info.pop("after_commit", []):
+        fn()
+
+@event.listens_for(AppSession, "after_rollback")
+def _drop_versions(session):
+    for key in ("versions", "after_commit", "pending_versions", "before_commit"):
+        session.info.pop(key, None)
+
+@asynccontextmanager
+async def savepoint(session):
+    """
+    交易內的 SAVEPOINT：區塊失敗只退回區塊內的寫入（外層交易繼續）
+    區塊內登記的版本號 / commit 前後的動作 / 變更紀錄（都放在 session.info）一起退回，
+    不會在 commit 時寫入或發出不存在的變更
+    """
+    saved = {key: copy.copy(value) for key, value in session.info.items()}
+    nested = await session.begin_nested()
+    try:
+        yield
+    except BaseException:
+        if nested.is_active:
+            await nested.rollback()
+        session.info.clear()
+        session.info.update(saved)
+        raise
+    await nested.commit()
+
+# =========================================================
+# 批次 upsert（INSERT ... ON CONFLICT DO UPDATE，Postgres / SQLite 皆可）
+# =========================================================
+def dialect_insert(session):
+    name = session.get_bind().dialect.name
+    if name == "postgresql":
+        return postgresql.insert
+    if name == "sqlite":
+        return sqlite.insert
+    raise NotImplementedError(f"bulk upsert not supported on {name}")
+
+def greatest(session, a, b):
+    """兩值取大：Postgres 用 GREATEST，SQLite 用兩參數的 max()"""
+    if session.get_bind().dialect.name == "postgresql":
+        return func.greatest(a, b)
+    return func.max(a, b)
+
+async def bulk_upsert(session, model, rows: List[Dict], conflict_cols: Sequence[str],
+                      update_cols: Optional[Sequence[str]] = None,
+                      set_: Optional[Callable] = None, returning: Sequence = ()):
+    """
+    一次送出整批 upsert（executemany → 由 SQLAlchemy 合併成多列 VALUES）
+      - update_cols：衝突時以新值覆蓋的欄位（預設 rows 內所有非 conflict 欄位）
+      - set_(table, excluded)：自訂衝突時的 SET 運算式（例如 qty = qty - excluded.qty）
+      - returning：要取回的欄位（寫入後的值），有給才回傳 rows
+    """
+    if not rows:
+        return []
+    # 同一批內重複的 key 只留最後一筆（Postgres 不允許同一句 upsert 更新同列兩次）
+    rows = list({tuple(r[c] for c in conflict_cols): r for r in rows}.values())
+    stmt = dialect_insert(session)(model)
+    if set_ is not None:
+        values = set_(model.__table__.c, stmt.excluded)
+    else:
+        cols = update_cols if update_cols is not None else [k for k in rows[0] if k not in conflict_cols]
+        values = {c: stmt.excluded[c] for c in cols}
+    stmt = stmt.on_conflict_do_update(index_elements=list(conflict_cols), set_=values)
+    if returning:
+        return (await session.execute(stmt.returning(*returning), rows)).all()
+    await session.execute(stmt, rows)
+    return []
 
-def init_db(products):
-    Base.metadata.create_all(bind=engine)
-    # seed inventory rows
-    with SessionLocal() as s:
-        # 清理不再需要的舊品項
-        obsolete_items = ["腸子", "蝦肉丸", "脆丸"]
-        for item in obsolete_items:
-            old_item = s.query(Inventory).filter_by(item=item).first()
-            if old_item:
-                s.delete(old_item)
-        
-        # 新增正確的品項
-        for p in products:
-            if not s.query(Inventory).filter_by(item=p).first():
-                s.add(Inventory(item=p, qty=0))
-        s.commit()
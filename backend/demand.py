@@ -0,0 +1,227 @@
+# demand.py
+"""
+需求模型：從歷史資料學每個 (品項, 日期類型, 天氣) 的日需求
+  - 某天需求 = 當天確認的提貨量 + 前一天剩料 - 當天剩料（不得為負）
+  - 資料庫只存充分統計量（n / 總和 / 平方和），確認提貨或寫入剩料時只更新受影響的格子，不重新訓練
+  - 已計入的觀測值另外存一份，資料被修正時先扣回舊值再加新值
+  - 係數放在記憶體，查詢是 O(1) 的 dict 查表
+  - 資料少時往手調常數收斂（收縮估計）：
+      水準 = (K × 平均量 × 日期權重 + Σ 需求 / 天氣權重) / (K + n)     ← 同品項同日期類型、不分天氣
+      係數 = (K × 水準 × 天氣權重 + Σ 需求) / (K + n_天氣)              ← 再細分到天氣
+    完全沒有資料時 = 平均量 × 日期權重 × 天氣權重（與原本的常數相同）
+"""
+import os
+from datetime import date, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, select, tuple_
+
+from db import (DeliveryPlan, DemandObservation, DemandStat, Leftover, MetaVersion, DEMAND_MODEL,
+                after_commit, before_commit, bulk_upsert, bump_version)
+
+# 先驗的份量（相當於幾天的觀測）；越大越相信手調常數
+PRIOR_WEIGHT = float(os.getenv("DEMAND_PRIOR_WEIGHT", "7"))
+# 啟動時補算歷史資料，每批幾天
+BACKFILL_CHUNK_DAYS = 366
+
+Key = Tuple[str, str, str]   # (item, date_type, weather)
+
+
+class DemandModel:
+    def __init__(self, average: Dict[str, float], date_weight: Dict, weather_weight: Dict[str, float],
+                 date_type_of: Callable[[date], object], prior_weight: float = PRIOR_WEIGHT):
+        self.average = average
+        self.date_weight = {_dt(k): v for k, v in date_weight.items()}
+        self.weather_weight = weather_weight
+        self.date_type_of = date_type_of
+        self.prior_weight = prior_weight
+        self.version = -1
+        self._stats: Dict[Key, List[float]] = {}          # key → [n, total, total_sq]
+        self._coef: Dict[Key, float] = {}                 # 算好的係數（查表用）
+
+    def set_average(self, average: Dict[str, float]) -> None:
+        """品項目錄的基準量改了：換先驗、已算好的係數全部作廢"""
+        self.average = average
+        self._coef.clear()
+
+    # ---------- 查詢 ----------
+    def expected(self, item: str, date_type, weather: str) -> float:
+        """(品項, 日期類型, 天氣) 的預期日需求"""
+        key = (item, _dt(date_type), weather)
+        coef = self._coef.get(key)
+        if coef is None:
+            coef = self._coef[key] = self._compute(*key)
+        return coef
+
+    def prior(self, item: str, date_type: str, weather: str) -> float:
+        return (self.average.get(item, 0.0) * self.date_weight.get(date_type, 1.0)
+                * self.weather_weight.get(weather, 1.0))
+
+    def _compute(self, item: str, date_type: str, weather: str) -> float:
+        n_all, norm_total = 0, 0.0
+        for w in [""] + list(self.weather_weight):
+            n, total, _ = self._stats.get((item, date_type, w), (0, 0.0, 0.0))
+            if n:
+                n_all += n
+                norm_total += total / (self.weather_weight.get(w, 1.0) or 1.0)
+        n, total, _ = self._stats.get((item, date_type, weather), (0, 0.0, 0.0))
+        if not n_all:
+            return self.prior(item, date_type, weather)
+        k = self.prior_weight
+        level = (k * self.average.get(item, 0.0) * self.date_weight.get(date_type, 1.0) + norm_total) / (k + n_all)
+        ww = self.weather_weight.get(weather, 1.0)
+        return (k * level * ww + total) / (k + n)
+
+    def describe(self) -> List[Dict]:
+        """各格子的觀測數 / 平均 / 標準差 / 目前係數"""
+        out = []
+        for (item, dt, w), (n, total, total_sq) in sorted(self._stats.items()):
+            if not n:
+                continue
+            mean = total / n
+            var = max(total_sq / n - mean * mean, 0.0)
+            out.append({"item": item, "date_type": dt, "weather": w, "n": int(n),
+                        "mean": round(mean, 3), "std": round(var ** 0.5, 3),
+                        "prior": round(self.prior(item, dt, w), 3),
+                        "coef": round(self.expected(item, dt, w), 3) if w else None})
+        return out
+
+    # ---------- 記憶體狀態 ----------
+    def snapshot(self) -> Dict:
+        """可 pickle 的狀態（模擬器送到其他行程用）"""
+        return {"average": dict(self.average), "stats": {k: list(v) for k, v in self._stats.items()}}
+
+    def restore(self, state: Dict) -> None:
+        self.average = dict(state["average"])
+        self._stats = {tuple(k): list(v) for k, v in state["stats"].items()}
+        self._coef.clear()
+
+    async def load(self, session) -> None:
+        rows = (await session.execute(select(
+            DemandStat.item, DemandStat.date_type, DemandStat.weather,
+            DemandStat.n, DemandStat.total, DemandStat.total_sq))).all()
+        self.version = (await session.scalar(select(MetaVersion.version).where(MetaVersion.key == DEMAND_MODEL))) or 0
+        self._stats = {(item, dt, w or ""): [n, total, total_sq] for item, dt, w, n, total, total_sq in rows}
+        self._coef.clear()
+
+    async def refresh(self, session, version: int) -> None:
+        """別的行程更新過統計量（版本對不上）才重新載入"""
+        if version != self.version:
+            await self.load(session)
+
+    def _apply(self, deltas: Dict[Key, List[float]], version: int) -> None:
+        for key, (dn, dt_, dsq) in deltas.items():
+            cell = self._stats.setdefault(key, [0, 0.0, 0.0])
+            cell[0] += dn
+            cell[1] += dt_
+            cell[2] += dsq
+        # 受影響的 (品項, 日期類型) 係數作廢，下次查詢再算
+        touched = {(item, dt) for item, dt, _ in deltas}
+        for key in [k for k in self._coef if (k[0], k[1]) in touched]:
+            del self._coef[key]
+        # 中間有別的行程的更新就不算跟上，留給 refresh 重新載入
+        if version == self.version + 1:
+            self.version = version
+
+    # ---------- 增量更新 ----------
+    async def observe_days(self, session, days: Iterable[date],
+                           date_type_of: Optional[Callable[[date], object]] = None) -> int:
+        """
+        重新計算這些日子的需求觀測，把差異加進統計量（同一個交易內）
+        提貨確認 → 該日；剩料寫入 → 該日與隔天（隔天的需求用到今天的剩料）
+        date_type_of：日期類型還沒 commit 就要用新的時候給（工作日曆改某天的類型）
+        回傳有變動的觀測數
+        """
+        date_type_of = date_type_of or self.date_type_of
+        days = sorted(set(days))
+        if not days:
+            return 0
+        plans = (await session.execute(
+            select(DeliveryPlan.day, DeliveryPlan.item, DeliveryPlan.planned_qty, DeliveryPlan.weather)
+            .where(DeliveryPlan.day.in_(days), DeliveryPlan.confirmed.is_(True))
+        )).all()
+        lo_days = sorted(set(days) | {d - timedelta(days=1) for d in days})
+        leftovers = {(d, item): qty or 0.0 for d, item, qty in (await session.execute(
+            select(Leftover.day, Leftover.item, Leftover.qty).where(Leftover.day.in_(lo_days))
+        )).all()}
+        old = {(d, item): ((item, dt, w), qty) for d, item, dt, w, qty in (await session.execute(
+            select(DemandObservation.day, DemandObservation.item, DemandObservation.date_type,
+                   DemandObservation.weather, DemandObservation.qty)
+            .where(DemandObservation.day.in_(days))
+        )).all()}
+
+        # 當天有確認提貨、也記了剩料，才算一筆完整的觀測
+        new: Dict[Tuple[date, str], Tuple[Key, float]] = {}
+        for d, item, planned, weather in plans:
+            if (d, item) not in leftovers:
+                continue
+            qty = max((planned or 0.0) + leftovers.get((d - timedelta(days=1), item), 0.0) - leftovers[(d, item)], 0.0)
+            new[(d, item)] = ((item, _dt(date_type_of(d)), weather or ""), round(qty, 4))
+
+        deltas: Dict[Key, List[float]] = {}
+        for obs, sign in ((old, -1), (new, 1)):
+            for day_item, (key, qty) in obs.items():
+                if old.get(day_item) == new.get(day_item):
+                    continue
+                cell = deltas.setdefault(key, [0, 0.0, 0.0])
+                cell[0] += sign
+                cell[1] += sign * qty
+                cell[2] += sign * qty * qty
+        deltas = {k: v for k, v in deltas.items() if any(v)}
+        changed = [k for k in set(old) | set(new) if old.get(k) != new.get(k)]
+        if not changed:
+            return 0
+
+        await bulk_upsert(session, DemandStat,
+                          [{"item": item, "date_type": dt, "weather": w, "n": int(n), "total": total, "total_sq": sq}
+                           for (item, dt, w), (n, total, sq) in deltas.items()],
+                          conflict_cols=["item", "date_type", "weather"],
+                          set_=lambda c, excluded: {"n": c.n + excluded.n, "total": c.total + excluded.total,
+                                                    "total_sq": c.total_sq + excluded.total_sq})
+        gone = [k for k in changed if k not in new]
+        if gone:
+            await session.execute(delete(DemandObservation).where(
+                tuple_(DemandObservation.day, DemandObservation.item).in_(gone)))
+        await bulk_upsert(session, DemandObservation,
+                          [{"day": d, "item": item, "date_type": key[1], "weather": key[2], "qty": qty}
+                           for (d, item), (key, qty) in new.items() if (d, item) in changed],
+                          conflict_cols=["day", "item"])
+        bump_version(session, DEMAND_MODEL)
+        # 版本號 commit 前才遞增：拿到遞增後的值再登記 commit 後套用差異
+        before_commit(session, lambda _, versions: after_commit(
+            session, lambda: self._apply(deltas, versions[DEMAND_MODEL])))
+        return len(changed)
+
+    async def backfill(self, session) -> int:
+        """統計量還是空的（剛升級）就從既有的提貨紀錄補算一次"""
+        if await session.scalar(select(DemandObservation.id).limit(1)) is not None:
+            return 0
+        days = (await session.scalars(
+            select(DeliveryPlan.day).where(DeliveryPlan.confirmed.is_(True)).distinct().order_by(DeliveryPlan.day)
+        )).all()
+        total = 0
+        for k in range(0, len(days), BACKFILL_CHUNK_DAYS):
+            total += await self.observe_days(session, days[k:k + BACKFILL_CHUNK_DAYS])
+        return total
+
+    async def rebuild(self, session) -> int:
+        """歷史資料整批換過（還原 / 大量匯入）：清掉統計量從頭補算，commit 後記憶體重新載入"""
+        await session.execute(delete(DemandStat))
+        await session.execute(delete(DemandObservation))
+        total = await self.backfill(session)
+        bump_version(session, DEMAND_MODEL)
+        after_commit(session, self._invalidate)
+        return total
+
+    def _invalidate(self) -> None:
+        # 記憶體裡是舊的統計量，下次 refresh 一定重新載入
+        self.version = -1
+
+
+def _dt(date_type) -> str:
+    return getattr(date_type, "value", date_type)
+
+
+def affected_by_leftovers(days: Iterable[date]) -> List[date]:
+    """剩料寫入影響的需求日：當天與隔天"""
+    return sorted({d for day in days for d in (day, day + timedelta(days=1))})
@@ -0,0 +1,148 @@
+# events.py
+"""
+變更通知（Server-Sent Events，GET /events）：
+  - 寫入端在交易內 emit()，commit 成功後才真的發出（rollback 就不發）
+  - 事件只帶變動的部分（庫存某幾個品項、某天的剩料、新增 / 修改 / 刪除的任務）
+  - 每個訂閱者一個有上限的佇列；太慢塞滿時丟掉排隊中的事件、改送一個 resync，
+    客戶端收到 resync 再整批重抓（配合 ETag 很便宜），記憶體不會一直長
+  - 定時送 heartbeat（SSE 註解行），讓代理伺服器不要斷線、也讓伺服器發現斷線
+  - 最近的事件留一小段，斷線重連帶 Last-Event-ID 可以補送；接不上就 resync
+事件編號是「本行程」的，格式 <token>:<seq>；行程重啟後 token 不同 → resync
+其他 worker 的事件經由 bus.py 轉進來，在本行程重新編號
+"""
+import asyncio
+import json
+import os
+import secrets
+from collections import deque
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional
+
+from db import after_commit
+
+QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "100"))
+HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT", "15"))
+MAX_SUBSCRIBERS = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", "50"))
+REPLAY_SIZE = 256
+
+# 事件種類
+INVENTORY = "inventory"    # {"items": {item: {"qty"?, "danger_level"?, "version"}}}
+LEFTOVERS = "leftovers"    # {"day": "YYYY-MM-DD", "items": {item: qty}}
+SCHEDULE = "schedule"      # {"upsert": [task, ...]} 或 {"deleted": [id, ...]}
+RESYNC = "resync"          # 事件有漏，請重抓
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+class Subscriber:
+    def __init__(self, types: Optional[Iterable[str]], size: int):
+        self.types = set(types) if types else None
+        self.queue: asyncio.Queue = asyncio.Queue(size)
+        self.dropped = 0
+
+    def offer(self, event: Optional[Dict]) -> None:
+        """不等待地放進佇列；滿了就清空、只留一個 resync（event=None 表示結束）"""
+        if event is not None and self.types is not None and event["type"] not in self.types | {RESYNC}:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.dropped += 1
+            self.queue.put_nowait(event if event is None else {"id": event["id"], "type": RESYNC, "data": {}})
+
+
+class EventHub:
+    def __init__(self, queue_size: int = QUEUE_SIZE, heartbeat: float = HEARTBEAT_SECONDS,
+                 max_subscribers: int = MAX_SUBSCRIBERS):
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self.max_subscribers = max_subscribers
+        self.token = secrets.token_hex(4)
+        self._seq = 0
+        self._subscribers: set = set()
+        self._recent: deque = deque(maxlen=REPLAY_SIZE)
+        self.published = 0
+        # 本行程產生的事件另外交給誰（bus：轉送給其他 worker 的訂閱者）
+        self.forward: Optional[Callable[[str, Dict], None]] = None
+
+    def _event_id(self, seq: int) -> str:
+        return f"{self.token}:{seq}"
+
+    def publish(self, type: str, data: Dict) -> None:
+        self._seq += 1
+        event = {"id": self._event_id(self._seq), "type": type, "data": data}
+        self._recent.append((self._seq, event))
+        self.published += 1
+        for sub in list(self._subscribers):
+            sub.offer(event)
+
+    def subscribe(self, types: Optional[Iterable[str]] = None, last_event_id: Optional[str] = None) -> Subscriber:
+        if len(self._subscribers) >= self.max_subscribers:
+            raise TooManySubscribers()
+        sub = Subscriber(types, self.queue_size)
+        if last_event_id:
+            for event in self._missed(last_event_id):
+                sub.offer(event)
+        self._subscribers.add(sub)
+        return sub
+
+    def _missed(self, last_event_id: str) -> List[Dict]:
+        token, _, seq = last_event_id.partition(":")
+        if token != self.token or not seq.isdigit():
+            return [{"id": self._event_id(self._seq), "type": RESYNC, "data": {}}]
+        seq = int(seq)
+        oldest = self._recent[0][0] if self._recent else self._seq + 1
+        if seq + 1 < oldest:
+            return [{"id": self._event_id(self._seq), "type": RESYNC, "data": {}}]
+        return [event for s, event in self._recent if s > seq]
+
+    def unsubscribe(self, sub: Subscriber) -> None:
+        self._subscribers.discard(sub)
+
+    async def stream(self, sub: Subscriber) -> AsyncIterator[str]:
+        """SSE 文字串流；客戶端斷線時 StreamingResponse 會取消這個 generator"""
+        try:
+            yield f"retry: 3000\n: connected {self._event_id(self._seq)}\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(sub.queue.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if event is None:
+                    return
+                yield format_sse(event)
+        finally:
+            self.unsubscribe(sub)
+
+    def close(self) -> None:
+        """關機：結束所有串流"""
+        for sub in list(self._subscribers):
+            sub.offer(None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "subscribers": len(self._subscribers),
+            "published": self.published,
+            "dropped": sum(sub.dropped for sub in self._subscribers),
+        }
+
+
+def format_sse(event: Dict) -> str:
+    data = json.dumps(event["data"], ensure_ascii=False, separators=(",", ":"), default=str)
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
+
+
+hub = EventHub()
+
+
+def emit(session, type: str, data: Dict) -> None:
+    """交易 commit 成功後才發出事件（本行程的訂閱者 + 轉送給其他 worker）"""
+    def publish():
+        hub.publish(type, data)
+        if hub.forward is not None:
+            hub.forward(type, data)
+    after_commit(session, publish)
@@ -0,0 +1,110 @@
+# holidays.py
+"""
+工作日曆：每一天是 平日 / 假日 / 休息日（提貨基準量、需求模型、排程分配都看這個）
+  - 每週規則：六日假日、週三休息日（原本寫死在 weekday_to_datetype）
+  - calendar_days 表放例外：國定假日、臨時休息、補班日（date_type=weekday），優先於每週規則
+  - 整張表載入記憶體（date → 類型），查某天是 O(1) 的 dict 查表，不碰資料庫
+  - 日曆有異動時 calendar 版本 +1；各行程 refresh 時看到版本不同就重新載入
+  - 第一次 migration 寫入今天起 SEED_YEARS 年的固定日期國定假日；
+    農曆節日（春節、端午、中秋）每年日期不同，用 PUT /calendar/{day} 加
+"""
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, select
+
+from db import CALENDAR, SCHEDULE_INPUTS, CalendarDay, MetaVersion, bump_version, dialect_insert
+from models import DateType
+
+# weekday() → 類型；沒列的是平日
+WEEKLY: Dict[int, DateType] = {
+    5: DateType.holiday,
+    6: DateType.holiday,
+    2: DateType.restday,   # 每週三為 restday
+}
+
+# (月, 日) → 名稱
+FIXED_HOLIDAYS: List[Tuple[Tuple[int, int], str]] = [
+    ((1, 1), "元旦"),
+    ((2, 28), "和平紀念日"),
+    ((4, 4), "兒童節"),
+    ((5, 1), "勞動節"),
+    ((10, 10), "國慶日"),
+]
+SEED_YEARS = 5
+
+
+def weekly_type(d: date) -> DateType:
+    return WEEKLY.get(d.weekday(), DateType.weekday)
+
+
+class HolidayCalendar:
+    def __init__(self):
+        self.version = -1
+        self._days: Dict[date, DateType] = {}
+        self._names: Dict[date, str] = {}
+
+    def date_type(self, d: date) -> DateType:
+        found = self._days.get(d)
+        return found if found is not None else weekly_type(d)
+
+    def describe(self, start: date, end: date) -> List[Dict]:
+        out = []
+        d = start
+        while d <= end:
+            out.append({"day": d.isoformat(), "date_type": self.date_type(d).value,
+                        "name": self._names.get(d), "override": d in self._days})
+            d += timedelta(days=1)
+        return out
+
+    # ---------- 載入 ----------
+    async def load(self, session) -> None:
+        rows = (await session.execute(select(CalendarDay.day, CalendarDay.date_type, CalendarDay.name))).all()
+        self.version = (await session.scalar(select(MetaVersion.version).where(MetaVersion.key == CALENDAR))) or 0
+        self._days = {d: DateType(t) for d, t, _ in rows}
+        self._names = {d: name for d, _, name in rows if name}
+
+    async def refresh(self, session, version: int) -> None:
+        """日曆版本對不上（本行程或別的行程改過）才重新載入"""
+        if version != self.version:
+            await self.load(session)
+
+    def snapshot(self) -> Dict:
+        """可 pickle 的狀態（模擬器送到其他行程用）"""
+        return {"days": {d: t.value for d, t in self._days.items()}}
+
+    def restore(self, state: Dict) -> None:
+        self._days = {d: DateType(t) for d, t in state["days"].items()}
+        self._names = {}
+
+
+holiday_calendar = HolidayCalendar()
+
+
+# =========================================================
+# 資料庫端：預設假日、單日修改
+# =========================================================
+async def seed(session, today: Optional[date] = None) -> None:
+    """今天起 SEED_YEARS 年的固定日期國定假日（已有的日子不動；過去的日子不補，需求統計量不受影響）"""
+    today = today or date.today()
+    rows = [{"day": date(year, month, day), "date_type": DateType.holiday.value, "name": name}
+            for year in range(today.year, today.year + SEED_YEARS)
+            for (month, day), name in FIXED_HOLIDAYS
+            if date(year, month, day) > today]
+    stmt = dialect_insert(session)(CalendarDay).on_conflict_do_nothing(index_elements=["day"])
+    added = (await session.execute(stmt.returning(CalendarDay.day), rows)).all()
+    if added:
+        bump_version(session, CALENDAR, SCHEDULE_INPUTS)
+
+
+async def set_day(session, day: date, date_type: Optional[DateType], name: Optional[str] = None) -> DateType:
+    """設定某天的類型；date_type=None → 刪掉例外，回到每週規則。回傳生效的類型"""
+    if date_type is None:
+        await session.execute(delete(CalendarDay).where(CalendarDay.day == day))
+    else:
+        stmt = dialect_insert(session)(CalendarDay)
+        stmt = stmt.on_conflict_do_update(index_elements=["day"],
+                                          set_={"date_type": stmt.excluded.date_type, "name": stmt.excluded.name})
+        await session.execute(stmt, [{"day": day, "date_type": date_type.value, "name": name}])
+    bump_version(session, CALENDAR, SCHEDULE_INPUTS)
+    return date_type or weekly_type(day)
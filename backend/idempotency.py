@@ -0,0 +1,72 @@
+# idempotency.py
+"""
+Idempotency-Key：手機逾時重送時，回傳第一次的結果而不要再執行一次
+  - begin()：在同一個交易內 INSERT key ... ON CONFLICT DO NOTHING
+      搶到 → 回傳 None，照常執行
+      已存在 → 回傳當初存下的結果（Postgres 上同時送來的第二個請求會等第一個 commit）
+      已過期（超過 KEY_TTL）→ 當作新的 key：刪掉舊列再搶一次
+  - finish()：把結果寫回 key，與業務異動一起 commit
+  - purge_expired()：清掉過期的 key（背景的 checkpoint 迴圈定期呼叫）
+"""
+import json
+from datetime import datetime, timedelta
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import delete
+
+from db import IdempotencyKey, dialect_insert
+
+# 保留多久（超過就可以重用同一個 key）
+KEY_TTL = timedelta(hours=24)
+
+
+async def drop_if_expired(session, row: IdempotencyKey) -> bool:
+    """row 已過期就刪掉（條件式 DELETE，同時兩個請求只有一個刪得到），回傳有沒有刪"""
+    cutoff = datetime.utcnow() - KEY_TTL
+    if row.created_at >= cutoff:
+        return False
+    deleted = (await session.execute(
+        delete(IdempotencyKey)
+        .where(IdempotencyKey.key == row.key, IdempotencyKey.created_at < cutoff)
+        .execution_options(synchronize_session=False)
+    )).rowcount
+    session.expunge(row)
+    return bool(deleted)
+
+
+async def begin(session, key: Optional[str], endpoint: str) -> Optional[dict]:
+    if not key:
+        return None
+    stmt = dialect_insert(session)(IdempotencyKey).values(
+        key=key, endpoint=endpoint, created_at=datetime.utcnow()
+    ).on_conflict_do_nothing(index_elements=["key"])
+    if (await session.execute(stmt)).rowcount:
+        return None
+    row = await session.get(IdempotencyKey, key)
+    if await drop_if_expired(session, row):
+        if (await session.execute(stmt)).rowcount:
+            return None
+        row = await session.get(IdempotencyKey, key)
+    if row.endpoint != endpoint:
+        raise HTTPException(422, "Idempotency-Key 已用於其他請求")
+    if row.response is None:
+        # 理論上只會在 SQLite 上看到：前一個請求還沒寫完
+        raise HTTPException(409, "相同 Idempotency-Key 的請求仍在處理中")
+    response = row.response
+    await session.rollback()
+    return json.loads(response)
+
+
+async def finish(session, key: Optional[str], result: dict) -> None:
+    if not key:
+        return
+    row = await session.get(IdempotencyKey, key)
+    row.response = json.dumps(result, ensure_ascii=False)
+
+
+async def purge_expired(session) -> int:
+    """刪掉過期的 key，回傳刪了幾筆"""
+    return (await session.execute(
+        delete(IdempotencyKey).where(IdempotencyKey.created_at < datetime.utcnow() - KEY_TTL)
+    )).rowcount
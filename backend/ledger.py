@@ -0,0 +1,129 @@
+# ledger.py
+"""
+庫存異動帳：
+  - 每次庫存異動都追加一筆 InventoryMovement（與異動同一個交易）
+  - Inventory 表是「目前庫存」的快照，由寫入端原子更新
+  - 定期產生 InventoryCheckpoint，查某個時間點的庫存 = 最近的快照 + 之後少量異動重播
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import delete, func, select
+
+from db import Inventory, InventoryCheckpoint, InventoryMovement
+
+DELIVERY = "delivery"      # 提貨扣庫存
+PRODUCTION = "production"  # 完成排程任務（備料入庫）
+STOCKTAKE = "stocktake"    # 手動盤點 / 匯入（直接設定數量）
+OPENING = "opening"        # 啟用異動帳時的期初庫存
+
+# 累積多少筆異動才產生新快照
+CHECKPOINT_EVERY = int(os.getenv("LEDGER_CHECKPOINT_EVERY", "500"))
+# 只把這麼久以前的異動納入快照，確保同時進行中的交易都已經 commit
+SETTLE_DELAY = timedelta(seconds=60)
+
+_ABSOLUTE = (STOCKTAKE, OPENING)
+
+
+async def record(session, kind: str, changes: Dict[str, Tuple[Optional[float], float]], ref: Optional[str] = None) -> None:
+    """changes: {item: (delta, qty_after)}；盤點類 delta 為 None"""
+    if not changes:
+        return
+    now = datetime.utcnow()
+    await session.execute(InventoryMovement.__table__.insert(), [
+        {"ts": now, "item": item, "kind": kind, "delta": delta, "qty_after": qty_after, "ref": ref}
+        for item, (delta, qty_after) in changes.items()
+    ])
+
+
+def apply(state: Dict[str, float], movements: Iterable) -> Dict[str, float]:
+    """重播異動：盤點直接設定，其餘 qty = max(qty + delta, 0)"""
+    for m in movements:
+        if m.kind in _ABSOLUTE:
+            state[m.item] = m.qty_after
+        else:
+            state[m.item] = max(state.get(m.item, 0.0) + m.delta, 0.0)
+    return state
+
+
+async def _latest_checkpoint(session, before: Optional[datetime] = None):
+    q = select(func.max(InventoryCheckpoint.movement_id))
+    if before is not None:
+        q = q.where(InventoryCheckpoint.as_of <= before)
+    mid = await session.scalar(q)
+    if mid is None:
+        return 0, {}
+    rows = (await session.execute(
+        select(InventoryCheckpoint.item, InventoryCheckpoint.qty).where(InventoryCheckpoint.movement_id == mid)
+    )).all()
+    return mid, {item: qty for item, qty in rows}
+
+
+async def stock_as_of(session, as_of: datetime) -> Dict[str, float]:
+    mid, state = await _latest_checkpoint(session, as_of)
+    movements = (await session.execute(
+        select(InventoryMovement.item, InventoryMovement.kind, InventoryMovement.delta, InventoryMovement.qty_after)
+        .where(InventoryMovement.id > mid, InventoryMovement.ts <= as_of)
+        .order_by(InventoryMovement.id)
+    )).all()
+    return apply(state, movements)
+
+
+async def checkpoint(session) -> Optional[int]:
+    """
+    前一個快照 + 已穩定的異動 → 新快照（不掃 Inventory，也不在寫入路徑上執行）
+    回傳新快照的 movement_id；異動不足 CHECKPOINT_EVERY 筆則不做
+    """
+    mid, state = await _latest_checkpoint(session)
+    settled = datetime.utcnow() - SETTLE_DELAY
+    upto = await session.scalar(
+        select(func.max(InventoryMovement.id)).where(InventoryMovement.id > mid, InventoryMovement.ts <= settled)
+    )
+    if upto is None or upto - mid < CHECKPOINT_EVERY:
+        return None
+    movements = (await session.execute(
+        select(InventoryMovement.item, InventoryMovement.kind, InventoryMovement.delta,
+               InventoryMovement.qty_after, InventoryMovement.ts)
+        .where(InventoryMovement.id > mid, InventoryMovement.id <= upto)
+        .order_by(InventoryMovement.id)
+    )).all()
+    state = apply(state, movements)
+    as_of = movements[-1].ts
+    await session.execute(InventoryCheckpoint.__table__.insert(), [
+        {"movement_id": upto, "as_of": as_of, "item": item, "qty": qty} for item, qty in state.items()
+    ])
+    return upto
+
+
+async def rebuild_checkpoints(session) -> int:
+    """
+    異動帳整批換過（匯入）：舊快照的 movement_id 對不上新的異動，全部刪掉，每 CHECKPOINT_EVERY 筆重新產生
+    回傳產生了幾個快照
+    """
+    await session.execute(delete(InventoryCheckpoint))
+    settled = datetime.utcnow() - SETTLE_DELAY
+    mid, state, made = 0, {}, 0
+    while True:
+        movements = (await session.execute(
+            select(InventoryMovement.id, InventoryMovement.item, InventoryMovement.kind, InventoryMovement.delta,
+                   InventoryMovement.qty_after, InventoryMovement.ts)
+            .where(InventoryMovement.id > mid, InventoryMovement.ts <= settled)
+            .order_by(InventoryMovement.id).limit(CHECKPOINT_EVERY)
+        )).all()
+        if len(movements) < CHECKPOINT_EVERY:
+            return made
+        state = apply(state, movements)
+        mid = movements[-1].id
+        await session.execute(InventoryCheckpoint.__table__.insert(), [
+            {"movement_id": mid, "as_of": movements[-1].ts, "item": item, "qty": qty} for item, qty in state.items()
+        ])
+        made += 1
+
+
+async def ensure_opening_balance(session) -> None:
+    """異動帳還是空的：把目前庫存記成期初，之後的歷史才重播得出來"""
+    if (await session.execute(select(InventoryMovement.id).limit(1))).first():
+        return
+    rows = (await session.execute(select(Inventory.item, Inventory.qty))).all()
+    await record(session, OPENING, {item: (None, qty or 0.0) for item, qty in rows})
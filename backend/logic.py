@@ -1,20 +1,20 @@
 # logic.py
-from typing import Dict, Tuple
+from typing import Dict, List, Tuple
 from datetime import date
-import httpx
+import numpy as np
 from models import DateType
 from datetime import datetime, timedelta
-from db import ScheduleTask,Inventory,Leftover
-import asyncio
-
-# 門市座標（自行調整）
-STORE_LAT, STORE_LON = 22.989382341539695, 120.20492352698653
-
-#提貨基準量
-AVERAGE_DELIVERY = {
-    "魚肚": 3.0, "魚皮": 2.0, "魚肉": 3.0, "粉蒸": 2.0, "Q腸": 1.0,
-    "豬腸": 1.0, "燕餃": 1.0, "蝦丸": 1.0, "肉丸": 0.5, "肉燥": 0.5, "骨頭": 1.0
-}
+from sqlalchemy import select, update, or_
+from db import ScheduleTask,Leftover,DeliveryPlan,MetaVersion,SCHEDULE_INPUTS,SCHEDULE_GENERATED,CATALOG,CALENDAR,DEMAND_MODEL,touch
+from weather import weather_service
+from demand import DemandModel
+from catalog import catalog
+from holidays import holiday_calendar
+import cache
+import planner
+from metrics import phase
+
+# 提貨基準量、品項係數、各品項的排程 / 顯示規則都在品項目錄（catalog.py / product_rules 表）
 
 DATE_WEIGHT = {
     DateType.weekday: 1.0,
@@ -22,54 +22,32 @@ DATE_WEIGHT = {
     DateType.restday: 0.2,
 }
 
-# 可按實際數據微調(排程用)
-ITEM_COEFF: Dict[str, float] = {
-    "魚肚": 1.2,
-    "魚皮": 1.1,
-    "魚肉": 1.0,
-    "粉蒸": 1.0,
-    "腸子": 0.9,
-    "脆丸": 1.3,
-    "蝦肉丸": 1.1,
-    "肉燥": 1.0,
-}
-
 WEATHER_WEIGHT = {  # 簡化分類
     "sunny": 1.0, "cloudy": 0.95, "rain": 0.8, "storm": 0.6, "typhoon": 0.4
 }
 
 def weekday_to_datetype(d: date) -> DateType:
-    # 六日視為 holiday；可擴充一個 set 放國定假日
-    if d.weekday() >= 5:
-        return DateType.holiday
-    elif d.weekday() == 2:  # 每週三為 restday 
-        return DateType.restday
-    return DateType.weekday 
-
-def map_weather_code_to_label(code: int) -> str:
-    # Open-Meteo weathercode 簡化對應
-    if code in (0,1): return "sunny"
-    if code in (2,3): return "cloudy"
-    if code in (51,53,55,61,63,65,80,81,82): return "rain"
-    if code in (95,96,99): return "storm"
-    return "cloudy"
+    # 工作日曆（記憶體查表）：國定假日 / 補班等例外，其餘照每週規則（六日假日、週三休息日），見 holidays.py
+    return holiday_calendar.date_type(d)
 
 async def fetch_weather_label() -> str:
-    # Open-Meteo：當前天氣
-    url = (f"https://api.open-meteo.com/v1/forecast?latitude={STORE_LAT}"
-           f"&longitude={STORE_LON}&current=weather_code")
-    async with httpx.AsyncClient(timeout=10) as client:
-        r = await client.get(url)
-        r.raise_for_status()
-        code = r.json().get("current", {}).get("weather_code", 2)
-        return map_weather_code_to_label(code)
+    # 走快取（見 weather.py），上游慢或失敗時回傳 fallback
+    return await weather_service.get_label()
+
+# 需求模型：從提貨 / 剩料歷史學出來的係數，沒有資料時等於目錄的基準量 × 權重（見 demand.py）
+demand_model = DemandModel(catalog.base_delivery, DATE_WEIGHT, WEATHER_WEIGHT, weekday_to_datetype)
+catalog.on_reload(lambda c: demand_model.set_average(c.base_delivery))
+
+async def refresh_models(session) -> None:
+    """品項目錄 / 工作日曆 / 需求模型被改過（版本不同）才重新載入"""
+    await catalog.refresh(session, cache.versions.get(CATALOG))
+    await holiday_calendar.refresh(session, cache.versions.get(CALENDAR))
+    await demand_model.refresh(session, cache.versions.get(DEMAND_MODEL))
 
 def calc_base_delivery(date_type: DateType, weather_label: str, safety: float) -> Dict[str, float]:
-    dw = DATE_WEIGHT.get(date_type, 1.0)
-    ww = WEATHER_WEIGHT.get(weather_label, 1.0)
     out: Dict[str, float] = {}
-    for name, avg in AVERAGE_DELIVERY.items():
-        out[name] = round(avg * dw * ww * safety, 2)
+    for name in catalog.delivery_items:
+        out[name] = round(demand_model.expected(name, date_type, weather_label) * safety, 2)
     return out
 
 def apply_leftover_deduction(plan: Dict[str, float], leftovers: Dict[str, float]) -> Dict[str, float]:
@@ -80,45 +58,96 @@ def apply_leftover_deduction(plan: Dict[str, float], leftovers: Dict[str, float]
         out[item] = max(round(qty - ded, 2), 0.0)
     return out
 
-def format_delivery_plan(plan: Dict[str, float], session, target_date: date) -> Dict[str, float]:
+# =========================================================
+# 📈 多日提貨預測（天數 × 品項 矩陣一次算完）
+# =========================================================
+def forecast_delivery_matrix(days: List[date], weather_labels: List[str], leftovers: np.ndarray,
+                             safety: float, items: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    calc_base_delivery + apply_leftover_deduction 的批次版本
+      days / weather_labels：長度 D
+      leftovers：D × I（第 d 列 = 計畫日前一天記錄的剩料）
+      items：I 個品項（欄位順序）
+    回傳 (base, final)，皆為 D × I
+    """
+    # (日期類型, 天氣) 組合最多十幾種，每種查一次模型
+    rows: Dict[Tuple[DateType, str], np.ndarray] = {}
+    expected = np.empty((len(days), len(items)))
+    for i, (d, w) in enumerate(zip(days, weather_labels)):
+        key = (weekday_to_datetype(d), w)
+        if key not in rows:
+            rows[key] = np.array([demand_model.expected(item, key[0], w) for item in items])
+        expected[i] = rows[key]
+    base = np.round(expected * safety, 2)
+    final = np.maximum(np.round(base - leftovers, 2), 0.0)
+    return base, final
+
+async def load_forecast_inputs(session, days: List[date],
+                               items: List[str]) -> Tuple[np.ndarray, Dict[date, Dict[str, float]]]:
+    """
+    一次查出區間內的剩料（各計畫日用前一天的剩料）與已確認的提貨
+    回傳 (leftovers D × I, {day: {item: confirmed_qty}})
     """
-    格式化提貨計畫的顯示邏輯：
-    - 魚肚魚皮粉蒸Q腸豬腸蝦丸肉丸：顯示到小數點第一位
-    - 魚肉：只有隔天做脆丸或蝦肉丸才顯示，並且取整
-    - 肉燥：取整
-    - 脆丸：不需要提貨（從計畫中移除）
+    col = {item: j for j, item in enumerate(items)}
+    row = {d: i for i, d in enumerate(days)}
+    leftovers = np.zeros((len(days), len(items)))
+    rows = (await session.execute(
+        select(Leftover.day, Leftover.item, Leftover.qty)
+        .where(Leftover.day >= days[0] - timedelta(days=1), Leftover.day <= days[-1] - timedelta(days=1))
+    )).all()
+    for day, item, qty in rows:
+        i, j = row.get(day + timedelta(days=1)), col.get(item)
+        if i is not None and j is not None:
+            leftovers[i, j] = qty or 0.0
+    confirmed: Dict[date, Dict[str, float]] = {}
+    plans = (await session.execute(
+        select(DeliveryPlan.day, DeliveryPlan.item, DeliveryPlan.planned_qty)
+        .where(DeliveryPlan.day >= days[0], DeliveryPlan.day <= days[-1], DeliveryPlan.confirmed.is_(True))
+    )).all()
+    for day, item, qty in plans:
+        confirmed.setdefault(day, {})[item] = qty
+    return leftovers, confirmed
+
+async def forecast_range(session, days: List[date], weather: Dict[date, str], safety: float) -> Dict:
     """
-    from datetime import timedelta
-    from db import ScheduleTask
-    
-    # 檢查目標日期是否有脆丸或蝦肉丸的排程任務
-    target_weekday = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"][target_date.weekday()]
-    
-    # 查詢目標日期的排程任務
-    tasks = session.query(ScheduleTask).filter_by(weekday=target_weekday, done=False).all()
-    has_crispy_ball_task = any("脆丸" in (task.task or "") for task in tasks)
-    has_shrimp_ball_task = any("蝦肉丸" in (task.task or "") or "蝦丸" in (task.task or "") or "肉丸" in (task.task or "") for task in tasks)
-    
+    區間提貨預測（欄式輸出：days × items）
+    已確認提貨的日子，final 改用確認量
+    """
+    labels = [weather[d] for d in days]
+    items = catalog.delivery_items   # 中途目錄重新載入也不影響這次的欄位
+    with phase("forecast_load"):
+        leftovers, confirmed = await load_forecast_inputs(session, days, items)
+    with phase("forecast_compute"):
+        base, final = forecast_delivery_matrix(days, labels, leftovers, safety, items)
+    for i, d in enumerate(days):
+        if d in confirmed:
+            final[i, :] = [confirmed[d].get(item, 0.0) for item in items]
+    return {
+        "items": items,
+        "days": [d.isoformat() for d in days],
+        "date_type": [weekday_to_datetype(d).value for d in days],
+        "weather": labels,
+        "confirmed": [d in confirmed for d in days],
+        "base": base.tolist(),
+        "leftovers": leftovers.tolist(),
+        "final": final.tolist(),
+    }
+
+async def format_delivery_plan(plan: Dict[str, float], session, target_date: date) -> Dict[str, float]:
+    """
+    格式化提貨計畫的顯示邏輯（規則在品項目錄）：
+    - 大部分品項顯示到小數點第一位
+    - 魚肉：只有目標日做脆丸或蝦肉丸（ball 標籤）才顯示，並且取整
+    - 脆丸：不需要提貨（沒有提貨基準量），從計畫中移除
+    """
+    # 目標日期的未完成任務品項（走快取索引）
+    task_items = await planner.open_task_index.items_on(session, target_date)
+
     formatted_plan = {}
-    
     for item, qty in plan.items():
-        # 脆丸不需要提貨
-        if item == "脆丸":
-            continue
-            
-        # 魚肉：只有隔天做脆丸或蝦肉丸才顯示，並且取整
-        elif item == "魚肉":
-            if has_crispy_ball_task or has_shrimp_ball_task:
-                formatted_plan[item] = float(int(qty))  # 取整
-        
-        # 肉燥：顯示到小數點第一位
-        elif item == "肉燥":
-            formatted_plan[item] = round(qty, 1)
-        
-        # 其他項目（魚肚魚皮粉蒸Q腸豬腸蝦丸肉丸）：顯示到小數點第一位
-        else:
-            formatted_plan[item] = round(qty, 1)
-    
+        shown = catalog.delivery_qty(item, qty, task_items)
+        if shown is not None:
+            formatted_plan[item] = shown
     return formatted_plan
 
 def compute_intensity(
@@ -142,62 +171,44 @@ def compute_intensity(
         DateType.holiday: 1.2,
         DateType.restday: 0.8,
     }
-    item_coeff = ITEM_COEFF.get(item, 1.0)
+    item_coeff = catalog.intensity_coeff(item)
 
     return min(basic_int * weather_map.get(weather_label, 1.0) * date_map.get(date_type, 1.0) * item_coeff, 1.0)
 
 def calculate_qty_plan(item: str, intensity: float) -> Tuple[str, float]:
     """
-    回傳 (顯示用工作名稱, 數量)
-    ——依你的規則：
-      魚肚:一次3/4/5/6(強度高選大),魚皮:4,粉蒸:8
+    回傳 (顯示用工作名稱, 數量)，依品項目錄的強度門檻（task_levels）：
+      魚肚:一次3/4/5/6(強度高選大),粉蒸:8,肉燥:8,剝魚肉:1
       脆丸:7/8/9包魚肉 → 4.5/5/5.5(名稱:脆丸7/8/9)
-      腸子、蝦肉丸:數量由前端/現場決定(0)
-      肉燥:8
+      腸子、蝦肉丸:數量由前端/現場決定(0)；成員品項沿用合併群組的規則
     """
-    if item == "魚肚":
-        # 用強度把 3~6 映射出來（你也可以改成離散規則）
-        if intensity >= 0.85:
-            return ("魚肚", 6.0)
-        elif intensity >= 0.65:
-            return ("魚肚", 5.0)
-        elif intensity >= 0.45:
-            return ("魚肚", 4.0)
-        else:
-            return ("魚肚", 3.0)
-
-    # 魚皮不再獨立排程，當魚皮不夠時排剝魚肉工作
-
-    if item == "魚肉":
-        return ("剝魚肉", 1.0)  # 剝一次產出 3包魚肉 + 4包魚皮
-
-    if item == "粉蒸":
-        return ("粉蒸", 8.0)
-
-    if item == "脆丸":
-        # 強度高 → 做9，次高 → 8，否則7
-        if intensity >= 0.8:
-            return ("脆丸9", 5.5)
-        elif intensity >= 0.5:
-            return ("脆丸8", 5.0)
-        else:
-            return ("脆丸7", 4.5)
-
-    if item in ("Q腸", "豬腸", "腸子"):
-        return ("腸子", 0.0)
-
-    if item in ("蝦丸", "肉丸", "蝦肉丸"):
-        return ("蝦肉丸", 0.0)
-
-    if item == "肉燥":
-        return ("肉燥", 8.0)
-
-    # fallback
-    return (item, 0.0)
+    return catalog.task_for(item, intensity)
 # =========================================================
 # 🧮 自動排程邏輯
 # =========================================================
-def generate_schedule(session):
+def plan_tasks(ctx: "planner.PlanningContext", base_plan: Dict[str, float], weather_label: str,
+               date_type: DateType, K: float = 5.0) -> List[Dict]:
+    """
+    排程的純計算部分（不碰資料庫；模擬器 simulate.py 也用這個）：
+    低於危險量的品項 → intensity → 工作數量 → 分配到 ctx.today 之後的 planner.HORIZON_DAYS 天
+    """
+    requests: List[planner.TaskRequest] = []
+    for item in planner.low_items(ctx):
+        intensity = compute_intensity(
+            next_day_plan_qty=planner.combined(base_plan, item),
+            today_leftover_qty=planner.combined(ctx.leftovers, item),
+            weather_label=weather_label,
+            date_type=date_type,
+            item=item,
+            K=K,
+        )
+        task_name, qty = calculate_qty_plan(item, intensity)
+        requests.append(planner.TaskRequest(item=item, task=f"製作 {task_name}", qty=qty))
+    days = [(d, weekday_to_datetype(d))
+            for d in (ctx.today + timedelta(days=i) for i in range(1, planner.HORIZON_DAYS + 1))]
+    return planner.allocate(requests, ctx.open_tasks, days)
+
+async def generate_schedule(session):
     """
     自動排程：
       - 掃描：哪些品項庫存 < 危險量
@@ -207,100 +218,59 @@ def generate_schedule(session):
       - 避開假日/休息日 + 避免同日>1件
       - 已有未完成同品項任務 → 視為鎖住，不重複建
     """
-    WEEKDAYS_EN = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
     today = datetime.today()
     # 1) 決定隔日的 date_type & 天氣
     tomorrow = today.date() + timedelta(days=1)
     dt = weekday_to_datetype(tomorrow)              # DateType
-    weather_label = asyncio.run(fetch_weather_label()) if callable(fetch_weather_label) else "晴"
+    weather_label = weather_service.peek_label()    # 同步路徑不等網路，過期時背景更新
 
     # 2) 計算隔日提貨「基準計畫」（用你既有函式）
-    base_plan: Dict[str, float] = calc_base_delivery(dt, weather_label, 1.0)
-
-    # 3) 當日剩料（用今天）
-    todays_leftovers = {r.item: r.qty for r in session.query(Leftover).filter_by(day=today.date()).all()}
-
-    # 4) 盤點庫存、找出低於危險量的品項
-    inventories = session.query(Inventory).all()
-    low_items = [inv.item for inv in inventories if inv.qty < inv.danger_level]
-
-    # 5) 特殊邏輯：當魚皮低於危險量時，也新增魚肉任務
-    fish_skin_inv = next((inv for inv in inventories if inv.item == "魚皮"), None)
-    if fish_skin_inv and fish_skin_inv.qty < fish_skin_inv.danger_level:
-        if "魚肉" not in low_items:
-            low_items.append("魚肉")
+    with phase("base_plan"):
+        base_plan: Dict[str, float] = calc_base_delivery(dt, weather_label, 1.0)
 
-    # 6) 合併：腸子 / 蝦肉丸
-    if any(x in low_items for x in ("Q腸", "豬腸")):
-        low_items = [x for x in low_items if x not in ("Q腸", "豬腸")]
-        low_items.append("腸子")
-    if any(x in low_items for x in ("蝦丸", "肉丸")):
-        low_items = [x for x in low_items if x not in ("蝦丸", "肉丸")]
-        low_items.append("蝦肉丸")
+    # 3) 庫存 / 當日剩料 / 未完成任務：各查一次
+    with phase("schedule_load"):
+        ctx = await planner.load_context(session, today.date())
 
-    # 7) 取出目前未完成任務（鎖住，不重建）
-    locked_items = set(t.item for t in session.query(ScheduleTask).filter_by(done=False).all())
+    # 4) 低於危險量的品項 → 依 intensity 決定每項工作的數量，
+    #    再在記憶體裡分配日子（未來 planner.HORIZON_DAYS 天）
+    with phase("schedule_allocate"):
+        rows = plan_tasks(ctx, base_plan, weather_label, dt)
 
-    # 8) 逐項建立任務
-    for item in low_items:
-        if item in locked_items:
-            continue
+    # 5) 一次寫入
+    with phase("schedule_insert"):
+        created = await planner.insert_tasks(session, rows)
 
-        # 7-1) 取得「隔日提貨量」與「當日剩料量」→ 計算 intensity
-        # 對合併項目做對應
-        if item == "腸子":
-            # 取 Q腸/豬腸的合計當作參考
-            base_qty = (base_plan.get("Q腸", 0.0) or 0.0) + (base_plan.get("豬腸", 0.0) or 0.0)
-            leftover_qty = (todays_leftovers.get("Q腸", 0.0) or 0.0) + (todays_leftovers.get("豬腸", 0.0) or 0.0)
-        elif item == "蝦肉丸":
-            base_qty = (base_plan.get("蝦丸", 0.0) or 0.0) + (base_plan.get("肉丸", 0.0) or 0.0)
-            leftover_qty = (todays_leftovers.get("蝦丸", 0.0) or 0.0) + (todays_leftovers.get("肉丸", 0.0) or 0.0)
-        else:
-            base_qty = base_plan.get(item, 0.0) or 0.0
-            leftover_qty = todays_leftovers.get(item, 0.0) or 0.0
+    if created:
+        touch(session, ScheduleTask.__tablename__)
+    await session.commit()
 
-        intensity = compute_intensity(
-            next_day_plan_qty=base_qty,
-            today_leftover_qty=leftover_qty,
-            weather_label=weather_label,
-            date_type=dt,
-            item=item,
-        )
-
-        # 7-2) 用 intensity 決定離散數量 & 顯示名稱
-        task_name, qty = calculate_qty_plan(item, intensity)
-
-        # 7-3) 幫它找一個合適天（避假日/休息日、避免同日多個非繁重工作）
-        # 定義非繁重工作：魚肚、魚肉 (剝魚肉)
-        light_tasks = ["魚肚", "魚肉"]
-        is_light_task = item in light_tasks
-        
-        for i in range(1, 8):
-            d = today + timedelta(days=i)
-            day_dt = weekday_to_datetype(d.date())
-            if day_dt in (DateType.holiday, DateType.restday):
-                continue
-
-            wd = WEEKDAYS_EN[d.weekday()]
-            existed_tasks = session.query(ScheduleTask).filter_by(weekday=wd, done=False).all()
-            
-            # 如果是非繁重工作，檢查該天是否已有任何工作
-            if is_light_task and existed_tasks:
-                continue
-                
-            # 如果是繁重工作，檢查該天是否已有其他繁重工作
-            if not is_light_task:
-                existing_heavy_tasks = [t for t in existed_tasks if t.item not in light_tasks]
-                if existing_heavy_tasks:
-                    continue
-
-            session.add(ScheduleTask(
-                weekday=wd,
-                task=f"製作 {task_name}",
-                item=item,
-                qty=qty,
-                done=False
-            ))
-            break
-
-    session.commit()
\ No newline at end of file
+async def ensure_schedule(session) -> bool:
+    """
+    只有在排程輸入改變（版本號不同）或跨日時才重新產生排程。
+    用條件式 UPDATE 搶下「這次由我產生」，多個請求同時進來也只會產生一次。
+    回傳是否有重新產生。
+    """
+    today = date.today()
+    await refresh_models(session)
+    inputs_version = await select_version(session, SCHEDULE_INPUTS)
+    claimed = (await session.execute(
+        update(MetaVersion)
+        .where(MetaVersion.key == SCHEDULE_GENERATED)
+        .where(or_(
+            MetaVersion.version != inputs_version,
+            MetaVersion.updated_on.is_(None),
+            MetaVersion.updated_on != today,
+        ))
+        .values(version=inputs_version, updated_on=today)
+    )).rowcount
+    if not claimed:
+        await session.rollback()
+        return False
+    await generate_schedule(session)  # 與上面的 UPDATE 一起 commit
+    return True
+
+
+async def select_version(session, key: str) -> int:
+    row = await session.get(MetaVersion, key)
+    return row.version if row else 0
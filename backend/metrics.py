@@ -0,0 +1,255 @@
+# metrics.py
+"""
+觀測：
+  - 每個請求的 SQL 句數 / DB 時間（engine 事件），各階段耗時（phase）
+    → 回應標頭 Server-Timing（瀏覽器 DevTools 可直接看）
+  - /metrics：Prometheus 文字格式（請求延遲直方圖、SQL、連線池等待、快取命中、背景工作失敗次數）
+不另外裝 prometheus_client，格式自己輸出
+"""
+import contextvars
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# =========================================================
+# 請求內的統計（contextvar，async 任務各自一份）
+# =========================================================
+class RequestStats:
+    __slots__ = ("statements", "db_time", "phases")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+        self.phases: Dict[str, float] = {}
+
+    def server_timing(self, total: float) -> str:
+        parts = [f'db;dur={self.db_time * 1000:.1f};desc="{self.statements} queries"']
+        parts += [f"{name};dur={dur * 1000:.1f}" for name, dur in self.phases.items()]
+        parts.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_current: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("request_stats", default=None)
+
+
+def current() -> Optional[RequestStats]:
+    return _current.get()
+
+
+@contextmanager
+def phase(name: str):
+    """量一段程式的耗時，記到目前請求的 Server-Timing 與 app_phase_seconds"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dur = time.perf_counter() - t0
+        stats = _current.get()
+        if stats is not None:
+            stats.phases[name] = stats.phases.get(name, 0.0) + dur
+        PHASE_SECONDS.observe(dur, phase=name)
+
+
+# =========================================================
+# Prometheus 指標（只做用得到的 counter / gauge / histogram）
+# =========================================================
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in sorted(self._values.items())]
+        return out
+
+
+class Gauge:
+    """
+    取值時才呼叫 fn（例如連線池目前借出幾條），回傳 {labels tuple: value}
+    kind="counter"：值本身是別處累計的次數（例如快取命中數）
+    """
+
+    def __init__(self, name: str, help: str, fn: Callable[[], Dict[Tuple[str, ...], float]],
+                 labels: Iterable[str] = (), kind: str = "gauge"):
+        self.name, self.help, self.fn, self.labels, self.kind = name, help, fn, tuple(labels), kind
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        out += [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in sorted(self.fn().items())]
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], list] = {}   # key → [各 bucket 次數..., +Inf 次數, sum]
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = 'le="%s"' % ("+Inf" if bound == float("inf") else repr(bound))
+                out.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}")
+            out.append(f"{self.name}_sum{_labels(self.labels, key)} {series[-1]}")
+            out.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return out
+
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "HTTP request latency",
+                            ["method", "route", "status"])
+REQUEST_STATEMENTS = Histogram("http_request_sql_statements", "SQL statements per request",
+                               ["method", "route"], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34))
+REQUEST_DB_SECONDS = Histogram("http_request_db_seconds", "Time spent in the database per request",
+                               ["method", "route"])
+PHASE_SECONDS = Histogram("app_phase_seconds", "Planning / computation phase latency", ["phase"])
+SQL_STATEMENTS = Counter("db_statements_total", "SQL statements executed")
+POOL_WAIT_SECONDS = Histogram("db_pool_checkout_wait_seconds", "Time waiting to check out a pooled connection",
+                              buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0))
+
+# 背景工作的失敗（寫 log 之外也計數，才看得出持續在失敗）
+BUS_ERRORS = Counter("bus_errors_total", "Invalidation bus failures", ["op"])            # send / poll / reconnect / reconcile
+BACKGROUND_ERRORS = Counter("background_errors_total", "Background task failures", ["task"])  # checkpoint / warm_up / simulation
+
+_registry: List = [REQUEST_SECONDS, REQUEST_STATEMENTS, REQUEST_DB_SECONDS, PHASE_SECONDS,
+                   SQL_STATEMENTS, POOL_WAIT_SECONDS, BUS_ERRORS, BACKGROUND_ERRORS]
+
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for metric in _registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# =========================================================
+# SQLAlchemy：SQL 計數 / DB 時間 / 連線池等待
+# =========================================================
+def instrument_engine(engine) -> None:
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("query_start")
+        dur = time.perf_counter() - starts.pop() if starts else 0.0
+        SQL_STATEMENTS.inc()
+        stats = _current.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.db_time += dur
+
+    # 連線池沒有「開始借」的事件：包住 pool.connect 量等待時間
+    pool = sync_engine.pool
+    connect = pool.connect
+
+    def timed_connect():
+        t0 = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            POOL_WAIT_SECONDS.observe(time.perf_counter() - t0)
+
+    pool.connect = timed_connect
+
+    def pool_state() -> Dict[Tuple[str, ...], float]:
+        state = {}
+        for name in ("size", "checkedout", "overflow"):
+            fn = getattr(sync_engine.pool, name, None)
+            if callable(fn):
+                state[(name,)] = float(fn())
+        return state
+
+    register(Gauge("db_pool_connections", "Connection pool state", pool_state, ["state"]))
+
+
+# =========================================================
+# ASGI middleware
+# =========================================================
+class MetricsMiddleware:
+    """每個 HTTP 請求：建立 RequestStats，回應加 Server-Timing，結束時記直方圖"""
+
+    def __init__(self, app):
+        self.app = app
+        self._routes: Dict[object, str] = {}
+
+    def _route_of(self, scope) -> str:
+        # 用路由樣板（/schedule/move/{task_id}）當標籤，避免每個 id 一條時間序列
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        path = self._routes.get(endpoint)
+        if path is None:
+            app = scope.get("app")
+            for route in getattr(app, "routes", []):
+                if getattr(route, "endpoint", None) is endpoint:
+                    path = route.path
+                    break
+            path = self._routes[endpoint] = path or "unmatched"
+        return path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats()
+        token = _current.set(stats)
+        t0 = time.perf_counter()
+        status = [500]
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", stats.server_timing(time.perf_counter() - t0).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            route = self._route_of(scope)
+            method = scope.get("method", "")
+            REQUEST_SECONDS.observe(time.perf_counter() - t0, method=method, route=route, status=status[0])
+            REQUEST_STATEMENTS.observe(stats.statements, method=method, route=route)
+            REQUEST_DB_SECONDS.observe(stats.db_time, method=method, route=route)
@@ -0,0 +1,186 @@
+# migrations.py
+"""
+資料庫 migration：有編號、只跑一次、多個 worker 同時啟動也只有一個在跑
+  - schema_migrations 記錄已套用的版本
+  - 先用一句查詢看是不是最新（大部分的啟動只花這一句）
+  - 不是最新才拿鎖：Postgres 用 advisory lock；SQLite 用寫入鎖（一次只有一個寫入交易）
+    拿到鎖後再讀一次版本，別的 worker 剛做完就直接結束
+  - 全部步驟在同一個交易裡，失敗就整批 rollback，下次啟動重來
+新增資料表 / 欄位：在 MIGRATIONS 後面加一筆 (版本, 名稱, sync_schema)
+"""
+import random
+from datetime import date, datetime, timedelta
+from typing import Awaitable, Callable, List, Tuple
+
+from sqlalchemy import Date, String, column, delete, func, inspect, select, table, text, update
+from sqlalchemy.exc import DBAPIError
+
+from db import (Base, DeliveryPlan, Leftover, MetaVersion, ScheduleTask, SchemaMigration, SessionLocal, CALENDAR,
+                CATALOG, DATA_EPOCH, DEMAND_MODEL, SCHEDULE_GENERATED, SCHEDULE_INPUTS, TABLE_KEYS, CHANGE_FLOOR,
+                CHANGE_SEQ, dialect_insert)
+from planner import WEEKDAYS_EN
+import catalog
+import holidays
+import ledger
+import rollups
+from logic import demand_model
+
+# pg_advisory_xact_lock 的 key（任意固定值，同一個資料庫的 worker 共用）
+LOCK_ID = 74_170_017
+
+
+# =========================================================
+# 步驟
+# =========================================================
+def _add_missing_columns(conn):
+    """create_all 不會幫舊表加欄位：有 server_default 或可為 NULL 的新欄位在這裡補上"""
+    insp = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not insp.has_table(table.name):
+            continue
+        existing = {c["name"] for c in insp.get_columns(table.name)}
+        for col in table.columns:
+            if col.name in existing or (col.server_default is None and not col.nullable):
+                continue
+            col_type = col.type.compile(dialect=conn.dialect)
+            if col.server_default is None:
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col_type}"))
+                continue
+            not_null = "" if col.nullable else " NOT NULL"
+            conn.execute(text(
+                f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col_type}{not_null} "
+                f"DEFAULT {col.server_default.arg}"
+            ))
+
+
+async def sync_schema(session) -> None:
+    """建立缺少的表 / 索引，補上新欄位（可重複執行）"""
+    def run(sync_session):
+        conn = sync_session.connection()
+        Base.metadata.create_all(conn)
+        _add_missing_columns(conn)
+    await session.run_sync(run)
+
+
+async def seed_versions(session) -> None:
+    rows = [{"key": key, "version": 0}
+            for key in (SCHEDULE_INPUTS, SCHEDULE_GENERATED, DEMAND_MODEL, CATALOG, CALENDAR, CHANGE_SEQ,
+                        CHANGE_FLOOR, *TABLE_KEYS)]
+    rows.append({"key": DATA_EPOCH, "version": random.randint(1, 2**31 - 1)})
+    stmt = dialect_insert(session)(MetaVersion).on_conflict_do_nothing(index_elements=["key"])
+    await session.execute(stmt, rows)
+
+
+async def backfill_demand(session) -> None:
+    await demand_model.backfill(session)
+
+
+async def add_change_log(session) -> None:
+    await sync_schema(session)
+    await seed_versions(session)
+
+
+async def add_usage_rollups(session) -> None:
+    await sync_schema(session)
+    await seed_versions(session)
+    await rollups.rebuild(session)
+
+
+async def add_range_indexes(session) -> None:
+    """剩料 / 提貨計畫的覆蓋索引；取代原本只有 day 的單欄索引"""
+    def run(sync_session):
+        conn = sync_session.connection()
+        for table in (Leftover.__table__, DeliveryPlan.__table__):
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        for name in ("ix_leftovers_day", "ix_delivery_plans_day"):
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    await session.run_sync(run)
+
+
+async def date_schedule_tasks(session) -> None:
+    """
+    schedule_tasks.weekday（星期幾字串）換成 day（日期）：舊任務排到今天起最近的那個星期幾
+    加 (day, done) 索引；工作日曆表與預設國定假日
+    """
+    today = date.today()
+    legacy = table("schedule_tasks", column("weekday", String), column("day", Date))
+
+    def run(sync_session):
+        conn = sync_session.connection()
+        columns = {c["name"] for c in inspect(conn).get_columns("schedule_tasks")}
+        if "day" not in columns:
+            conn.execute(text(f"ALTER TABLE schedule_tasks ADD COLUMN day {Date().compile(dialect=conn.dialect)}"))
+        if "weekday" in columns:
+            for i, name in enumerate(WEEKDAYS_EN):
+                day = today + timedelta(days=(i - today.weekday()) % 7)
+                conn.execute(update(legacy).where(legacy.c.weekday == name).values(day=day))
+            conn.execute(update(legacy).where(legacy.c.day.is_(None)).values(day=today))
+            conn.execute(text("ALTER TABLE schedule_tasks DROP COLUMN weekday"))
+        for index in ScheduleTask.__table__.indexes:
+            index.create(conn, checkfirst=True)
+    await sync_schema(session)
+    await session.run_sync(run)
+    await seed_versions(session)
+    await holidays.seed(session)
+
+
+Step = Tuple[int, str, Callable[[object], Awaitable[None]]]
+
+MIGRATIONS: List[Step] = [
+    (1, "schema", sync_schema),
+    (2, "version keys", seed_versions),
+    (3, "product catalog", catalog.seed),
+    (4, "inventory opening balance", ledger.ensure_opening_balance),
+    (5, "demand statistics backfill", backfill_demand),
+    (6, "change log", add_change_log),
+    (7, "usage rollups", add_usage_rollups),
+    (8, "range indexes", add_range_indexes),
+    (9, "simulation jobs", sync_schema),
+    (10, "dated schedule tasks", date_schedule_tasks),
+    (11, "rollup previous values", sync_schema),
+]
+
+LATEST = MIGRATIONS[-1][0]
+
+
+# =========================================================
+# 執行
+# =========================================================
+async def current_version(session) -> int:
+    try:
+        return (await session.scalar(select(func.max(SchemaMigration.version)))) or 0
+    except DBAPIError:
+        # 全新的資料庫：還沒有 schema_migrations
+        await session.rollback()
+        return 0
+
+
+async def _lock(session) -> None:
+    if session.get_bind().dialect.name == "postgresql":
+        await session.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": LOCK_ID})
+        await session.run_sync(lambda s: SchemaMigration.__table__.create(s.connection(), checkfirst=True))
+    else:
+        await session.run_sync(lambda s: SchemaMigration.__table__.create(s.connection(), checkfirst=True))
+        # 空的 DELETE 也會拿到 SQLite 的寫入鎖，直到這個交易結束
+        await session.execute(delete(SchemaMigration).where(SchemaMigration.version < 0))
+
+
+async def migrate() -> List[str]:
+    """套用尚未執行的 migration，回傳這次套用的名稱（已是最新則為空）"""
+    async with SessionLocal() as s:
+        if await current_version(s) >= LATEST:
+            return []
+    async with SessionLocal() as s:
+        await _lock(s)
+        done = await current_version(s)
+        applied = []
+        for version, name, step in MIGRATIONS:
+            if version <= done:
+                continue
+            await step(s)
+            await s.flush()
+            s.add(SchemaMigration(version=version, name=name, applied_at=datetime.utcnow()))
+            applied.append(name)
+        await s.commit()
+    return applied
@@ -1,7 +1,7 @@
 # models.py
 from enum import Enum
-from typing import Dict, List , Optional
-from pydantic import BaseModel
+from typing import Any, Dict, List, Literal, Optional, Tuple
+from pydantic import BaseModel, Field, RootModel
 from datetime import date
 
 # 日期類型（平日/假日/休息日）
@@ -10,14 +10,14 @@ class DateType(str, Enum):
     holiday = "holiday"  # 假日
     restday = "restday"  # 休息日
 
-# 商品列表（固定排列順序）
-PRODUCTS: List[str] = ["魚肚", "魚皮", "Q腸", "粉蒸", "燕餃", "豬腸", "肉燥", "魚肉", "蝦丸", "肉丸", "骨頭"]
+# 商品列表與各品項規則在品項目錄（catalog.py / product_rules 表），改資料即可新增品項
 
 # =========================================================
 # ✅ Pydantic 模型區（FastAPI 使用）
 # =========================================================   
 class InventoryUpdate(BaseModel):
     updates: Dict[str, float]
+    expected_versions: Optional[Dict[str, int]] = None  # 樂觀鎖：與目前版本不同則 409
 
 class LeftoverUpsert(BaseModel):
     day: date
@@ -31,9 +31,123 @@ class DeliveryRequest(BaseModel):
 class ConfirmDelivery(BaseModel):
     day: date
     items: Dict[str, float]  # 最終確認的提貨量
+    weather: Optional[str] = None   # 當天天氣（需求模型用）；若空則由後端查預報
 
 class MoveTaskRequest(BaseModel):
-    new_weekday: str
+    new_day: Optional[date] = None
+    new_weekday: Optional[str] = None   # 舊版前端：移到今天起最近的那個星期幾
+
+class CalendarDayIn(BaseModel):
+    date_type: DateType
+    name: Optional[str] = None          # 例如「春節」「補班」
 
 class UpdateTaskQtyRequest(BaseModel):
     new_qty: float
+
+# 品項目錄（PUT /catalog/{item}）：沒給的欄位用預設值
+class ProductRuleIn(BaseModel):
+    position: Optional[int] = None              # 排列順序；不給則保留原本的（新品項排最後）
+    stocked: bool = True                        # False：排程用的虛擬品項，不建庫存列
+    base_delivery: Optional[float] = None       # 提貨基準量；不給 = 不需提貨
+    delivery_decimals: int = 1
+    delivery_truncate: bool = False
+    delivery_requires: Optional[str] = None     # 目標日有此標籤的任務才顯示提貨
+    tags: List[str] = []
+    merge_into: Optional[str] = None
+    restock_item: Optional[str] = None
+    light_task: bool = False
+    intensity_coeff: float = 1.0
+    task_levels: List[Tuple[float, str, float]] = []   # [[最低強度, 工作名稱, 數量], ...]
+    task_yield: Optional[Dict[str, float]] = None
+
+
+# 大量匯入（一次可帶上千筆）
+class InventoryRow(BaseModel):
+    item: str
+    qty: Optional[float] = None            # 不給則保留原本的庫存量（只改危險量）
+    danger_level: Optional[float] = None   # 不給則保留原本的危險量
+
+class LeftoverRow(BaseModel):
+    day: date
+    item: str
+    qty: float
+
+class DeliveryPlanRow(BaseModel):
+    day: date
+    item: str
+    planned_qty: float
+    confirmed: bool = False
+    weather: Optional[str] = None
+
+class BulkImport(BaseModel):
+    inventory: List[InventoryRow] = []
+    leftovers: List[LeftoverRow] = []
+    delivery_plans: List[DeliveryPlanRow] = []
+
+# 批次操作（POST /batch）：依序執行，同一個交易，全部成功才生效
+class BatchOperation(BaseModel):
+    op: str                        # upsert_leftovers / update_inventory / confirm_delivery / complete_task ...
+    args: Dict[str, Any] = {}      # 與單一路由的 body 相同；任務類操作另帶 task_id
+
+# 操作表的 args：沒有對應單一路由 body 的操作（任務 id、危險量）也先驗證，格式錯一律 422
+class TaskRef(BaseModel):
+    task_id: int
+
+class DangerLevels(RootModel[Dict[str, float]]):
+    pass
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
+    include_state: bool = True     # 回傳執行後的 庫存 / 剩料 / 排程
+
+# =========================================================
+# 離線同步：裝置上傳累積的操作（POST /sync/push）
+# =========================================================
+class SyncOperation(BaseModel):
+    op_id: str                     # 裝置產生的唯一 id（重送不會再執行）
+    op: str                        # 與 /batch 相同的操作名稱
+    args: Dict[str, Any] = {}
+    base: Optional[int] = None     # 做這個操作時的同步游標；之後別人改過同一列 → conflict
+    force: bool = False            # 有衝突也套用（後寫的贏）
+
+class SyncPush(BaseModel):
+    device: str
+    cursor: int = 0                # 裝置目前的游標：回應會附上之後的變更
+    operations: List[SyncOperation]
+
+# =========================================================
+# 寫入端回應（POST ...?delta=true 只回 changed + version，不帶整張表）
+# =========================================================
+class InventoryRowState(BaseModel):
+    qty: Optional[float] = None
+    danger_level: Optional[float] = None
+    version: Optional[int] = None
+
+class InventoryWriteResult(BaseModel):
+    message: str
+    changed: Dict[str, InventoryRowState] = {}            # 這次寫入後的列
+    version: Optional[int] = None                         # 庫存表寫入後的資料版本
+    inventory: Optional[Dict[str, InventoryRowState]] = None   # 整張表（delta=true 時不帶）
+
+class LeftoverWriteResult(BaseModel):
+    message: str
+    day: Optional[date] = None
+    changed: Dict[str, float] = {}
+    version: Optional[int] = None
+    leftovers: Optional[Dict[str, float]] = None          # 當天全部剩料（delta=true 時不帶）
+
+# =========================================================
+# 模擬（what-if）：用真正的提貨 / 排程函式重播 N 週，比較不同的參數
+# =========================================================
+class SimulationRequest(BaseModel):
+    weeks: int = Field(8, ge=1, le=104)
+    scenarios: int = Field(1000, ge=1, le=20000)
+    seed: Optional[int] = None                 # 固定 seed → 結果可重現
+    start: Optional[date] = None               # 第一天（預設明天）
+    safety_factor: float = 1.0
+    K: float = Field(5.0, gt=0)                # compute_intensity 的 K
+    danger_levels: Dict[str, float] = {}       # 覆蓋各品項的危險量
+    task_levels: Dict[str, List[Tuple[float, str, float]]] = {}   # 覆蓋 calculate_qty_plan 的強度門檻 / 批量
+    demand: Literal["model", "history"] = "model"   # model：需求模型 × 隨機誤差；history：抽歷史的實際 / 預期比
+    demand_cv: float = Field(0.25, ge=0, le=2)       # model 模式的誤差（變異係數）
+
@@ -0,0 +1,161 @@
+# planner.py
+"""
+排程規劃：
+  - PlanningContext：庫存 / 當日剩料 / 未完成任務，每張表查一次
+  - 低庫存判斷、品項合併、分配日子都是純函式（不碰資料庫，規則查品項目錄 catalog）
+  - 新任務一次批次寫入
+  - 任務排在實際的日期上，往後排 HORIZON_DAYS 天（可以排好幾週，下週一不會跟這週一撞在一起）
+  - OpenTaskIndex：今天起各日期的未完成任務品項，依 schedule_tasks 版本快取（/delivery 不用每次查）
+"""
+import os
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import insert, select
+
+from db import Inventory, Leftover, ScheduleTask, table_key
+from models import DateType
+from catalog import catalog
+import cache
+import changelog
+import events
+
+WEEKDAYS_EN = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+# 排程往後排幾天（明天起）
+HORIZON_DAYS = int(os.getenv("SCHEDULE_HORIZON_DAYS", "14"))
+
+# 非繁重工作（light_task）、合併群組（merge_into）、補貨品項（restock_item）都在品項目錄
+
+
+@dataclass
+class PlanningContext:
+    today: date
+    inventory: Dict[str, Tuple[float, float]]          # item → (qty, danger_level)
+    leftovers: Dict[str, float]                        # 當日剩料
+    open_tasks: List[Tuple[date, str]] = field(default_factory=list)  # (day, item)
+
+
+@dataclass
+class TaskRequest:
+    item: str
+    task: str
+    qty: float
+
+
+async def load_context(session, today: date) -> PlanningContext:
+    inventory = {item: (qty or 0.0, danger if danger is not None else 5.0) for item, qty, danger in (
+        await session.execute(select(Inventory.item, Inventory.qty, Inventory.danger_level))).all()}
+    leftovers = {item: qty for item, qty in (await session.execute(
+        select(Leftover.item, Leftover.qty).where(Leftover.day == today))).all()}
+    open_tasks = [(day, item) for day, item in (await session.execute(
+        select(ScheduleTask.day, ScheduleTask.item).where(ScheduleTask.done.is_(False)))).all()]
+    return PlanningContext(today=today, inventory=inventory, leftovers=leftovers, open_tasks=open_tasks)
+
+
+def low_items(ctx: PlanningContext) -> List[str]:
+    """低於危險量的品項（魚皮不夠 → 剝魚肉；合併腸子 / 蝦肉丸）"""
+    low = [item for item, (qty, danger) in ctx.inventory.items() if qty < danger]
+    # 有設定補貨品項的（魚皮 → 魚肉），也新增該品項的任務
+    for item in list(low):
+        rule = catalog.rules.get(item)
+        if rule is not None and rule.restock_item and rule.restock_item not in low:
+            low.append(rule.restock_item)
+    for merged, parts in catalog.merge_groups.items():
+        if any(x in low for x in parts):
+            low = [x for x in low if x not in parts]
+            low.append(merged)
+    return low
+
+
+def combined(values: Dict[str, float], item: str) -> float:
+    """合併品項取各成員合計，其餘直接取值"""
+    return sum(values.get(x, 0.0) or 0.0 for x in catalog.merge_groups.get(item, (item,)))
+
+
+def allocate(requests: Sequence[TaskRequest], open_tasks: Iterable[Tuple[date, str]],
+             days: Sequence[Tuple[date, DateType]]) -> List[Dict]:
+    """
+    把任務分配到日子上（依序嘗試 days，放不下就不排）：
+      - 假日 / 休息日不排
+      - 非繁重工作：那天不能有任何工作
+      - 繁重工作：那天不能有其他繁重工作（一天最多一件）
+      - 已有未完成的同品項任務 → 鎖住，不重複建
+    新排進去的任務也算佔用
+    """
+    busy: Dict[date, List[str]] = {}
+    for day, item in open_tasks:
+        busy.setdefault(day, []).append(item)
+    locked = {item for items in busy.values() for item in items}
+
+    rows: List[Dict] = []
+    for req in requests:
+        if req.item in locked:
+            continue
+        day = pick_day(req.item, busy, days)
+        if day is None:
+            continue
+        busy.setdefault(day, []).append(req.item)
+        rows.append({"day": day, "task": req.task, "item": req.item, "qty": req.qty, "done": False})
+    return rows
+
+
+def pick_day(item: str, busy: Dict[date, List[str]], days: Sequence[Tuple[date, DateType]]) -> Optional[date]:
+    light = item in catalog.light
+    for d, day_type in days:
+        if day_type in (DateType.holiday, DateType.restday):
+            continue
+        existed = busy.get(d, [])
+        if light and existed:
+            continue
+        if not light and any(x not in catalog.light for x in existed):
+            continue
+        return d
+    return None
+
+
+TASK_COLUMNS = (ScheduleTask.id, ScheduleTask.day, ScheduleTask.task, ScheduleTask.item,
+                ScheduleTask.qty, ScheduleTask.done)
+
+
+def task_dict(row) -> Dict:
+    # weekday 由日期推出來（舊版前端依星期幾分組）
+    return {"id": row.id, "day": row.day.isoformat(), "weekday": WEEKDAYS_EN[row.day.weekday()], "task": row.task,
+            "item": row.item, "qty": row.qty, "done": row.done}
+
+
+async def insert_tasks(session, rows: List[Dict]) -> int:
+    if not rows:
+        return 0
+    created = (await session.execute(insert(ScheduleTask).returning(*TASK_COLUMNS), rows)).all()
+    events.emit(session, events.SCHEDULE, {"upsert": [task_dict(r) for r in created]})
+    changelog.record(session, changelog.SCHEDULE_TASKS, {r.id: task_dict(r) for r in created})
+    return len(created)
+
+
+class OpenTaskIndex:
+    """日期 → 未完成任務的品項（今天起）；schedule_tasks 版本變了或跨日才重新查（走 (day, done) 索引）"""
+
+    def __init__(self):
+        self._key = None
+        self._by_day: Dict[date, Set[str]] = {}
+
+    async def items_on(self, session, day: date) -> Set[str]:
+        today = date.today()
+        if day < today:
+            # 過去的日子很少查，不快取
+            return set((await session.scalars(
+                select(ScheduleTask.item).where(ScheduleTask.day == day, ScheduleTask.done.is_(False)))).all())
+        key = (cache.versions.get(table_key("schedule_tasks")), today)
+        if key != self._key:
+            rows = (await session.execute(
+                select(ScheduleTask.day, ScheduleTask.item)
+                .where(ScheduleTask.day >= today, ScheduleTask.done.is_(False)))).all()
+            by_day: Dict[date, Set[str]] = {}
+            for d, item in rows:
+                by_day.setdefault(d, set()).add(item)
+            self._by_day, self._key = by_day, key
+        return self._by_day.get(day, set())
+
+
+open_task_index = OpenTaskIndex()
@@ -0,0 +1,157 @@
+# rollups.py
+"""
+用量彙總（usage_rollups）：每個品項每日 / 週 / 月的 提貨、剩料、備料量
+  - 寫入端在同一個交易內把「新值 - 舊值」加進三個粒度（一句多列 INSERT ... ON CONFLICT 累加）
+  - 舊值不另外查：剩料 / 提貨的 upsert 在 SET 裡把舊值存進 prev_* 欄位，RETURNING 一起取回
+    （同一列的寫入由那一列的鎖排隊，不需要整張表的鎖）
+  - 剩料率（leftover / delivered）讀取時才算，彙總表只存可以相加的量
+  - /analytics 只讀這張表；區間剛好是整月 / 整週就用月 / 週的列，一年的資料也只有幾十列
+"""
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import case, delete, func, select
+
+from db import DeliveryPlan, InventoryMovement, Leftover, UsageRollup, bulk_upsert, touch
+import ledger
+
+DAY = "day"
+WEEK = "week"
+MONTH = "month"
+GRAINS = (DAY, WEEK, MONTH)
+FIELDS = ("delivered", "leftover", "produced")
+
+DayItem = Tuple[date, str]
+
+
+def period_start(grain: str, day: date) -> date:
+    if grain == WEEK:
+        return day - timedelta(days=day.weekday())
+    if grain == MONTH:
+        return day.replace(day=1)
+    return day
+
+
+def period_end(grain: str, start: date) -> date:
+    """期間的最後一天"""
+    if grain == WEEK:
+        return start + timedelta(days=6)
+    if grain == MONTH:
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    return start
+
+
+def grain_for(start: date, end: date) -> str:
+    """區間能整除的最粗粒度（讀最少列）"""
+    if start == period_start(MONTH, start) and end == period_end(MONTH, period_start(MONTH, end)):
+        return MONTH
+    if start.weekday() == 0 and end.weekday() == 6:
+        return WEEK
+    return DAY
+
+
+# =========================================================
+# 寫入端
+# =========================================================
+async def add(session, field: str, deltas: Dict[DayItem, float]) -> None:
+    """把每個 (日期, 品項) 的差額加進日 / 週 / 月三個粒度"""
+    totals: Dict[Tuple[str, date, str], float] = {}
+    for (day, item), delta in deltas.items():
+        if not delta:
+            continue
+        for grain in GRAINS:
+            key = (grain, period_start(grain, day), item)
+            totals[key] = totals.get(key, 0.0) + delta
+    rows = [{"grain": grain, "period": period, "item": item, **{f: 0.0 for f in FIELDS}, field: delta}
+            for (grain, period, item), delta in totals.items()]
+    if not rows:
+        return
+    touch(session, "usage_rollups")
+    await bulk_upsert(session, UsageRollup, rows, conflict_cols=["grain", "period", "item"],
+                      set_=lambda c, excluded: {field: c[field] + excluded[field]})
+
+
+async def upsert_leftovers(session, rows: List[dict]) -> None:
+    """寫入剩料 {day, item, qty}，差額加進彙總"""
+    written = await bulk_upsert(
+        session, Leftover, rows, conflict_cols=["day", "item"],
+        set_=lambda c, excluded: {"qty": excluded.qty, "prev_qty": c.qty},
+        returning=(Leftover.day, Leftover.item, Leftover.qty, Leftover.prev_qty))
+    await add(session, "leftover", {(r.day, r.item): (r.qty or 0.0) - (r.prev_qty or 0.0) for r in written})
+
+
+async def upsert_plans(session, plans: List[dict]) -> None:
+    """寫入提貨計畫 {day, item, planned_qty, confirmed, weather}；只有確認過的算提貨量"""
+    written = await bulk_upsert(
+        session, DeliveryPlan, plans, conflict_cols=["day", "item"],
+        set_=lambda c, excluded: {"planned_qty": excluded.planned_qty, "confirmed": excluded.confirmed,
+                                  "weather": excluded.weather,
+                                  "prev_delivered": case((c.confirmed, c.planned_qty), else_=0.0)},
+        returning=(DeliveryPlan.day, DeliveryPlan.item, DeliveryPlan.planned_qty, DeliveryPlan.confirmed,
+                   DeliveryPlan.prev_delivered))
+    await add(session, "delivered", {
+        (r.day, r.item): ((r.planned_qty or 0.0) if r.confirmed else 0.0) - (r.prev_delivered or 0.0)
+        for r in written})
+
+
+async def add_produced(session, day: date, produced: Dict[str, float]) -> None:
+    await add(session, "produced", {(day, item): float(qty) for item, qty in produced.items()})
+
+
+async def rebuild(session) -> None:
+    """從 剩料 / 已確認提貨 / 備料入庫異動 重算整張表（migration、資料修復用）"""
+    touch(session, "usage_rollups")
+    await session.execute(delete(UsageRollup))
+    leftovers = (await session.execute(select(Leftover.day, Leftover.item, Leftover.qty))).all()
+    await add(session, "leftover", {(d, i): q or 0.0 for d, i, q in leftovers})
+    plans = (await session.execute(
+        select(DeliveryPlan.day, DeliveryPlan.item, DeliveryPlan.planned_qty).where(DeliveryPlan.confirmed.is_(True))
+    )).all()
+    await add(session, "delivered", {(d, i): q or 0.0 for d, i, q in plans})
+    produced: Dict[DayItem, float] = {}
+    for ts, item, delta in (await session.execute(
+        select(InventoryMovement.ts, InventoryMovement.item, InventoryMovement.delta)
+        .where(InventoryMovement.kind == ledger.PRODUCTION)
+    )).all():
+        produced[(ts.date(), item)] = produced.get((ts.date(), item), 0.0) + (delta or 0.0)
+    await add(session, "produced", produced)
+
+
+# =========================================================
+# 讀取
+# =========================================================
+def _figures(delivered: float, leftover: float, produced: float) -> dict:
+    return {
+        "delivered": round(delivered, 3),
+        "leftover": round(leftover, 3),
+        "produced": round(produced, 3),
+        "used": round(delivered - leftover, 3),
+        "waste_ratio": round(leftover / delivered, 4) if delivered > 0 else None,
+    }
+
+
+async def series(session, grain: str, start: date, end: date, item: Optional[str] = None) -> List[dict]:
+    """各期間的數字（period 落在 [start, end] 所在期間內）"""
+    stmt = (select(UsageRollup.period, UsageRollup.item, UsageRollup.delivered, UsageRollup.leftover,
+                   UsageRollup.produced)
+            .where(UsageRollup.grain == grain,
+                   UsageRollup.period.between(period_start(grain, start), period_start(grain, end)))
+            .order_by(UsageRollup.period, UsageRollup.item))
+    if item is not None:
+        stmt = stmt.where(UsageRollup.item == item)
+    return [{"period": period.isoformat(), "item": name, **_figures(d, l, p)}
+            for period, name, d, l, p in (await session.execute(stmt)).all()]
+
+
+async def totals(session, start: date, end: date, item: Optional[str] = None) -> Dict:
+    """區間內每個品項的合計（依剩料率高到低）"""
+    grain = grain_for(start, end)
+    stmt = (select(UsageRollup.item, func.sum(UsageRollup.delivered), func.sum(UsageRollup.leftover),
+                   func.sum(UsageRollup.produced))
+            .where(UsageRollup.grain == grain, UsageRollup.period.between(start, end))
+            .group_by(UsageRollup.item))
+    if item is not None:
+        stmt = stmt.where(UsageRollup.item == item)
+    items = {name: _figures(d or 0.0, l or 0.0, p or 0.0) for name, d, l, p in (await session.execute(stmt)).all()}
+    ranked = sorted(items.items(), key=lambda kv: -(kv[1]["waste_ratio"] or 0.0))
+    return {"from": start.isoformat(), "to": end.isoformat(), "grain": grain, "items": dict(ranked)}
@@ -0,0 +1,30 @@
+# serialization.py
+"""
+JSON 輸出：
+  - 有 orjson 就用 orjson（C 實作，比標準 json 快數倍，日期 / numpy / 非字串 key 直接支援）
+  - 沒裝時退回標準 json + jsonable_encoder，行為相同只是慢
+  - FastJSONResponse 當 FastAPI 的預設回應類別；有宣告 response_model 的路由
+    由 pydantic 驗證後直接交給它輸出，不再經過 jsonable_encoder
+"""
+import json
+from typing import Any
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson 是選配
+    orjson = None
+
+
+def dumps(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, default=jsonable_encoder,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(jsonable_encoder(data), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,367 @@
+# services.py
+"""
+寫入端的業務邏輯：每個函式收一個 session，在呼叫端的交易裡做事，不自己 commit
+  - 一般路由：開 session → 呼叫一個 → commit
+  - POST /batch：同一個 session 依序呼叫多個 → 全部成功才 commit（任何一個失敗整批 rollback）
+錯誤用 HTTPException 往外丟（批次端會補上是第幾個操作）
+回傳的 changed 是這次寫入後的列（客戶端可只套用差異）
+版本號 commit 前才遞增（db.bump_version）：回應裡該表寫入後的 version 由路由 stamp_versions 後補上
+"""
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import and_, delete, or_, select, update
+
+from db import (Inventory, Leftover, DeliveryPlan, ScheduleTask, bump_version, touch, table_key,
+                SCHEDULE_INPUTS)
+from models import (BulkImport, CalendarDayIn, ConfirmDelivery, DangerLevels, InventoryUpdate, LeftoverUpsert,
+                    MoveTaskRequest, TaskRef, UpdateTaskQtyRequest)
+from stock import StockConflict, adjust_stock, set_stock, set_danger_levels
+from logic import demand_model, refresh_models
+from catalog import catalog
+from demand import affected_by_leftovers
+from planner import TASK_COLUMNS, WEEKDAYS_EN, task_dict
+from weather import FALLBACK_LABEL, weather_service
+from holidays import holiday_calendar
+import changelog
+import holidays
+import rollups
+import events
+import ledger
+
+
+# =========================================================
+# 讀取
+# =========================================================
+async def read_inventory(s) -> Dict[str, dict]:
+    rows = (await s.scalars(select(Inventory))).all()
+    return {
+        r.item: {
+            "qty": r.qty,
+            "danger_level": r.danger_level,
+            "version": r.version,
+        } for r in rows
+    }
+
+async def read_leftovers(s, day: date) -> Dict[str, float]:
+    rows = (await s.execute(select(Leftover.item, Leftover.qty).where(Leftover.day == day))).all()
+    return {item: qty for item, qty in rows}
+
+async def read_schedule(s, start: Optional[date] = None, end: Optional[date] = None) -> List[dict]:
+    """排程任務（依日期）；給了 start / end 就只取區間內的（走 (day, done) 索引）"""
+    stmt = select(*TASK_COLUMNS).order_by(ScheduleTask.day, ScheduleTask.id)
+    if start is not None:
+        stmt = stmt.where(ScheduleTask.day >= start)
+    if end is not None:
+        stmt = stmt.where(ScheduleTask.day <= end)
+    return [task_dict(t) for t in (await s.execute(stmt)).all()]
+
+
+# 區間讀取：依 (day, item) 的 keyset 分頁（覆蓋索引 ix_leftovers_day_item_qty / ix_plans_day_item_cover 直接掃）
+RANGE_PAGE_SIZE = 500
+
+def parse_cursor(cursor: Optional[str]) -> Optional[Tuple[date, str]]:
+    """游標格式：YYYY-MM-DD|品項（上一頁最後一列）"""
+    if not cursor:
+        return None
+    day, sep, item = cursor.partition("|")
+    try:
+        return date.fromisoformat(day), item
+    except ValueError:
+        raise HTTPException(400, "cursor 格式錯誤")
+
+def columnar(rows, fields: Sequence[str], items: Optional[Sequence[str]] = None) -> dict:
+    """
+    (day, item, *fields) 的列 → {days, items, <field>: [[每天 × 每個品項]]}；沒有資料的格子為 null
+    items 有給就照這個順序排欄位
+    """
+    days = sorted({r[0] for r in rows})
+    names = list(items) if items else sorted({r[1] for r in rows})
+    day_index = {d: i for i, d in enumerate(days)}
+    item_index = {name: i for i, name in enumerate(names)}
+    out = {"days": [d.isoformat() for d in days], "items": names}
+    for f in fields:
+        out[f] = [[None] * len(names) for _ in days]
+    for r in rows:
+        col = item_index.get(r[1])
+        if col is None:
+            continue
+        for f, value in zip(fields, r[2:]):
+            out[f][day_index[r[0]]][col] = value
+    return out
+
+async def _read_range(s, model, fields: Sequence[str], start: date, end: date, items: Optional[Sequence[str]],
+                      cursor: Optional[str], limit: int, *where) -> dict:
+    stmt = (select(model.day, model.item, *(getattr(model, f) for f in fields))
+            .where(model.day.between(start, end), *where)
+            .order_by(model.day, model.item).limit(limit + 1))
+    if items:
+        stmt = stmt.where(model.item.in_(items))
+    after = parse_cursor(cursor)
+    if after is not None:
+        stmt = stmt.where(or_(model.day > after[0], and_(model.day == after[0], model.item > after[1])))
+    rows = (await s.execute(stmt)).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    result = columnar(rows, fields, items)
+    # 同一天可能跨頁：下一頁用 next 繼續，客戶端依 days 合併
+    result["next"] = f"{rows[-1][0].isoformat()}|{rows[-1][1]}" if more else None
+    return result
+
+async def read_leftover_range(s, start: date, end: date, items: Optional[Sequence[str]] = None,
+                              cursor: Optional[str] = None, limit: int = RANGE_PAGE_SIZE) -> dict:
+    return await _read_range(s, Leftover, ("qty",), start, end, items, cursor, limit)
+
+async def read_plan_range(s, start: date, end: date, items: Optional[Sequence[str]] = None,
+                          confirmed: Optional[bool] = None, cursor: Optional[str] = None,
+                          limit: int = RANGE_PAGE_SIZE) -> dict:
+    where = [] if confirmed is None else [DeliveryPlan.confirmed.is_(confirmed)]
+    return await _read_range(s, DeliveryPlan, ("planned_qty", "confirmed", "weather"),
+                             start, end, items, cursor, limit, *where)
+
+
+# =========================================================
+# 變更紀錄（剩料 / 提貨計畫；庫存在 stock.py、任務在下面各自記）
+# =========================================================
+def record_leftovers(s, rows: List[dict]) -> None:
+    changelog.record(s, changelog.LEFTOVERS, {
+        changelog.day_key(r["day"], r["item"]): {"day": r["day"].isoformat(), "item": r["item"], "qty": r["qty"]}
+        for r in rows})
+
+def record_plans(s, rows: List[dict]) -> None:
+    changelog.record(s, changelog.DELIVERY_PLANS, {
+        changelog.day_key(r["day"], r["item"]): {**r, "day": r["day"].isoformat()} for r in rows})
+
+
+# =========================================================
+# 庫存
+# =========================================================
+async def update_inventory(s, payload: InventoryUpdate) -> dict:
+    if not payload.updates:
+        raise HTTPException(400, "updates 不可為空")
+    try:
+        changed = await set_stock(s, payload.updates, payload.expected_versions, kind=ledger.STOCKTAKE)
+    except StockConflict as e:
+        raise HTTPException(409, f"庫存已被其他裝置更新：{', '.join(e.items)}")
+    bump_version(s, SCHEDULE_INPUTS, table_key("inventory"))
+    return {"message": "inventory updated", "changed": changed}
+
+async def update_danger_levels(s, levels: Dict[str, float]) -> dict:
+    if not levels:
+        raise HTTPException(400, "danger_levels 不可為空")
+    changed = await set_danger_levels(s, levels)
+    bump_version(s, SCHEDULE_INPUTS, table_key("inventory"))
+    return {"message": "danger levels updated", "changed": changed}
+
+
+# =========================================================
+# 剩料 / 提貨
+# =========================================================
+async def upsert_leftovers(s, payload: LeftoverUpsert) -> dict:
+    rows = [{"day": payload.day, "item": item, "qty": max(float(qty), 0.0)} for item, qty in payload.leftovers.items()]
+    await rollups.upsert_leftovers(s, rows)
+    changed = {r["item"]: r["qty"] for r in rows}
+    events.emit(s, events.LEFTOVERS, {"day": payload.day.isoformat(), "items": changed})
+    record_leftovers(s, rows)
+    # 剩料影響當天與隔天的需求觀測
+    await demand_model.observe_days(s, affected_by_leftovers([payload.day]))
+    bump_version(s, SCHEDULE_INPUTS, table_key("leftovers"))
+    return {"message": "leftovers upserted", "day": payload.day.isoformat(), "changed": changed}
+
+async def confirm_delivery(s, payload: ConfirmDelivery) -> dict:
+    # 寫入/更新 DeliveryPlan，並同步更新庫存（提貨到庫存 -）
+    # 天氣由路由在開交易前查好（resolve_weather）；交易裡不等上游
+    weather_label = payload.weather or FALLBACK_LABEL
+    # upsert plans
+    plans = [{"day": payload.day, "item": item, "planned_qty": float(qty), "confirmed": True,
+              "weather": weather_label}
+             for item, qty in payload.items.items()]
+    await rollups.upsert_plans(s, plans)
+    record_plans(s, plans)
+    await demand_model.observe_days(s, [payload.day])
+    # 更新庫存（提貨 → 扣庫存，在資料庫內原子扣減，不得為負）
+    changed = await adjust_stock(s, {item: -float(qty) for item, qty in payload.items.items()},
+                                 kind=ledger.DELIVERY, ref=f"delivery:{payload.day.isoformat()}")
+    bump_version(s, SCHEDULE_INPUTS, table_key("inventory"), table_key("delivery_plans"))
+    return {"message": "delivery confirmed & inventory updated", "changed": changed}
+
+async def bulk_import(s, payload: BulkImport) -> dict:
+    """大量匯入庫存 / 剩料 / 提貨計畫（每張表一個批次 upsert）"""
+    await set_stock(s, {r.item: r.qty for r in payload.inventory if r.qty is not None},
+                    kind=ledger.STOCKTAKE, ref="import")
+    await set_danger_levels(s, {r.item: r.danger_level for r in payload.inventory if r.danger_level is not None})
+    leftovers = [{"day": r.day, "item": r.item, "qty": max(r.qty, 0.0)} for r in payload.leftovers]
+    await rollups.upsert_leftovers(s, leftovers)
+    record_leftovers(s, leftovers)
+    by_day: Dict[date, Dict[str, float]] = {}
+    for r in payload.leftovers:
+        by_day.setdefault(r.day, {})[r.item] = max(r.qty, 0.0)
+    for day, items in sorted(by_day.items()):
+        events.emit(s, events.LEFTOVERS, {"day": day.isoformat(), "items": items})
+    plans = [{"day": r.day, "item": r.item, "planned_qty": r.planned_qty, "confirmed": r.confirmed,
+              "weather": r.weather}
+             for r in payload.delivery_plans]
+    await rollups.upsert_plans(s, plans)
+    record_plans(s, plans)
+    await demand_model.observe_days(s, {r.day for r in payload.delivery_plans}
+                                    | set(affected_by_leftovers({r.day for r in payload.leftovers})))
+    keys = [SCHEDULE_INPUTS] if payload.inventory or payload.leftovers else []
+    keys += [table_key(t) for t, rows in (("inventory", payload.inventory),
+                                          ("leftovers", payload.leftovers),
+                                          ("delivery_plans", payload.delivery_plans)) if rows]
+    if keys:
+        bump_version(s, *keys)
+    return {
+        "message": "bulk import done",
+        "inventory": len(payload.inventory),
+        "leftovers": len(payload.leftovers),
+        "delivery_plans": len(payload.delivery_plans),
+    }
+
+
+# =========================================================
+# 排程任務
+# =========================================================
+async def complete_task(s, task_id: int) -> dict:
+    """
+    完成任務：
+      - 刪除這筆排程（或你想改 done=True 也行）
+      - 依任務數量更新庫存（完成備料 → 庫存增加）
+    兩台裝置同時完成同一筆：DELETE ... RETURNING 只會有一個成功，另一個回 404
+    """
+    # 刪除任務（或改 task.done = True；這裡依你規格用刪除）
+    task = (await s.execute(
+        delete(ScheduleTask).where(ScheduleTask.id == task_id)
+        .returning(ScheduleTask.task, ScheduleTask.item, ScheduleTask.qty)
+        .execution_options(synchronize_session=False)
+    )).first()
+    if not task:
+        raise HTTPException(404, "Task not found")
+    events.emit(s, events.SCHEDULE, {"deleted": [task_id]})
+    changelog.record(s, changelog.SCHEDULE_TASKS, deleted=[task_id])
+
+    # 有設定產出的品項（剝魚肉：3包魚肉 + 4包魚皮）依目錄加庫存
+    await refresh_models(s)
+    rule = catalog.rules.get(task.item)
+    if rule is not None and rule.task_yield:
+        produced = catalog.task_yield(task.item, task.qty)
+        message = f"任務 [{task.task}] 已完成，已增加" + "、".join(f"{k} {v} 包" for k, v in produced.items())
+    else:
+        # 一般任務：完成備料 → 庫存加 qty
+        produced = {task.item: float(task.qty)}
+        message = f"任務 [{task.task}] 已完成，已更新 {task.item} 庫存 {task.qty}"
+    await adjust_stock(s, produced, kind=ledger.PRODUCTION, ref=f"task:{task_id}")
+    await rollups.add_produced(s, date.today(), produced)
+
+    bump_version(s, SCHEDULE_INPUTS, table_key("inventory"), table_key("schedule_tasks"))
+    return {"message": message}
+
+async def delete_task(s, task_id: int) -> dict:
+    """刪除任務：不更新庫存（同時刪同一筆只會有一個成功）"""
+    task = (await s.execute(
+        delete(ScheduleTask).where(ScheduleTask.id == task_id)
+        .returning(ScheduleTask.task)
+        .execution_options(synchronize_session=False)
+    )).first()
+    if not task:
+        raise HTTPException(404, "Task not found")
+    events.emit(s, events.SCHEDULE, {"deleted": [task_id]})
+    changelog.record(s, changelog.SCHEDULE_TASKS, deleted=[task_id])
+    bump_version(s, SCHEDULE_INPUTS, table_key("schedule_tasks"))
+    return {"message": f"任務 [{task.task}] 已刪除"}
+
+async def _update_task(s, task_id: int, **values):
+    """改一筆任務，回傳 (改之前的列, 改之後的列)"""
+    before = (await s.execute(select(*TASK_COLUMNS).where(ScheduleTask.id == task_id))).first()
+    if not before:
+        raise HTTPException(404, "Task not found")
+    after = (await s.execute(
+        update(ScheduleTask).where(ScheduleTask.id == task_id).values(**values)
+        .returning(*TASK_COLUMNS)
+        .execution_options(synchronize_session=False)
+    )).first()
+    if not after:
+        raise HTTPException(404, "Task not found")
+    events.emit(s, events.SCHEDULE, {"upsert": [task_dict(after)]})
+    changelog.record(s, changelog.SCHEDULE_TASKS, {after.id: task_dict(after)})
+    touch(s, "schedule_tasks")
+    return before, after
+
+def move_target(payload: MoveTaskRequest, today: Optional[date] = None) -> date:
+    """new_day；舊版前端只給 new_weekday → 今天起最近的那個星期幾"""
+    today = today or date.today()
+    if payload.new_day is not None:
+        if payload.new_day < today:
+            raise HTTPException(400, "不能移到今天以前")
+        return payload.new_day
+    if payload.new_weekday not in WEEKDAYS_EN:
+        raise HTTPException(400, f"new_day is required, or new_weekday must be one of: {WEEKDAYS_EN}")
+    return today + timedelta(days=(WEEKDAYS_EN.index(payload.new_weekday) - today.weekday()) % 7)
+
+async def move_task(s, task_id: int, payload: MoveTaskRequest) -> dict:
+    """移動任務到另一天"""
+    new_day = move_target(payload)
+    before, _ = await _update_task(s, task_id, day=new_day)
+    return {"message": f"任務已從 {before.day} 移動到 {new_day}", "day": new_day.isoformat()}
+
+async def update_task_qty(s, task_id: int, new_qty: float) -> dict:
+    """更新任務數量"""
+    qty = max(float(new_qty), 0.0)
+    before, _ = await _update_task(s, task_id, qty=qty)
+    return {"message": f"任務數量已從 {before.qty} 更新為 {qty}"}
+
+
+# =========================================================
+# 工作日曆
+# =========================================================
+async def set_calendar_day(s, day: date, payload: Optional[CalendarDayIn]) -> dict:
+    """
+    設定某天的類型（payload=None：刪掉例外，回到每週規則）
+    那天已經有的需求觀測換到新的日期類型（同一個交易內，記憶體的日曆 commit 後才重新載入）
+    """
+    effective = await holidays.set_day(s, day, payload.date_type if payload else None,
+                                       payload.name if payload else None)
+    await demand_model.observe_days(
+        s, [day], date_type_of=lambda d: effective if d == day else holiday_calendar.date_type(d))
+    return {"day": day.isoformat(), "date_type": effective.value, "name": payload.name if payload else None}
+
+
+# =========================================================
+# 操作表：POST /batch 與 POST /sync/push 用名稱呼叫（args 與單一路由的 body 相同；任務類另帶 task_id）
+# args 一律先經 pydantic 驗證：格式錯是 ValidationError（呼叫端回 422），不會變成 500
+# =========================================================
+async def resolve_weather(operations) -> None:
+    """
+    沒帶天氣的 confirm_delivery 先查好填進 args（同一天只查一次）
+    要在開交易之前呼叫：查預報可能要等上游，不能讓交易 / SAVEPOINT 跟著等
+    """
+    pending: Dict[date, List[dict]] = {}
+    for operation in operations:
+        args = operation.args
+        if operation.op != "confirm_delivery" or args.get("weather"):
+            continue
+        try:
+            day = date.fromisoformat(str(args.get("day")))
+        except ValueError:
+            continue   # 日期格式錯的留給 ConfirmDelivery 驗證回 422
+        pending.setdefault(day, []).append(args)
+    for day, args_list in pending.items():
+        label = (await weather_service.daily_labels(day, day))[day]
+        for args in args_list:
+            args["weather"] = label
+
+def task_id_of(args) -> int:
+    return TaskRef(**args).task_id
+
+OPERATIONS = {
+    "upsert_leftovers": lambda s, args: upsert_leftovers(s, LeftoverUpsert(**args)),
+    "update_inventory": lambda s, args: update_inventory(s, InventoryUpdate(**args)),
+    "update_danger_levels": lambda s, args: update_danger_levels(s, DangerLevels(args).root),
+    "confirm_delivery": lambda s, args: confirm_delivery(s, ConfirmDelivery(**args)),
+    "bulk_import": lambda s, args: bulk_import(s, BulkImport(**args)),
+    "complete_task": lambda s, args: complete_task(s, task_id_of(args)),
+    "delete_task": lambda s, args: delete_task(s, task_id_of(args)),
+    "move_task": lambda s, args: move_task(s, task_id_of(args), MoveTaskRequest(**args)),
+    "update_task_qty": lambda s, args: update_task_qty(s, task_id_of(args), UpdateTaskQtyRequest(**args).new_qty),
+}
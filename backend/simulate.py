@@ -0,0 +1,494 @@
+# simulate.py
+"""
+Monte Carlo 模擬（what-if）：改危險量 / 工作批量 / intensity 的 K 之前，先看看過去 N 週會變怎樣
+  - 起始狀態是目前的資料庫：庫存、危險量、今天的剩料、未完成任務、品項目錄、需求模型
+  - 每個情境：用天氣的馬可夫鏈抽一串天氣（轉移機率從歷史提貨紀錄估），逐日重播
+      早上：calc_base_delivery → apply_leftover_deduction → 目錄的顯示規則 → 從廚房庫存提貨（不夠 = 缺貨）
+      白天：需求 = 需求模型 ×（隨機誤差 或 抽歷史的 實際 / 預期 比），賣不完的就是剩料
+            當天的任務完成 → 依目錄的產出加庫存（同 complete_task）
+      晚上：logic.plan_tasks（與 generate_schedule 相同）排未來 planner.HORIZON_DAYS 天的任務
+  - 情境分成幾批丟到 ProcessPoolExecutor（spawn）；品項目錄的覆蓋只在子行程裡生效，不影響服務中的行程
+CLI：
+    DATABASE_URL=sqlite:///./app.db python simulate.py --weeks 8 --scenarios 2000 --K 4 --danger 魚肚=8
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import secrets
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import select, update
+from sqlalchemy.exc import OperationalError
+
+from db import (DeliveryPlan, DemandObservation, Inventory, Leftover, ScheduleTask, SessionLocal, SimulationJob)
+from models import SimulationRequest
+from catalog import Rule, catalog
+from holidays import holiday_calendar
+from logic import (WEATHER_WEIGHT, apply_leftover_deduction, calc_base_delivery, demand_model, plan_tasks,
+                   refresh_models, weekday_to_datetype)
+import metrics
+import planner
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.getenv("SIM_WORKERS", str(os.cpu_count() or 2)))
+# 每批幾個情境（太小 → 行程間傳輸的成本比計算高）
+CHUNK_SIZE = int(os.getenv("SIM_CHUNK_SIZE", "100"))
+# 情境數 × 週數上限（避免一個請求佔滿 CPU 太久）
+MAX_WORK = int(os.getenv("SIM_MAX_WORK", "500000"))
+# 更新工作狀態遇到 database is locked 等暫時性錯誤：重試幾次（每次等待加倍）
+FINISH_ATTEMPTS = 5
+FINISH_RETRY_SECONDS = 0.2
+# history 模式：觀測數少於這個的品項改用隨機誤差
+MIN_HISTORY = 5
+EPS = 1e-9
+
+METRICS = ("stockout_days", "lost_sales", "kitchen_short_days", "delivered", "leftover", "produced", "tasks")
+
+
+@dataclass
+class Inputs:
+    """送到子行程的全部輸入（可 pickle）"""
+    key: str
+    start: date
+    days: int
+    rules: List[Rule]
+    demand_state: Dict
+    calendar_state: Dict
+    inventory: Dict[str, Tuple[float, float]]        # item → (qty, danger_level)
+    leftovers: Dict[str, float]                      # 起始前一天的剩料
+    open_tasks: List[Dict]                           # {day, item, qty}
+    weather_labels: List[str]
+    weather_transition: List[List[float]]
+    ratios: Dict[str, List[float]] = field(default_factory=dict)
+    safety_factor: float = 1.0
+    K: float = 5.0
+    demand: str = "model"
+    demand_cv: float = 0.25
+
+
+# =========================================================
+# 輸入（服務中的行程：讀資料庫）
+# =========================================================
+def _weather_transition(history: Sequence[str], labels: List[str]) -> List[List[float]]:
+    """相鄰兩天天氣的轉移機率（每格先給 1 次，沒有歷史時就是均勻分布）"""
+    index = {w: i for i, w in enumerate(labels)}
+    counts = np.ones((len(labels), len(labels)))
+    for a, b in zip(history, history[1:]):
+        if a in index and b in index:
+            counts[index[a], index[b]] += 1
+    return (counts / counts.sum(axis=1, keepdims=True)).tolist()
+
+
+def _overridden_rules(request: SimulationRequest) -> List[Rule]:
+    rules = []
+    for rule in catalog.rules.values():
+        levels = request.task_levels.get(rule.item)
+        if levels is not None:
+            rule = replace(rule, task_levels=tuple(sorted((tuple(level) for level in levels), reverse=True)))
+        rules.append(rule)
+    return rules
+
+
+async def load_inputs(session, request: SimulationRequest) -> Inputs:
+    await refresh_models(session)
+    start = request.start or date.today() + timedelta(days=1)
+    inventory = {item: (qty or 0.0, danger if danger is not None else 5.0) for item, qty, danger in (
+        await session.execute(select(Inventory.item, Inventory.qty, Inventory.danger_level))).all()}
+    for item, level in request.danger_levels.items():
+        inventory[item] = (inventory.get(item, (0.0, 0.0))[0], float(level))
+    leftovers = {item: qty or 0.0 for item, qty in (await session.execute(
+        select(Leftover.item, Leftover.qty).where(Leftover.day == start - timedelta(days=1)))).all()}
+    open_tasks = [{"day": day, "item": item, "qty": qty or 0.0} for day, item, qty in (await session.execute(
+        select(ScheduleTask.day, ScheduleTask.item, ScheduleTask.qty).where(ScheduleTask.done.is_(False)))).all()]
+
+    labels = list(WEATHER_WEIGHT)
+    by_day: Dict[date, str] = {}
+    for day, weather in (await session.execute(
+            select(DeliveryPlan.day, DeliveryPlan.weather)
+            .where(DeliveryPlan.confirmed.is_(True), DeliveryPlan.weather.is_not(None))
+            .order_by(DeliveryPlan.day))).all():
+        by_day.setdefault(day, weather)
+    history = [by_day[d] for d in sorted(by_day)]
+
+    ratios: Dict[str, List[float]] = {}
+    if request.demand == "history":
+        for item, dt, weather, qty in (await session.execute(
+                select(DemandObservation.item, DemandObservation.date_type, DemandObservation.weather,
+                       DemandObservation.qty))).all():
+            expected = demand_model.expected(item, dt, weather or "")
+            if expected > 0:
+                ratios.setdefault(item, []).append(qty / expected)
+
+    return Inputs(
+        key=secrets.token_hex(8), start=start, days=request.weeks * 7,
+        rules=_overridden_rules(request), demand_state=demand_model.snapshot(),
+        calendar_state=holiday_calendar.snapshot(),
+        inventory=inventory, leftovers=leftovers, open_tasks=open_tasks,
+        weather_labels=labels, weather_transition=_weather_transition(history, labels),
+        ratios=ratios, safety_factor=request.safety_factor, K=request.K,
+        demand=request.demand, demand_cv=request.demand_cv,
+    )
+
+
+# =========================================================
+# 模擬（子行程）
+# =========================================================
+_installed: Optional[str] = None
+
+
+def _install(inputs: Inputs) -> None:
+    """把這次的品項目錄 / 工作日曆 / 需求模型裝進子行程（同一批輸入只裝一次）"""
+    global _installed
+    if _installed == inputs.key:
+        return
+    catalog.compile(inputs.rules)
+    demand_model.restore(inputs.demand_state)
+    holiday_calendar.restore(inputs.calendar_state)
+    _installed = inputs.key
+
+
+def _weather_path(inputs: Inputs, rng: np.random.Generator) -> List[str]:
+    labels, transition = inputs.weather_labels, np.asarray(inputs.weather_transition)
+    state = rng.integers(len(labels))
+    path = []
+    for _ in range(inputs.days + 1):
+        path.append(labels[state])
+        state = rng.choice(len(labels), p=transition[state])
+    return path
+
+
+def _noise(inputs: Inputs, items: List[str], rng: np.random.Generator) -> np.ndarray:
+    """每天 × 每個品項的需求倍數（一次抽完）"""
+    days = inputs.days
+    if inputs.demand_cv > 0:
+        sigma = np.sqrt(np.log1p(inputs.demand_cv ** 2))
+        noise = rng.lognormal(-sigma * sigma / 2, sigma, size=(days, len(items)))
+    else:
+        noise = np.ones((days, len(items)))
+    if inputs.demand == "history":
+        for j, item in enumerate(items):
+            ratios = inputs.ratios.get(item)
+            if ratios and len(ratios) >= MIN_HISTORY:
+                noise[:, j] = np.asarray(ratios)[rng.integers(len(ratios), size=days)]
+    return noise
+
+
+class _Plans:
+    """(日期類型, 天氣, 安全係數) → 提貨基準計畫 / 預期需求（組合很少，算一次就好）"""
+
+    def __init__(self):
+        self._base: Dict[Tuple, Dict[str, float]] = {}
+        self._expected: Dict[Tuple, Dict[str, float]] = {}
+
+    def base(self, dt, weather: str, safety: float) -> Dict[str, float]:
+        key = (dt, weather, safety)
+        plan = self._base.get(key)
+        if plan is None:
+            plan = self._base[key] = calc_base_delivery(dt, weather, safety)
+        return plan
+
+    def expected(self, dt, weather: str) -> Dict[str, float]:
+        key = (dt, weather)
+        out = self._expected.get(key)
+        if out is None:
+            out = self._expected[key] = {item: demand_model.expected(item, dt, weather)
+                                         for item in catalog.delivery_items}
+        return out
+
+
+def run_scenario(inputs: Inputs, rng: np.random.Generator, plans: Optional[_Plans] = None) -> Dict[str, Dict[str, float]]:
+    """一個情境，回傳 {item: {metric: 值}}"""
+    plans = plans or _Plans()
+    weather = _weather_path(inputs, rng)
+    items = list(catalog.delivery_items)
+    column = {item: j for j, item in enumerate(items)}
+    noise = _noise(inputs, items, rng).tolist()
+    stock = {item: qty for item, (qty, _) in inputs.inventory.items()}
+    danger = {item: level for item, (_, level) in inputs.inventory.items()}
+    leftovers = dict(inputs.leftovers)
+    tasks = [dict(t) for t in inputs.open_tasks]
+    out: Dict[str, List[float]] = {}
+
+    def row(item: str) -> List[float]:
+        r = out.get(item)
+        if r is None:
+            r = out[item] = [0.0] * len(METRICS)
+        return r
+
+    STOCKOUT, LOST, SHORT, DELIVERED, LEFTOVER, PRODUCED, TASKS = range(len(METRICS))
+    for i in range(inputs.days):
+        day = inputs.start + timedelta(days=i)
+        dt = weekday_to_datetype(day)
+        # 起始前就過期的未完成任務，第一天做
+        today_tasks = [t for t in tasks if t["day"] <= day]
+        task_items = {t["item"] for t in today_tasks}
+        expected = plans.expected(dt, weather[i])
+
+        # 早上：提貨（前一晚算的計畫，天氣預報 = 實際天氣）
+        plan = apply_leftover_deduction(plans.base(dt, weather[i], inputs.safety_factor), leftovers)
+        today_leftovers = dict(leftovers)
+        for item, qty in plan.items():
+            shown = catalog.delivery_qty(item, qty, task_items)
+            if shown is None:
+                # 今天不提貨的品項（例如魚肉只在做丸子的日子）：當天沒有需求
+                continue
+            r = row(item)
+            have = stock.get(item, 0.0)
+            if shown > have + EPS:
+                r[SHORT] += 1
+            taken = min(shown, have)
+            stock[item] = have - taken
+            r[DELIVERED] += taken
+
+            # 白天：賣
+            available = taken + leftovers.get(item, 0.0)
+            demand = expected.get(item, 0.0) * noise[i][column[item]]
+            if demand > available + EPS:
+                r[STOCKOUT] += 1
+                r[LOST] += demand - available
+            today_leftovers[item] = max(available - demand, 0.0)
+            r[LEFTOVER] += today_leftovers[item]
+        leftovers = today_leftovers
+
+        # 當天的任務完成（同 complete_task 的產出規則）
+        for task in today_tasks:
+            for item, qty in catalog.task_yield(task["item"], task["qty"]).items():
+                stock[item] = stock.get(item, 0.0) + qty
+                row(item)[PRODUCED] += qty
+            row(task["item"])[TASKS] += 1
+        if today_tasks:
+            tasks = [t for t in tasks if t["day"] > day]
+
+        # 晚上：排程（同 generate_schedule）
+        tomorrow_dt = weekday_to_datetype(day + timedelta(days=1))
+        ctx = planner.PlanningContext(
+            today=day,
+            inventory={item: (stock.get(item, 0.0), level) for item, level in danger.items()},
+            leftovers=leftovers,
+            open_tasks=[(t["day"], t["item"]) for t in tasks],
+        )
+        tasks += [{"day": r["day"], "item": r["item"], "qty": r["qty"]}
+                  for r in plan_tasks(ctx, plans.base(tomorrow_dt, weather[i + 1], 1.0), weather[i + 1],
+                                      tomorrow_dt, K=inputs.K)]
+    return {item: dict(zip(METRICS, values)) for item, values in out.items()}
+
+
+def run_chunk(inputs: Inputs, seeds: List[np.random.SeedSequence]) -> List[Dict[str, Dict[str, float]]]:
+    _install(inputs)
+    plans = _Plans()
+    return [run_scenario(inputs, np.random.default_rng(seed), plans) for seed in seeds]
+
+
+# =========================================================
+# 彙總
+# =========================================================
+def summarize(results: List[Dict[str, Dict[str, float]]], weeks: int) -> Dict:
+    items = sorted({item for r in results for item in r})
+    out: Dict[str, Dict] = {}
+    for item in items:
+        rows = [r.get(item) or dict.fromkeys(METRICS, 0.0) for r in results]
+        summary = {}
+        for metric in METRICS:
+            values = np.array([row[metric] for row in rows])
+            summary[metric] = {"mean": round(float(values.mean()), 3),
+                               "p10": round(float(np.percentile(values, 10)), 3),
+                               "p50": round(float(np.percentile(values, 50)), 3),
+                               "p90": round(float(np.percentile(values, 90)), 3)}
+        delivered = np.array([row["delivered"] for row in rows])
+        leftover = np.array([row["leftover"] for row in rows])
+        summary["waste_ratio"] = round(float(leftover.sum() / delivered.sum()), 4) if delivered.sum() > 0 else None
+        summary["tasks_per_week"] = round(summary["tasks"]["mean"] / weeks, 3)
+        out[item] = summary
+    return out
+
+
+# =========================================================
+# 執行
+# =========================================================
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def pool() -> ProcessPoolExecutor:
+    # spawn：不從服務中的行程 fork（連線池 / 事件迴圈 / thread 不會被複製過去）
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def shutdown() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def run(inputs: Inputs, scenarios: int, seed: Optional[int] = None) -> Dict:
+    started = time.perf_counter()
+    seeds = np.random.SeedSequence(seed).spawn(scenarios)
+    size = max(1, min(CHUNK_SIZE, -(-scenarios // WORKERS)))
+    loop = asyncio.get_running_loop()
+    chunks = await asyncio.gather(*(loop.run_in_executor(pool(), run_chunk, inputs, seeds[k:k + size])
+                                    for k in range(0, scenarios, size)))
+    results = [r for chunk in chunks for r in chunk]
+    weeks = inputs.days // 7
+    return {
+        "scenarios": scenarios,
+        "weeks": weeks,
+        "start": inputs.start.isoformat(),
+        "seed": seed,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        "items": summarize(results, weeks),
+    }
+
+
+def check_size(request: SimulationRequest) -> None:
+    if request.scenarios * request.weeks > MAX_WORK:
+        raise ValueError(f"scenarios × weeks 最多 {MAX_WORK}")
+
+
+async def simulate(request: SimulationRequest) -> Dict:
+    async with SessionLocal() as s:
+        inputs = await load_inputs(s, request)
+    return {"policy": request.model_dump(mode="json", exclude={"scenarios", "weeks", "seed", "start"}),
+            **await run(inputs, request.scenarios, request.seed)}
+
+
+# =========================================================
+# 背景工作（POST /simulations）
+# =========================================================
+_running: set = set()
+_slots = asyncio.Semaphore(1)   # 同一個行程一次跑一個（已經用滿所有 CPU）
+
+
+async def submit(request: SimulationRequest) -> str:
+    job_id = secrets.token_hex(8)
+    async with SessionLocal() as s:
+        s.add(SimulationJob(id=job_id, status="queued", params=request.model_dump_json(),
+                            created_at=datetime.utcnow()))
+        await s.commit()
+    task = asyncio.ensure_future(_run_job(job_id, request))
+    _running.add(task)
+    task.add_done_callback(_running.discard)
+    return job_id
+
+
+async def _finish(job_id: str, **values) -> None:
+    for attempt in range(FINISH_ATTEMPTS):
+        try:
+            async with SessionLocal() as s:
+                await s.execute(update(SimulationJob).where(SimulationJob.id == job_id).values(**values))
+                await s.commit()
+            return
+        except OperationalError:
+            if attempt == FINISH_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(FINISH_RETRY_SECONDS * 2 ** attempt)
+
+
+async def _run_job(job_id: str, request: SimulationRequest) -> None:
+    async with _slots:
+        try:
+            await _finish(job_id, status="running")
+            try:
+                result = await simulate(request)
+            except Exception as e:
+                logger.exception("simulation %s failed", job_id)
+                metrics.BACKGROUND_ERRORS.inc(task="simulation")
+                await _finish(job_id, status="failed", error=str(e), finished_at=datetime.utcnow())
+                return
+            await _finish(job_id, status="done", result=json.dumps(result, ensure_ascii=False),
+                          finished_at=datetime.utcnow())
+        except Exception:
+            # 狀態寫不進去（重試也失敗）：工作會一直停在 queued / running，下次啟動時由 fail_interrupted 標成失敗
+            logger.exception("simulation %s: cannot update job status", job_id)
+            metrics.BACKGROUND_ERRORS.inc(task="simulation")
+
+
+async def fail_interrupted(session) -> int:
+    """啟動時：上次行程結束時還沒跑完的工作（queued / running）不會再有人跑，標成失敗"""
+    result = await session.execute(
+        update(SimulationJob).where(SimulationJob.status.in_(("queued", "running")))
+        .values(status="failed", error="服務重新啟動，工作中斷", finished_at=datetime.utcnow()))
+    return result.rowcount
+
+
+async def get_job(session, job_id: str) -> Optional[Dict]:
+    job = await session.get(SimulationJob, job_id)
+    if job is None:
+        return None
+    return {
+        "id": job.id, "status": job.status, "params": json.loads(job.params),
+        "result": json.loads(job.result) if job.result else None, "error": job.error,
+        "created_at": job.created_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+# =========================================================
+# CLI
+# =========================================================
+def _pairs(values: Sequence[str]) -> Dict[str, str]:
+    out = {}
+    for value in values:
+        key, sep, v = value.partition("=")
+        if not sep:
+            raise SystemExit(f"格式是 品項=值：{value}")
+        out[key] = v
+    return out
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="庫存策略的 Monte Carlo 模擬（讀 DATABASE_URL 的目前狀態）")
+    p.add_argument("--weeks", type=int, default=8)
+    p.add_argument("--scenarios", type=int, default=1000)
+    p.add_argument("--seed", type=int, default=None)
+    p.add_argument("--start", type=date.fromisoformat, default=None, help="第一天（預設明天）")
+    p.add_argument("--safety-factor", type=float, default=1.0)
+    p.add_argument("--K", type=float, default=5.0, help="compute_intensity 的 K")
+    p.add_argument("--danger", action="append", default=[], metavar="品項=量", help="覆蓋危險量（可重複）")
+    p.add_argument("--levels", action="append", default=[], metavar="品項=JSON",
+                   help='覆蓋工作批量，例如 魚肚=[[0.6,"魚肚6",6],[0,"魚肚3",3]]')
+    p.add_argument("--demand", choices=("model", "history"), default="model")
+    p.add_argument("--demand-cv", type=float, default=0.25)
+    p.add_argument("--json", default=None, help="結果另存 JSON")
+    return p.parse_args(argv)
+
+
+async def main(args) -> int:
+    request = SimulationRequest(
+        weeks=args.weeks, scenarios=args.scenarios, seed=args.seed, start=args.start,
+        safety_factor=args.safety_factor, K=args.K,
+        danger_levels={k: float(v) for k, v in _pairs(args.danger).items()},
+        task_levels={k: json.loads(v) for k, v in _pairs(args.levels).items()},
+        demand=args.demand, demand_cv=args.demand_cv,
+    )
+    try:
+        result = await simulate(request)
+    finally:
+        shutdown()
+    print(f"{result['scenarios']} scenarios × {result['weeks']} weeks in {result['elapsed_ms']} ms")
+    print(f"{'item':<8}{'stockout d':>12}{'p90':>8}{'short d':>10}{'lost':>10}{'leftover':>10}"
+          f"{'waste':>8}{'produced':>10}{'tasks/wk':>10}")
+    for item, m in result["items"].items():
+        waste = "-" if m["waste_ratio"] is None else f"{m['waste_ratio']:.1%}"
+        print(f"{item:<8}{m['stockout_days']['mean']:>12.2f}{m['stockout_days']['p90']:>8.1f}"
+              f"{m['kitchen_short_days']['mean']:>10.2f}{m['lost_sales']['mean']:>10.2f}"
+              f"{m['leftover']['mean']:>10.2f}{waste:>8}{m['produced']['mean']:>10.2f}{m['tasks_per_week']:>10.2f}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(main(parse_args())))
@@ -0,0 +1,111 @@
+# stock.py
+"""
+庫存的原子異動：
+  - 加減量在資料庫內用單一 UPDATE 完成（qty = max(qty + delta, 0)），不在 Python 讀改寫
+  - 每次寫入 version + 1，可用 expected_versions 做樂觀鎖
+  - 數量異動同時寫入異動帳（ledger.py）
+  - 寫入後的整列（RETURNING）送到變更通知（events.py）與變更紀錄（changelog.py）
+"""
+from typing import Dict, Optional
+
+from sqlalchemy import case, update
+
+from db import Inventory, bulk_upsert, greatest, dialect_insert
+import changelog
+import events
+import ledger
+
+# 寫入後取回的欄位（變更通知 / 同步都送整列）
+ROW = (Inventory.item, Inventory.qty, Inventory.danger_level, Inventory.version)
+
+
+class StockConflict(Exception):
+    """樂觀鎖失敗：呼叫端看到的版本已經被別人改過"""
+
+    def __init__(self, items):
+        self.items = sorted(items)
+        super().__init__(f"version conflict on {', '.join(self.items)}")
+
+
+async def ensure_items(session, items) -> None:
+    """沒有的品項先補一列 qty=0（已存在就什麼都不做）"""
+    items = list(dict.fromkeys(items))
+    if not items:
+        return
+    stmt = dialect_insert(session)(Inventory).on_conflict_do_nothing(index_elements=["item"])
+    await session.execute(stmt, [{"item": item, "qty": 0.0} for item in items])
+
+
+async def adjust_stock(session, deltas: Dict[str, float], kind: str, ref: Optional[str] = None) -> Dict[str, dict]:
+    """
+    原子加減庫存（結果不得為負），回傳寫入後的列 {item: {"qty", "danger_level", "version"}}
+    全部品項合成一句 UPDATE ... CASE item WHEN ... RETURNING
+    """
+    deltas = {item: float(d) for item, d in deltas.items()}
+    if not deltas:
+        return {}
+    await ensure_items(session, deltas)
+    delta_expr = case(deltas, value=Inventory.item, else_=0.0)
+    rows = (await session.execute(
+        update(Inventory)
+        .where(Inventory.item.in_(deltas))
+        .values(qty=greatest(session, Inventory.qty + delta_expr, 0.0), version=Inventory.version + 1)
+        .returning(*ROW)
+        .execution_options(synchronize_session=False)
+    )).all()
+    await ledger.record(session, kind, {r.item: (deltas[r.item], r.qty) for r in rows}, ref)
+    return emit_inventory(session, rows)
+
+
+async def set_stock(session, values: Dict[str, float],
+              expected_versions: Optional[Dict[str, int]] = None,
+              kind: str = ledger.STOCKTAKE, ref: Optional[str] = None) -> Dict[str, dict]:
+    """
+    盤點：直接設定庫存量（不得為負），回傳寫入後的列 {item: {"qty", "danger_level", "version"}}
+    expected_versions 有給的品項，版本不同就整批失敗（StockConflict）
+    """
+    expected_versions = expected_versions or {}
+    plain = [{"item": item, "qty": max(float(qty), 0.0)}
+             for item, qty in values.items() if item not in expected_versions]
+    checked = [{"item": item, "qty": max(float(qty), 0.0), "version": int(expected_versions[item])}
+               for item, qty in values.items() if item in expected_versions]
+
+    written = await bulk_upsert(session, Inventory, plain, conflict_cols=["item"],
+                                set_=lambda c, excluded: {"qty": excluded.qty, "version": c.version + 1},
+                                returning=ROW)
+
+    if checked:
+        stmt = dialect_insert(session)(Inventory)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["item"],
+            set_={"qty": stmt.excluded.qty, "version": Inventory.version + 1},
+            where=Inventory.version == stmt.excluded.version,
+        ).returning(*ROW)
+        written_checked = (await session.execute(stmt, checked)).all()
+        lost = {r["item"] for r in checked} - {r.item for r in written_checked}
+        if lost:
+            raise StockConflict(lost)
+        written += written_checked
+
+    await ledger.record(session, kind, {r["item"]: (None, r["qty"]) for r in plain + checked}, ref)
+    return emit_inventory(session, written)
+
+
+async def set_danger_levels(session, levels: Dict[str, float]) -> Dict[str, dict]:
+    """設定危險量，回傳寫入後的列 {item: {"qty", "danger_level", "version"}}"""
+    written = await bulk_upsert(session, Inventory,
+                                [{"item": item, "qty": 0.0, "danger_level": float(d)} for item, d in levels.items()],
+                                conflict_cols=["item"],
+                                set_=lambda c, excluded: {"danger_level": excluded.danger_level,
+                                                          "version": c.version + 1},
+                                returning=ROW)
+    return emit_inventory(session, written)
+
+
+def emit_inventory(session, rows) -> Dict[str, dict]:
+    """RETURNING 的列 → {item: {qty, danger_level, version}}，送變更通知並記進變更紀錄"""
+    items = {r.item: {"qty": r.qty, "danger_level": r.danger_level, "version": r.version} for r in rows}
+    if items:
+        events.emit(session, events.INVENTORY, {"items": items})
+        changelog.record(session, changelog.INVENTORY, items)
+    return items
@@ -0,0 +1,129 @@
+# sync.py
+"""
+離線裝置上傳的操作紀錄（POST /sync/push）：
+  - 每個操作帶裝置自己的 op_id：同一個裝置重送同一個 op_id 不會再執行（回傳第一次的結果）
+  - base：裝置做這個操作時看到的游標；操作會動到的列在 base 之後被別人改過 → conflict，不套用
+    （force=true 則照樣套用，後寫的贏）
+  - 每個操作各自一個 SAVEPOINT：失敗 / 衝突只影響自己，其他操作照常套用，整批一次 commit
+    （args 格式錯也一樣：該操作回 error 422，不會讓整批 push 失敗）
+  - 只接受 TARGETS 裡列得出「會動到哪些列」的操作，其他的回 error（無法判斷衝突）
+"""
+import json
+from datetime import date, datetime
+from typing import Callable, Dict, List, Tuple
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError
+
+from db import IdempotencyKey, begin_write, savepoint
+import changelog
+import idempotency
+import services
+
+ENDPOINT = "sync"
+
+
+def _day_key(day, item) -> str:
+    """與 change_log 相同的 day|item 鍵；日期格式錯的原樣留著，交給操作本身驗證"""
+    try:
+        return changelog.day_key(date.fromisoformat(str(day)[:10]), item)
+    except ValueError:
+        return f"{day}|{item}"
+
+
+def _task(args: dict) -> List[Tuple[str, str]]:
+    return [(changelog.SCHEDULE_TASKS, str(args["task_id"]))] if args.get("task_id") is not None else []
+
+
+def _rows(table: str, rows) -> List[Tuple[str, str]]:
+    return [(table, _day_key(r.get("day"), r.get("item"))) for r in rows or [] if isinstance(r, dict)]
+
+
+# 操作會動到的列（(table, key)），衝突偵測用；不在表裡的操作不能離線同步
+TARGETS: Dict[str, Callable[[dict], List[Tuple[str, str]]]] = {
+    "update_inventory": lambda args: [(changelog.INVENTORY, item) for item in (args.get("updates") or {})],
+    "update_danger_levels": lambda args: [(changelog.INVENTORY, item) for item in args],
+    "upsert_leftovers": lambda args: [(changelog.LEFTOVERS, _day_key(args.get("day"), item))
+                                      for item in (args.get("leftovers") or {})],
+    "confirm_delivery": lambda args: (
+        [(changelog.DELIVERY_PLANS, _day_key(args.get("day"), item)) for item in (args.get("items") or {})]
+        + [(changelog.INVENTORY, item) for item in (args.get("items") or {})]),
+    "bulk_import": lambda args: (
+        [(changelog.INVENTORY, r.get("item")) for r in args.get("inventory") or [] if isinstance(r, dict)]
+        + _rows(changelog.LEFTOVERS, args.get("leftovers"))
+        + _rows(changelog.DELIVERY_PLANS, args.get("delivery_plans"))),
+    "complete_task": _task,
+    "delete_task": _task,
+    "move_task": _task,
+    "update_task_qty": _task,
+}
+
+
+def targets(op: str, args: dict) -> List[Tuple[str, str]]:
+    """操作會動到的列（(table, key)），衝突偵測用"""
+    return TARGETS[op](args)
+
+
+def _key(device: str, op_id: str) -> str:
+    return f"{ENDPOINT}:{device}:{op_id}"
+
+
+async def apply_operations(session, device: str, operations) -> List[Dict]:
+    """依序套用，回傳每個操作的 {op_id, status, ...}；status：applied / duplicate / conflict / error"""
+    # 自己這個交易的變更 commit 前才寫進 change_log，衝突判斷不會看到；SQLite 要在第一個 SAVEPOINT 前開好交易
+    await begin_write(session)
+    results = []
+    for operation in operations:
+        entry = {"op_id": operation.op_id, "op": operation.op}
+        key = _key(device, operation.op_id)
+        done = await session.get(IdempotencyKey, key)
+        if done is not None and await idempotency.drop_if_expired(session, done):
+            done = None
+        if done is not None and done.response is not None:
+            results.append({**entry, "status": "duplicate", "result": json.loads(done.response)})
+            continue
+        if operation.op not in services.OPERATIONS:
+            results.append({**entry, "status": "error", "status_code": 400, "detail": "不支援的操作"})
+            continue
+        if operation.op not in TARGETS:
+            # 不知道會動到哪些列就無法判斷衝突，不能當離線操作套用
+            results.append({**entry, "status": "error", "status_code": 400, "detail": "不支援離線同步"})
+            continue
+
+        try:
+            touched = targets(operation.op, operation.args)
+        except (AttributeError, TypeError, ValueError) as e:
+            results.append({**entry, "status": "error", "status_code": 422, "detail": f"args 格式錯誤：{e}"})
+            continue
+        if operation.base is not None and not operation.force:
+            conflicts = await changelog.changed_since(session, operation.base, touched)
+            if conflicts:
+                results.append({**entry, "status": "conflict",
+                                "conflicts": [{"table": t, "key": k} for t, k in conflicts]})
+                continue
+
+        try:
+            async with savepoint(session):
+                result = await services.OPERATIONS[operation.op](session, operation.args)
+                session.add(IdempotencyKey(key=key, endpoint=ENDPOINT, created_at=datetime.utcnow(),
+                                           response=json.dumps(result, ensure_ascii=False, default=str)))
+                await session.flush()
+        except HTTPException as e:
+            results.append({**entry, "status": "error", "status_code": e.status_code, "detail": e.detail})
+            continue
+        except ValidationError as e:
+            results.append({**entry, "status": "error", "status_code": 422,
+                            "detail": jsonable_encoder(e.errors(include_url=False))})
+            continue
+        except (TypeError, ValueError) as e:
+            # 操作本身沒驗證到的格式錯：一樣只算這個操作失敗，不要讓整批 push 一直重送失敗
+            results.append({**entry, "status": "error", "status_code": 422, "detail": f"args 格式錯誤：{e}"})
+            continue
+        except IntegrityError:
+            # 同一個 op_id 正由另一個連線送進來（重送）
+            results.append({**entry, "status": "duplicate"})
+            continue
+        results.append({**entry, "status": "applied", "result": result})
+    return results
@@ -0,0 +1,42 @@
+# conftest.py
+"""
+單元測試：純函式不連資料庫；要資料庫的用 database fixture（每個測試一個新的 SQLite 檔）
+db.py import 時就要 DATABASE_URL（不會連線），沒設定的話給一個記憶體 SQLite
+"""
+import asyncio
+import os
+import sys
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+from catalog import DEFAULT_RULES, catalog, row_values, rule_from_row
+from db import ProductRule, SessionLocal
+
+
+@pytest.fixture(autouse=True)
+def default_catalog():
+    """每個測試都用預設的品項規則（DEFAULT_RULES）"""
+    catalog.compile([rule_from_row(ProductRule(**row_values(r, i))) for i, r in enumerate(DEFAULT_RULES)])
+    yield catalog
+
+
+@pytest.fixture
+def database(tmp_path):
+    """
+    新的 SQLite 檔、跑完 migration，SessionLocal 暫時綁到它（services 等模組都從 db import 同一個物件）
+    NullPool：每個測試用 asyncio.run 開自己的事件迴圈，連線不跨迴圈重用
+    """
+    import migrations
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}", poolclass=NullPool)
+    bind = SessionLocal.kw["bind"]
+    SessionLocal.configure(bind=engine)
+    asyncio.run(migrations.migrate())
+    yield SessionLocal
+    SessionLocal.configure(bind=bind)
+    asyncio.run(engine.dispose())
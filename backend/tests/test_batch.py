@@ -0,0 +1,48 @@
+# test_batch.py
+"""POST /batch：args 格式錯的操作回 422（帶 index / op），整批不生效"""
+import asyncio
+
+import httpx
+from sqlalchemy import select
+
+from app import app
+from db import Inventory
+
+
+def post(path, body):
+    async def go():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await client.post(path, json=body)
+    return asyncio.run(go())
+
+
+def danger_level(database, item):
+    async def go():
+        async with database() as s:
+            return await s.scalar(select(Inventory.danger_level).where(Inventory.item == item))
+    return asyncio.run(go())
+
+
+def test_bad_danger_level_is_422_and_rolls_back(database):
+    before = danger_level(database, "魚皮")
+    r = post("/batch", {"include_state": False, "operations": [
+        {"op": "update_danger_levels", "args": {"魚皮": before + 1}},
+        {"op": "update_danger_levels", "args": {"魚肚": "abc"}}]})
+    assert r.status_code == 422
+    assert r.json()["detail"]["index"] == 1
+    assert r.json()["detail"]["op"] == "update_danger_levels"
+    assert danger_level(database, "魚皮") == before
+
+
+def test_bad_task_id_is_422(database):
+    for args in ({"task_id": "zz"}, {}, {"task_id": None}):
+        r = post("/batch", {"include_state": False, "operations": [{"op": "complete_task", "args": args}]})
+        assert r.status_code == 422, args
+        assert r.json()["detail"]["op"] == "complete_task"
+
+
+def test_numeric_strings_are_still_accepted(database):
+    r = post("/batch", {"include_state": False, "operations": [
+        {"op": "update_danger_levels", "args": {"魚肚": "2.5"}}]})
+    assert r.status_code == 200
+    assert danger_level(database, "魚肚") == 2.5
@@ -0,0 +1,134 @@
+# test_demand.py
+"""需求模型：收縮估計的係數、增量更新（觀測值修正時扣回舊值）、commit 後才套用到記憶體"""
+import asyncio
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import select
+
+from db import DeliveryPlan, DemandObservation, DemandStat, Leftover
+from demand import DemandModel
+
+DAY = date(2026, 10, 20)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def model(**kw) -> DemandModel:
+    return DemandModel(average={"魚肚": 10.0}, date_weight={"weekday": 1.0, "holiday": 2.0},
+                       weather_weight={"sunny": 1.0, "rain": 0.5}, date_type_of=lambda d: "weekday", **kw)
+
+
+# =========================================================
+# 係數（純記憶體）
+# =========================================================
+def test_prior_without_observations():
+    m = model()
+    assert m.expected("魚肚", "holiday", "rain") == 10.0 * 2.0 * 0.5
+    assert m.expected("沒這個", "weekday", "sunny") == 0.0
+
+
+def test_observations_shrink_towards_prior():
+    m = model(prior_weight=7)
+    m.restore({"average": {"魚肚": 10.0}, "stats": {("魚肚", "weekday", "sunny"): [7, 140.0, 2800.0]}})
+    # 水準 = (7×10 + 140) / 14 = 15；係數 = (7×15×1 + 140) / 14 = 17.5
+    assert m.expected("魚肚", "weekday", "sunny") == pytest.approx(17.5)
+    # 雨天沒有觀測：用水準 × 天氣權重
+    assert m.expected("魚肚", "weekday", "rain") == pytest.approx(15 * 0.5)
+
+
+def test_apply_invalidates_only_touched_cells():
+    m = model()
+    m.version = 3
+    before = m.expected("魚肚", "weekday", "sunny")
+    holiday = m.expected("魚肚", "holiday", "sunny")
+    m._apply({("魚肚", "weekday", "sunny"): [1, 30.0, 900.0]}, 4)
+    assert m.version == 4
+    assert m.expected("魚肚", "weekday", "sunny") > before
+    assert m.expected("魚肚", "holiday", "sunny") == holiday
+
+
+def test_apply_skipping_a_version_leaves_reload_to_refresh():
+    m = model()
+    m.version = 3
+    m._apply({("魚肚", "weekday", "sunny"): [1, 30.0, 900.0]}, 5)
+    assert m.version == 3
+
+
+# =========================================================
+# 增量更新（資料庫）
+# =========================================================
+async def write(s, plans=(), leftovers=()):
+    for day, qty, weather in plans:
+        s.add(DeliveryPlan(day=day, item="魚肚", planned_qty=qty, confirmed=True, weather=weather))
+    for day, qty in leftovers:
+        row = await s.scalar(select(Leftover).where(Leftover.day == day, Leftover.item == "魚肚"))
+        if row is None:
+            s.add(Leftover(day=day, item="魚肚", qty=qty))
+        else:
+            row.qty = qty
+    await s.flush()
+
+
+async def cells(s):
+    return {(r.item, r.date_type, r.weather): (r.n, r.total) for r in (await s.scalars(select(DemandStat))).all()}
+
+
+def test_observation_is_delivery_plus_previous_leftover_minus_leftover(database):
+    async def go():
+        m = model()
+        async with database() as s:
+            await m.load(s)
+            await write(s, plans=[(DAY, 10.0, "sunny")], leftovers=[(DAY - timedelta(days=1), 2.0), (DAY, 3.0)])
+            assert await m.observe_days(s, [DAY]) == 1
+            await s.commit()
+        async with database() as s:
+            assert (await s.scalar(select(DemandObservation.qty))) == 9.0
+            assert (await cells(s))[("魚肚", "weekday", "sunny")] == (1, 9.0)
+        # commit 後記憶體也加上同樣的差額
+        assert m.snapshot()["stats"][("魚肚", "weekday", "sunny")] == [1, 9.0, 81.0]
+    run(go())
+
+
+def test_day_without_leftovers_is_not_observed(database):
+    async def go():
+        m = model()
+        async with database() as s:
+            await m.load(s)
+            await write(s, plans=[(DAY, 10.0, "sunny")])
+            assert await m.observe_days(s, [DAY]) == 0
+    run(go())
+
+
+def test_corrected_leftover_replaces_old_observation(database):
+    async def go():
+        m = model()
+        async with database() as s:
+            await m.load(s)
+            await write(s, plans=[(DAY, 10.0, "rain")], leftovers=[(DAY, 3.0)])
+            await m.observe_days(s, [DAY])
+            await s.commit()
+        async with database() as s:
+            await write(s, leftovers=[(DAY, 1.0)])
+            assert await m.observe_days(s, [DAY]) == 1
+            # 沒改到的日子再算一次：沒有差異
+            assert await m.observe_days(s, [DAY]) == 0
+            await s.commit()
+        async with database() as s:
+            assert (await cells(s))[("魚肚", "weekday", "rain")] == (1, 9.0)
+        assert m.snapshot()["stats"][("魚肚", "weekday", "rain")] == [1, 9.0, 81.0]
+    run(go())
+
+
+def test_rolled_back_update_does_not_touch_memory(database):
+    async def go():
+        m = model()
+        async with database() as s:
+            await m.load(s)
+            await write(s, plans=[(DAY, 10.0, "sunny")], leftovers=[(DAY, 3.0)])
+            await m.observe_days(s, [DAY])
+            await s.rollback()
+        assert m.snapshot()["stats"] == {}
+    run(go())
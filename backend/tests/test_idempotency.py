@@ -0,0 +1,102 @@
+# test_idempotency.py
+"""Idempotency-Key：重送回傳第一次的結果、換端點 422、過期的 key 當作新的"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import select, update
+
+from db import IdempotencyKey
+import idempotency
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def first_call(database, key, endpoint, result):
+    async with database() as s:
+        assert await idempotency.begin(s, key, endpoint) is None
+        await idempotency.finish(s, key, result)
+        await s.commit()
+
+
+async def age(database, key, delta):
+    async with database() as s:
+        await s.execute(update(IdempotencyKey).where(IdempotencyKey.key == key)
+                        .values(created_at=datetime.utcnow() - delta))
+        await s.commit()
+
+
+def test_replay_returns_stored_result(database):
+    async def go():
+        await first_call(database, "k1", "batch", {"ok": 1})
+        async with database() as s:
+            assert await idempotency.begin(s, "k1", "batch") == {"ok": 1}
+    run(go())
+
+
+def test_no_key_always_runs(database):
+    async def go():
+        async with database() as s:
+            assert await idempotency.begin(s, None, "batch") is None
+            assert await idempotency.begin(s, "", "batch") is None
+    run(go())
+
+
+def test_key_reused_for_another_endpoint_is_rejected(database):
+    async def go():
+        await first_call(database, "k1", "batch", {"ok": 1})
+        async with database() as s:
+            with pytest.raises(HTTPException) as e:
+                await idempotency.begin(s, "k1", "delivery/confirm")
+            assert e.value.status_code == 422
+    run(go())
+
+
+def test_unfinished_key_is_in_progress(database):
+    async def go():
+        async with database() as s:
+            assert await idempotency.begin(s, "k1", "batch") is None
+            await s.commit()                 # 沒有 finish：模擬還在處理中
+        async with database() as s:
+            with pytest.raises(HTTPException) as e:
+                await idempotency.begin(s, "k1", "batch")
+            assert e.value.status_code == 409
+    run(go())
+
+
+def test_expired_key_runs_again(database):
+    async def go():
+        await first_call(database, "k1", "batch", {"ok": 1})
+        await age(database, "k1", idempotency.KEY_TTL + timedelta(minutes=1))
+        async with database() as s:
+            assert await idempotency.begin(s, "k1", "delivery/confirm") is None
+            await idempotency.finish(s, "k1", {"ok": 2})
+            await s.commit()
+        async with database() as s:
+            assert await idempotency.begin(s, "k1", "delivery/confirm") == {"ok": 2}
+    run(go())
+
+
+def test_key_just_inside_ttl_still_replays(database):
+    async def go():
+        await first_call(database, "k1", "batch", {"ok": 1})
+        await age(database, "k1", idempotency.KEY_TTL - timedelta(minutes=1))
+        async with database() as s:
+            assert await idempotency.begin(s, "k1", "batch") == {"ok": 1}
+    run(go())
+
+
+def test_purge_expired_removes_only_old_keys(database):
+    async def go():
+        await first_call(database, "old", "batch", {})
+        await first_call(database, "new", "batch", {})
+        await age(database, "old", idempotency.KEY_TTL + timedelta(seconds=1))
+        async with database() as s:
+            assert await idempotency.purge_expired(s) == 1
+            await s.commit()
+        async with database() as s:
+            assert (await s.scalars(select(IdempotencyKey.key))).all() == ["new"]
+    run(go())
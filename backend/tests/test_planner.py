@@ -0,0 +1,102 @@
+# test_planner.py
+"""planner 的純函式：allocate（分配日子）、low_items（低庫存 → 要排的品項）"""
+from datetime import date, timedelta
+
+from models import DateType
+from planner import PlanningContext, TaskRequest, allocate, low_items
+
+MONDAY = date(2026, 10, 19)
+
+
+def week(*types: DateType):
+    """從 MONDAY 起連續幾天，各自的日期類型"""
+    return [(MONDAY + timedelta(days=i), t) for i, t in enumerate(types)]
+
+
+def req(item: str) -> TaskRequest:
+    return TaskRequest(item=item, task=f"製作 {item}", qty=1.0)
+
+
+def placed(rows):
+    return {row["item"]: row["day"] for row in rows}
+
+
+# =========================================================
+# allocate
+# =========================================================
+def test_skips_holidays_and_restdays():
+    days = week(DateType.holiday, DateType.restday, DateType.weekday)
+    assert placed(allocate([req("粉蒸")], [], days)) == {"粉蒸": MONDAY + timedelta(days=2)}
+
+
+def test_nothing_placed_when_every_day_is_off():
+    days = week(DateType.holiday, DateType.restday)
+    assert allocate([req("粉蒸"), req("魚肚")], [], days) == []
+
+
+def test_one_heavy_task_per_day():
+    days = week(DateType.weekday, DateType.weekday, DateType.weekday)
+    rows = allocate([req("粉蒸"), req("肉燥"), req("魚皮")], [], days)
+    assert placed(rows) == {"粉蒸": MONDAY, "肉燥": MONDAY + timedelta(days=1), "魚皮": MONDAY + timedelta(days=2)}
+
+
+def test_heavy_task_shares_a_day_with_light_tasks():
+    days = week(DateType.weekday, DateType.weekday)
+    # 魚肚（非繁重）先佔了週一，繁重的粉蒸照樣可以排週一
+    assert placed(allocate([req("魚肚"), req("粉蒸")], [], days)) == {"魚肚": MONDAY, "粉蒸": MONDAY}
+
+
+def test_light_task_needs_an_empty_day():
+    days = week(DateType.weekday, DateType.weekday, DateType.weekday)
+    open_tasks = [(MONDAY, "粉蒸")]
+    rows = allocate([req("魚肚"), req("魚肉")], open_tasks, days)
+    # 週一已有工作；兩件非繁重工作也不能同一天
+    assert placed(rows) == {"魚肚": MONDAY + timedelta(days=1), "魚肉": MONDAY + timedelta(days=2)}
+
+
+def test_task_is_dropped_when_no_day_fits():
+    days = week(DateType.weekday)
+    rows = allocate([req("粉蒸"), req("肉燥")], [], days)
+    assert placed(rows) == {"粉蒸": MONDAY}
+
+
+def test_open_task_locks_its_item():
+    days = week(DateType.weekday, DateType.weekday)
+    # 已有未完成的粉蒸（即使排在範圍外的日子）→ 不再建新的
+    open_tasks = [(MONDAY + timedelta(days=10), "粉蒸")]
+    assert allocate([req("粉蒸"), req("肉燥")], open_tasks, days) == [
+        {"day": MONDAY, "task": "製作 肉燥", "item": "肉燥", "qty": 1.0, "done": False}]
+
+
+def test_open_tasks_occupy_their_days():
+    days = week(DateType.weekday, DateType.weekday)
+    assert placed(allocate([req("肉燥")], [(MONDAY, "粉蒸")], days)) == {"肉燥": MONDAY + timedelta(days=1)}
+
+
+# =========================================================
+# low_items
+# =========================================================
+def ctx(**inventory) -> PlanningContext:
+    """inventory：品項=(qty, danger_level)"""
+    return PlanningContext(today=MONDAY, inventory=inventory, leftovers={})
+
+
+def test_only_items_below_danger_level():
+    assert low_items(ctx(粉蒸=(1.0, 5.0), 肉燥=(5.0, 5.0), 燕餃=(9.0, 5.0))) == ["粉蒸"]
+
+
+def test_fish_skin_shortage_restocks_fish_meat():
+    assert sorted(low_items(ctx(魚皮=(1.0, 5.0), 魚肉=(9.0, 5.0)))) == ["魚皮", "魚肉"]
+
+
+def test_restock_item_is_not_added_twice():
+    assert sorted(low_items(ctx(魚皮=(1.0, 5.0), 魚肉=(1.0, 5.0)))) == ["魚皮", "魚肉"]
+
+
+def test_merge_group_members_become_the_merged_item():
+    low = low_items(ctx(Q腸=(1.0, 5.0), 豬腸=(0.0, 5.0), 蝦丸=(1.0, 5.0), 肉丸=(9.0, 5.0)))
+    assert sorted(low) == sorted(["腸子", "蝦肉丸"])
+
+
+def test_merge_group_untouched_when_no_member_is_low():
+    assert low_items(ctx(Q腸=(9.0, 5.0), 豬腸=(9.0, 5.0), 粉蒸=(1.0, 5.0))) == ["粉蒸"]
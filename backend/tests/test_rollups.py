@@ -0,0 +1,83 @@
+# test_rollups.py
+"""usage_rollups：upsert 時以 prev_* 算差額，重寫同一列只加差額；rebuild 要算出同樣的結果"""
+import asyncio
+from datetime import date
+
+from sqlalchemy import select
+
+from db import UsageRollup
+import rollups
+
+DAY = date(2020, 3, 4)        # 週三
+ITEM = "測試魚"
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def write(database, fn, rows):
+    async with database() as s:
+        await fn(s, rows)
+        await s.commit()
+
+
+async def figures(database):
+    """{grain: (delivered, leftover)}（ITEM 在 DAY 所在期間）"""
+    async with database() as s:
+        rows = (await s.execute(
+            select(UsageRollup.grain, UsageRollup.period, UsageRollup.delivered, UsageRollup.leftover)
+            .where(UsageRollup.item == ITEM))).all()
+    return {g: (d, l) for g, p, d, l in rows if p == rollups.period_start(g, DAY)}
+
+
+def plan(qty, confirmed, day=DAY):
+    return {"day": day, "item": ITEM, "planned_qty": qty, "confirmed": confirmed, "weather": "sunny"}
+
+
+def test_rewriting_leftovers_adds_only_the_difference(database):
+    async def go():
+        await write(database, rollups.upsert_leftovers, [{"day": DAY, "item": ITEM, "qty": 3.0}])
+        await write(database, rollups.upsert_leftovers, [{"day": DAY, "item": ITEM, "qty": 5.0}])
+        assert {g: l for g, (_, l) in (await figures(database)).items()} == {g: 5.0 for g in rollups.GRAINS}
+        await write(database, rollups.upsert_leftovers, [{"day": DAY, "item": ITEM, "qty": 1.0}])
+        assert {g: l for g, (_, l) in (await figures(database)).items()} == {g: 1.0 for g in rollups.GRAINS}
+    run(go())
+
+
+def test_only_confirmed_plans_count_as_delivered(database):
+    async def go():
+        await write(database, rollups.upsert_plans, [plan(10.0, False)])
+        assert all(d == 0.0 for d, _ in (await figures(database)).values())
+        await write(database, rollups.upsert_plans, [plan(10.0, True)])
+        assert {g: d for g, (d, _) in (await figures(database)).items()} == {g: 10.0 for g in rollups.GRAINS}
+        await write(database, rollups.upsert_plans, [plan(12.0, True)])        # 改確認過的量
+        assert {g: d for g, (d, _) in (await figures(database)).items()} == {g: 12.0 for g in rollups.GRAINS}
+        await write(database, rollups.upsert_plans, [plan(12.0, False)])       # 取消確認
+        assert {g: d for g, (d, _) in (await figures(database)).items()} == {g: 0.0 for g in rollups.GRAINS}
+    run(go())
+
+
+def test_days_in_the_same_week_and_month_add_up(database):
+    async def go():
+        await write(database, rollups.upsert_plans, [plan(10.0, True), plan(4.0, True, day=date(2020, 3, 6))])
+        got = await figures(database)
+        assert got[rollups.WEEK][0] == got[rollups.MONTH][0] == 14.0
+        async with database() as s:
+            days = await rollups.series(s, rollups.DAY, DAY, date(2020, 3, 6), ITEM)
+        assert [(r["period"], r["delivered"]) for r in days] == [("2020-03-04", 10.0), ("2020-03-06", 4.0)]
+    run(go())
+
+
+def test_rebuild_matches_incremental_updates(database):
+    async def go():
+        await write(database, rollups.upsert_leftovers, [{"day": DAY, "item": ITEM, "qty": 3.0}])
+        await write(database, rollups.upsert_leftovers, [{"day": DAY, "item": ITEM, "qty": 2.0}])
+        await write(database, rollups.upsert_plans, [plan(10.0, True)])
+        await write(database, rollups.upsert_plans, [plan(8.0, True)])
+        incremental = await figures(database)
+        async with database() as s:
+            await rollups.rebuild(s)
+            await s.commit()
+        assert await figures(database) == incremental == {g: (8.0, 2.0) for g in rollups.GRAINS}
+    run(go())
@@ -0,0 +1,112 @@
+# test_simulate.py
+"""模擬的背景工作：狀態一定會寫進去（暫時性錯誤重試）、失敗記在工作上、重啟時中斷的工作標成失敗"""
+import asyncio
+from datetime import datetime
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from db import SimulationJob
+from models import SimulationRequest
+import metrics
+import simulate
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def add_job(database, job_id, status="queued"):
+    async with database() as s:
+        s.add(SimulationJob(id=job_id, status=status, params="{}", created_at=datetime.utcnow()))
+        await s.commit()
+
+
+async def job(database, job_id):
+    async with database() as s:
+        return await simulate.get_job(s, job_id)
+
+
+def failures() -> float:
+    return metrics.BACKGROUND_ERRORS._values.get(("simulation",), 0.0)
+
+
+@pytest.fixture
+def locked_once(monkeypatch):
+    """下一個 commit 丟 database is locked（只丟一次）"""
+    monkeypatch.setattr(simulate, "FINISH_RETRY_SECONDS", 0)
+    real = simulate.SessionLocal
+    state = {"left": 1}
+
+    class Session:
+        def __init__(self):
+            self.s = real()
+
+        async def __aenter__(self):
+            await self.s.__aenter__()
+            return self
+
+        async def __aexit__(self, *exc):
+            return await self.s.__aexit__(*exc)
+
+        async def execute(self, *a, **kw):
+            return await self.s.execute(*a, **kw)
+
+        async def commit(self):
+            if state["left"]:
+                state["left"] -= 1
+                raise OperationalError("UPDATE", {}, Exception("database is locked"))
+            await self.s.commit()
+
+    monkeypatch.setattr(simulate, "SessionLocal", Session)
+    return state
+
+
+def test_finish_retries_when_the_database_is_locked(database, locked_once):
+    async def go():
+        await add_job(database, "j1")
+        await simulate._finish("j1", status="running")
+        assert locked_once["left"] == 0
+        assert (await job(database, "j1"))["status"] == "running"
+    run(go())
+
+
+def test_failed_simulation_is_recorded_on_the_job(database, monkeypatch):
+    async def boom(request):
+        raise RuntimeError("no data")
+
+    monkeypatch.setattr(simulate, "simulate", boom)
+
+    async def go():
+        await add_job(database, "j1")
+        before = failures()
+        await simulate._run_job("j1", SimulationRequest())
+        got = await job(database, "j1")
+        assert (got["status"], got["error"]) == ("failed", "no data")
+        assert got["finished_at"] is not None
+        assert failures() == before + 1
+    run(go())
+
+
+def test_status_write_failure_is_logged_not_raised(database, monkeypatch):
+    async def locked(job_id, **values):
+        raise OperationalError("UPDATE", {}, Exception("database is locked"))
+
+    monkeypatch.setattr(simulate, "_finish", locked)
+
+    async def go():
+        before = failures()
+        await simulate._run_job("j1", SimulationRequest())
+        assert failures() == before + 1
+    run(go())
+
+
+def test_interrupted_jobs_are_failed_at_startup(database):
+    async def go():
+        for job_id, status in (("q", "queued"), ("r", "running"), ("d", "done")):
+            await add_job(database, job_id, status)
+        async with database() as s:
+            assert await simulate.fail_interrupted(s) == 2
+            await s.commit()
+        assert [(await job(database, j))["status"] for j in "qrd"] == ["failed", "failed", "done"]
+    run(go())
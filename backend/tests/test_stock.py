@@ -0,0 +1,105 @@
+# test_stock.py
+"""庫存寫入：原子加減（不得為負）、盤點的樂觀鎖、大量匯入"""
+import asyncio
+
+import pytest
+from sqlalchemy import select
+
+from db import Inventory, InventoryMovement
+from models import BulkImport
+import ledger
+import services
+from stock import StockConflict, adjust_stock, set_stock
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def stock(s, item: str):
+    return (await s.execute(select(Inventory.qty, Inventory.danger_level).where(Inventory.item == item))).one()
+
+
+async def movements(s, item: str):
+    return (await s.execute(select(InventoryMovement.kind, InventoryMovement.delta, InventoryMovement.qty_after)
+                            .where(InventoryMovement.item == item).order_by(InventoryMovement.id))).all()
+
+
+def test_adjust_stock_never_goes_below_zero(database):
+    async def go():
+        async with database() as s:
+            await set_stock(s, {"魚肚": 2.0})
+            rows = await adjust_stock(s, {"魚肚": -5.0}, kind=ledger.DELIVERY, ref="t")
+            await s.commit()
+        assert rows["魚肚"]["qty"] == 0.0
+        async with database() as s:
+            # 異動帳記要求的量，qty_after 是夾住後的結果
+            assert (await movements(s, "魚肚"))[-1] == (ledger.DELIVERY, -5.0, 0.0)
+    run(go())
+
+
+def test_adjust_stock_adds_missing_items_and_bumps_versions(database):
+    async def go():
+        async with database() as s:
+            first = await adjust_stock(s, {"新品": 1.5, "魚肚": 1.0}, kind=ledger.PRODUCTION)
+            second = await adjust_stock(s, {"新品": 1.0}, kind=ledger.PRODUCTION)
+            await s.commit()
+        assert first["新品"]["qty"] == 1.5
+        assert second["新品"] == {"qty": 2.5, "danger_level": first["新品"]["danger_level"],
+                                 "version": first["新品"]["version"] + 1}
+    run(go())
+
+
+def test_set_stock_checks_expected_versions(database):
+    async def go():
+        async with database() as s:
+            version = (await set_stock(s, {"魚肚": 1.0}))["魚肚"]["version"]
+            await s.commit()
+        async with database() as s:
+            rows = await set_stock(s, {"魚肚": 4.0}, expected_versions={"魚肚": version})
+            await s.commit()
+        assert rows["魚肚"]["version"] == version + 1
+        async with database() as s:
+            # 拿舊版本再寫一次：整批失敗，呼叫端 rollback
+            with pytest.raises(StockConflict) as e:
+                await set_stock(s, {"魚肚": 9.0, "魚皮": 1.0}, expected_versions={"魚肚": version})
+            assert e.value.items == ["魚肚"]
+            await s.rollback()
+        async with database() as s:
+            assert (await stock(s, "魚肚")).qty == 4.0
+    run(go())
+
+
+def test_set_stock_clamps_negative_counts(database):
+    async def go():
+        async with database() as s:
+            rows = await set_stock(s, {"魚肚": -3.0})
+            await s.commit()
+        assert rows["魚肚"]["qty"] == 0.0
+    run(go())
+
+
+def test_bulk_import_keeps_qty_when_only_danger_level_is_given(database):
+    async def go():
+        async with database() as s:
+            await services.bulk_import(s, BulkImport(inventory=[{"item": "魚肚", "qty": 0.5}]))
+            await s.commit()
+        async with database() as s:
+            await services.bulk_import(s, BulkImport(inventory=[{"item": "魚肚", "danger_level": 9}]))
+            await s.commit()
+        async with database() as s:
+            assert tuple(await stock(s, "魚肚")) == (0.5, 9.0)
+            counts = (await s.scalars(select(InventoryMovement.qty_after).where(
+                InventoryMovement.item == "魚肚", InventoryMovement.kind == ledger.STOCKTAKE))).all()
+            assert counts == [0.5]      # 只改危險量：不寫盤點異動
+    run(go())
+
+
+def test_bulk_import_sets_qty_and_danger_level_together(database):
+    async def go():
+        async with database() as s:
+            await services.bulk_import(s, BulkImport(inventory=[{"item": "魚肚", "qty": 3, "danger_level": 2}]))
+            await s.commit()
+        async with database() as s:
+            assert tuple(await stock(s, "魚肚")) == (3.0, 2.0)
+    run(go())
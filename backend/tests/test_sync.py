@@ -0,0 +1,125 @@
+# test_sync.py
+"""POST /sync/push 的操作套用：衝突判斷、重送、格式錯的操作只算自己失敗"""
+import asyncio
+
+from sqlalchemy import select
+
+from db import Inventory
+from models import SyncOperation
+import changelog
+import sync
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def op(op_id, name, args, **kw) -> SyncOperation:
+    return SyncOperation(op_id=op_id, op=name, args=args, **kw)
+
+
+async def push(database, operations, device="d1"):
+    async with database() as s:
+        results = await sync.apply_operations(s, device, operations)
+        await s.commit()
+    return {r["op_id"]: r for r in results}
+
+
+async def cursor(database) -> int:
+    async with database() as s:
+        return (await changelog.changes_since(s, 0))["cursor"]
+
+
+async def qty(database, item):
+    async with database() as s:
+        return await s.scalar(select(Inventory.qty).where(Inventory.item == item))
+
+
+def test_bad_args_fail_only_that_op(database):
+    async def go():
+        results = await push(database, [
+            op("1", "update_inventory", {"updates": {"魚肚": 4.0}}),
+            op("2", "complete_task", {"task_id": "zz"}),
+            op("3", "update_danger_levels", {"魚肚": "abc"}),
+            op("4", "upsert_leftovers", {"day": "2026-10-20", "leftovers": 5}),
+            op("5", "update_inventory", {"updates": {"魚皮": 2.0}}),
+        ])
+        assert [results[k]["status"] for k in "12345"] == ["applied", "error", "error", "error", "applied"]
+        assert {results[k]["status_code"] for k in "234"} == {422}
+        assert await qty(database, "魚肚") == 4.0
+        assert await qty(database, "魚皮") == 2.0
+        # 失敗的操作沒有記成已執行：修好 args 重送就會套用
+        again = await push(database, [op("4", "upsert_leftovers", {"day": "2026-10-20", "leftovers": {"魚肚": 1}})])
+        assert again["4"]["status"] == "applied"
+    run(go())
+
+
+def test_bad_args_with_base_fail_only_that_op(database):
+    # 有 base 時要先算出操作會動到哪些列做衝突判斷，args 格式錯也不能讓整批失敗
+    async def go():
+        base = await cursor(database)
+        results = await push(database, [
+            op("1", "upsert_leftovers", {"day": "2026-10-20", "leftovers": 5}, base=base),
+            op("2", "confirm_delivery", {"day": "2026-10-20", "items": 3}, base=base),
+            op("3", "update_inventory", {"updates": {"魚肚": 4.0}}, base=base),
+        ])
+        assert [results[k]["status"] for k in "123"] == ["error", "error", "applied"]
+        assert {results[k]["status_code"] for k in "12"} == {422}
+        assert await qty(database, "魚肚") == 4.0
+    run(go())
+
+
+def test_stale_base_conflicts_unless_forced(database):
+    async def go():
+        base = await cursor(database)
+        await push(database, [op("1", "update_inventory", {"updates": {"魚肚": 4.0}})], device="d2")
+        results = await push(database, [
+            op("1", "update_inventory", {"updates": {"魚肚": 9.0}}, base=base),
+            op("2", "update_inventory", {"updates": {"魚皮": 2.0}}, base=base),   # 沒被別人改過的列
+        ])
+        assert results["1"]["status"] == "conflict"
+        assert results["1"]["conflicts"] == [{"table": changelog.INVENTORY, "key": "魚肚"}]
+        assert results["2"]["status"] == "applied"
+        assert await qty(database, "魚肚") == 4.0
+
+        results = await push(database, [op("3", "update_inventory", {"updates": {"魚肚": 9.0}}, base=base, force=True)])
+        assert results["3"]["status"] == "applied"
+        assert await qty(database, "魚肚") == 9.0
+        # 拿到最新游標之後再改就不算衝突
+        results = await push(database, [op("4", "update_inventory", {"updates": {"魚肚": 1.0}},
+                                           base=await cursor(database))])
+        assert results["4"]["status"] == "applied"
+    run(go())
+
+
+def test_own_changes_in_the_same_push_do_not_conflict(database):
+    async def go():
+        base = await cursor(database)
+        results = await push(database, [
+            op("1", "update_inventory", {"updates": {"魚肚": 4.0}}, base=base),
+            op("2", "update_inventory", {"updates": {"魚肚": 5.0}}, base=base),
+        ])
+        assert [results[k]["status"] for k in "12"] == ["applied", "applied"]
+        assert await qty(database, "魚肚") == 5.0
+    run(go())
+
+
+def test_resent_op_is_a_duplicate_with_the_original_result(database):
+    async def go():
+        first = await push(database, [op("1", "update_inventory", {"updates": {"魚肚": 4.0}})])
+        again = await push(database, [op("1", "update_inventory", {"updates": {"魚肚": 9.0}})])
+        assert again["1"]["status"] == "duplicate"
+        assert again["1"]["result"] == first["1"]["result"]
+        assert await qty(database, "魚肚") == 4.0
+        # op_id 是以裝置區分的
+        other = await push(database, [op("1", "update_inventory", {"updates": {"魚肚": 9.0}})], device="d2")
+        assert other["1"]["status"] == "applied"
+    run(go())
+
+
+def test_unknown_op_is_rejected(database):
+    async def go():
+        results = await push(database, [op("1", "drop_everything", {})])
+        assert results["1"]["status"] == "error"
+        assert results["1"]["status_code"] == 400
+    run(go())
@@ -0,0 +1,67 @@
+# test_transfer.py
+"""匯入：replace 換掉異動帳時，庫存快照依新的異動重新產生（舊快照對不上新的 movement id）"""
+import asyncio
+import json
+from datetime import datetime
+
+from sqlalchemy import select
+
+from db import InventoryCheckpoint
+import ledger
+import transfer
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def body(rows):
+    yield "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in rows).encode()
+
+
+def movement(id, day, kind, delta, qty_after):
+    return {"id": id, "ts": f"2020-03-0{day}T12:00:00", "item": "魚肚", "kind": kind, "delta": delta,
+            "qty_after": qty_after, "ref": None}
+
+
+MOVEMENTS = [
+    movement(1, 1, ledger.OPENING, None, 10.0),
+    movement(2, 2, ledger.DELIVERY, -4.0, 6.0),
+    movement(3, 3, ledger.PRODUCTION, 5.0, 11.0),
+    movement(4, 4, ledger.STOCKTAKE, None, 7.0),
+    movement(5, 5, ledger.DELIVERY, -2.0, 5.0),
+]
+
+
+def test_replacing_movements_rebuilds_checkpoints(database, monkeypatch):
+    monkeypatch.setattr(ledger, "CHECKPOINT_EVERY", 2)
+
+    async def go():
+        async with database() as s:
+            # 舊資料庫的快照：movement_id 對到的是舊的異動
+            s.add(InventoryCheckpoint(movement_id=4, as_of=datetime(2020, 3, 4, 12), item="魚肚", qty=100.0))
+            await s.commit()
+        async with database() as s:
+            await transfer.import_rows(s, body(MOVEMENTS), "inventory_movements", transfer.NDJSON, transfer.REPLACE)
+            await s.commit()
+        async with database() as s:
+            rows = (await s.execute(select(InventoryCheckpoint.movement_id, InventoryCheckpoint.qty)
+                                    .order_by(InventoryCheckpoint.movement_id))).all()
+            assert [tuple(r) for r in rows] == [(2, 6.0), (4, 7.0)]
+            assert (await ledger.stock_as_of(s, datetime(2020, 3, 4, 23)))["魚肚"] == 7.0
+            assert (await ledger.stock_as_of(s, datetime(2020, 3, 3, 23)))["魚肚"] == 11.0
+    run(go())
+
+
+def test_appending_movements_keeps_checkpoints(database):
+    async def go():
+        async with database() as s:
+            s.add(InventoryCheckpoint(movement_id=1, as_of=datetime(2020, 3, 1, 12), item="魚肚", qty=10.0))
+            await s.commit()
+        async with database() as s:
+            await transfer.import_rows(s, body([movement(900, 6, ledger.DELIVERY, -1.0, 4.0)]),
+                                       "inventory_movements", transfer.NDJSON, transfer.APPEND)
+            await s.commit()
+        async with database() as s:
+            assert await s.scalar(select(InventoryCheckpoint.qty)) == 10.0
+    run(go())
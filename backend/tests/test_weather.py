@@ -0,0 +1,161 @@
+# test_weather.py
+"""WeatherService：TTL、stale-while-revalidate、逾時回退、retry_after（stub provider + 假時鐘）"""
+import asyncio
+from datetime import date, timedelta
+from typing import Optional
+
+from weather import StaticWeatherProvider, WeatherService
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class CountingProvider(StaticWeatherProvider):
+    """固定天氣，另外記錄被呼叫幾次；fail=True 時丟例外，gate 設了就等它放行"""
+
+    def __init__(self, label: str = "sunny"):
+        super().__init__(label)
+        self.calls = 0
+        self.fail = False
+        self.gate: Optional[asyncio.Event] = None
+
+    async def current_label(self) -> str:
+        self.calls += 1
+        if self.gate is not None:
+            await self.gate.wait()
+        if self.fail:
+            raise RuntimeError("upstream down")
+        return self.label
+
+
+def service(provider, clock, **kw) -> WeatherService:
+    kw.setdefault("timeout", 0.05)
+    return WeatherService(provider, ttl=600, stale_ttl=3600, fallback="cloudy", retry_after=30, clock=clock, **kw)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_fresh_value_is_served_from_cache():
+    async def go():
+        clock, provider = Clock(), CountingProvider("sunny")
+        svc = service(provider, clock)
+        assert await svc.get_label() == "sunny"
+        provider.label = "rain"
+        clock.now += 599
+        assert await svc.get_label() == "sunny"
+        assert provider.calls == 1
+    run(go())
+
+
+def test_stale_value_is_returned_while_refreshing_in_background():
+    async def go():
+        clock, provider = Clock(), CountingProvider("sunny")
+        svc = service(provider, clock)
+        await svc.get_label()
+        provider.label = "rain"
+        clock.now += 601
+        assert await svc.get_label() == "sunny"      # 先回舊值
+        await asyncio.sleep(0)
+        assert provider.calls == 2
+        assert await svc.get_label() == "rain"       # 背景更新完成
+    run(go())
+
+
+def test_concurrent_stale_reads_share_one_refresh():
+    async def go():
+        clock, provider = Clock(), CountingProvider("sunny")
+        svc = service(provider, clock)
+        await svc.get_label()
+        clock.now += 601
+        provider.gate = asyncio.Event()
+        assert await asyncio.gather(*(svc.get_label() for _ in range(5))) == ["sunny"] * 5
+        await asyncio.sleep(0)
+        provider.gate.set()
+        await asyncio.sleep(0)
+        assert provider.calls == 2
+    run(go())
+
+
+def test_too_old_value_waits_for_upstream():
+    async def go():
+        clock, provider = Clock(), CountingProvider("sunny")
+        svc = service(provider, clock)
+        await svc.get_label()
+        provider.label = "storm"
+        clock.now += 3601
+        assert await svc.get_label() == "storm"
+    run(go())
+
+
+def test_timeout_without_cache_falls_back():
+    async def go():
+        clock, provider = Clock(), CountingProvider("sunny")
+        provider.gate = asyncio.Event()                # 上游一直不回
+        svc = service(provider, clock)
+        assert await svc.get_label() == "cloudy"
+        # 逾時不取消上游請求：回來之後快取就有值
+        provider.gate.set()
+        await asyncio.sleep(0)
+        assert await svc.get_label() == "sunny"
+        await svc.aclose()
+    run(go())
+
+
+def test_failure_backs_off_for_retry_after():
+    async def go():
+        clock, provider = Clock(), CountingProvider("sunny")
+        provider.fail = True
+        svc = service(provider, clock)
+        assert await svc.get_label() == "cloudy"
+        clock.now += 29
+        assert await svc.get_label() == "cloudy"
+        assert provider.calls == 1
+        provider.fail = False
+        clock.now += 1
+        assert await svc.get_label() == "sunny"
+        assert provider.calls == 2
+    run(go())
+
+
+def test_stale_branch_honors_retry_after():
+    async def go():
+        clock, provider = Clock(), CountingProvider("sunny")
+        svc = service(provider, clock)
+        await svc.get_label()
+        provider.fail = True
+        clock.now += 601
+        assert await svc.get_label() == "sunny"
+        await asyncio.sleep(0)
+        assert provider.calls == 2                   # 背景更新失敗
+        for _ in range(10):
+            clock.now += 2
+            assert await svc.get_label() == "sunny"  # 還在 retry_after 內：回舊值、不再打上游
+            await asyncio.sleep(0)
+        assert provider.calls == 2
+        provider.fail = False
+        provider.label = "rain"
+        clock.now += 11
+        assert await svc.get_label() == "sunny"
+        await asyncio.sleep(0)
+        assert provider.calls == 3
+        assert await svc.get_label() == "rain"
+    run(go())
+
+
+def test_daily_labels_use_fallback_outside_the_horizon():
+    async def go():
+        clock, provider = Clock(), CountingProvider("sunny")
+        svc = service(provider, clock)
+        today = date.today()
+        labels = await svc.daily_labels(today - timedelta(days=1), today + timedelta(days=30))
+        assert labels[today - timedelta(days=1)] == "cloudy"
+        assert labels[today] == "sunny"
+        assert labels[today + timedelta(days=30)] == "cloudy"
+    run(go())
@@ -0,0 +1,378 @@
+# transfer.py
+"""
+整批匯出 / 匯入（備份、還原、搬到另一個資料庫、給試算表用）：
+  - 匯出：伺服器端游標（session.stream + yield_per）一次讀 EXPORT_CHUNK 列，編碼完就送出，
+    不管表多大，記憶體只放得下一塊
+      GET /export/{table}?format=csv|ndjson   一張表（NDJSON 每行一列）
+      GET /export?tables=a,b                  多張表，NDJSON 每行 {"table", "row"}；Postgres 在同一個快照內讀
+  - 匯入：邊收邊解析，每 IMPORT_BATCH 列寫一次：Postgres 用 COPY（asyncpg copy_records_to_table），
+    SQLite 用 executemany；整個匯入一個交易，任何一列有錯就全部 rollback
+      POST /import/{table}?format=csv|ndjson&mode=append|replace
+      POST /import?mode=...                   GET /export 的輸出原樣送回來
+    mode=replace 先清空該表（還原用）；append 遇到重複的唯一鍵 → 409
+  - 匯入不逐列記錄：用量彙總、需求統計量從頭重算，離線同步的客戶端全部 reset，
+    SSE 訂閱者收到 resync，讀取快取靠版本號失效
+  - 庫存（inventory）與異動帳（inventory_movements / inventory_checkpoints）是分開的表，還原時要一起匯入；
+    只用 replace 換掉庫存的話，以匯入後的數量補記一筆期初異動；replace 換掉異動帳的話，快照依新的異動重新產生
+  - 匯入 product_rules 後與 PUT /catalog 一樣同步庫存列
+  - CSV 欄位內不可有換行
+"""
+import csv
+import io
+import json
+from datetime import date, datetime
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import Boolean, Date, DateTime, Float, Integer, delete, select, text
+from sqlalchemy.exc import IntegrityError
+
+from db import (CATALOG, SCHEDULE_INPUTS, DeliveryPlan, Inventory, InventoryCheckpoint, InventoryMovement,
+                Leftover, ProductRule, ScheduleTask, SessionLocal, bump_version, table_key)
+from logic import demand_model
+from serialization import dumps
+import catalog
+import changelog
+import events
+import ledger
+import rollups
+
+CSV = "csv"
+NDJSON = "ndjson"
+MEDIA_TYPES = {CSV: "text/csv; charset=utf-8", NDJSON: "application/x-ndjson"}
+APPEND = "append"
+REPLACE = "replace"
+
+# 匯出：伺服器端游標一次讀幾列
+EXPORT_CHUNK = 2000
+# 匯入：幾列寫一次（COPY / executemany）
+IMPORT_BATCH = 5000
+
+TABLES = {
+    "inventory": Inventory,
+    "leftovers": Leftover,
+    "delivery_plans": DeliveryPlan,
+    "schedule_tasks": ScheduleTask,
+    "inventory_movements": InventoryMovement,
+    "inventory_checkpoints": InventoryCheckpoint,
+    "product_rules": ProductRule,
+}
+
+# 匯入後要 +1 的版本號（讀取快取 / 排程 / 品項目錄依此失效）
+_VERSION_KEYS = {
+    "inventory": (SCHEDULE_INPUTS, table_key("inventory")),
+    "leftovers": (SCHEDULE_INPUTS, table_key("leftovers")),
+    "delivery_plans": (table_key("delivery_plans"),),
+    "schedule_tasks": (table_key("schedule_tasks"),),
+    "product_rules": (CATALOG, SCHEDULE_INPUTS),
+}
+# 用量彙總 / 需求統計量是從這些表算出來的
+_ROLLUP_SOURCES = {"leftovers", "delivery_plans", "inventory_movements"}
+_DEMAND_SOURCES = {"leftovers", "delivery_plans"}
+
+
+def model_of(table: str):
+    model = TABLES.get(table)
+    if model is None:
+        raise HTTPException(404, f"不支援的資料表：{table}")
+    return model
+
+
+def parse_tables(tables: Optional[str]) -> List[str]:
+    names = [t.strip() for t in tables.split(",") if t.strip()] if tables else list(TABLES)
+    for name in names:
+        model_of(name)
+    return list(dict.fromkeys(names))
+
+
+def _columns(model) -> List[str]:
+    return [c.name for c in model.__table__.columns]
+
+
+# =========================================================
+# 匯出
+# =========================================================
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def _encode_csv(rows) -> bytes:
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="\n").writerows([_csv_value(v) for v in row] for row in rows)
+    return buf.getvalue().encode("utf-8")
+
+
+async def _stream_rows(session, model) -> AsyncIterator[Sequence]:
+    """一塊一塊讀（伺服器端游標），依主鍵排序"""
+    stmt = (select(*model.__table__.columns).order_by(*model.__table__.primary_key.columns)
+            .execution_options(yield_per=EXPORT_CHUNK))
+    result = await session.stream(stmt)
+    async for part in result.partitions():
+        yield part
+
+
+async def export_table(table: str, fmt: str) -> AsyncIterator[bytes]:
+    model = model_of(table)
+    columns = _columns(model)
+    async with SessionLocal() as s:
+        if fmt == CSV:
+            yield _encode_csv([columns])
+        async for part in _stream_rows(s, model):
+            if fmt == CSV:
+                yield _encode_csv(part)
+            else:
+                yield b"".join(dumps(dict(zip(columns, row))) + b"\n" for row in part)
+
+
+async def export_tables(tables: Iterable[str]) -> AsyncIterator[bytes]:
+    """多張表一起匯出（NDJSON {"table", "row"}），POST /import 可以原樣匯回"""
+    async with SessionLocal() as s:
+        if s.get_bind().dialect.name == "postgresql":
+            # 所有表在同一個快照內讀，匯出期間的寫入不會讓表之間對不上
+            await s.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        for table in tables:
+            model = model_of(table)
+            columns = _columns(model)
+            async for part in _stream_rows(s, model):
+                yield b"".join(dumps({"table": table, "row": dict(zip(columns, row))}) + b"\n" for row in part)
+
+
+# =========================================================
+# 匯入：解析
+# =========================================================
+def _bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    text_ = str(value).strip().lower()
+    if text_ in ("true", "t", "1", "yes", "y"):
+        return True
+    if text_ in ("false", "f", "0", "no", "n"):
+        return False
+    raise ValueError(f"不是布林值：{value!r}")
+
+
+def _parser(column):
+    type_ = column.type
+    if isinstance(type_, Boolean):
+        return _bool
+    if isinstance(type_, Integer):
+        return int
+    if isinstance(type_, Float):
+        return float
+    if isinstance(type_, DateTime):
+        return lambda v: v if isinstance(v, datetime) else datetime.fromisoformat(v)
+    if isinstance(type_, Date):
+        return lambda v: v if isinstance(v, date) else date.fromisoformat(v)
+    return str
+
+
+class _Layout:
+    """一張表某一組欄位的轉換器（CSV 表頭 / NDJSON 的 key）"""
+
+    def __init__(self, table: str, fields: Tuple[str, ...]):
+        model = model_of(table)
+        columns = model.__table__.columns
+        unknown = [f for f in fields if f not in columns]
+        if unknown:
+            raise HTTPException(422, f"{table} 沒有這些欄位：{', '.join(unknown)}")
+        self.table = table
+        self.model = model
+        self.fields = fields
+        self._columns = [columns[f] for f in fields]
+        self._parsers = [_parser(c) for c in self._columns]
+
+    def convert(self, values: Sequence, line: int, from_csv: bool) -> tuple:
+        out = []
+        for column, parse, value in zip(self._columns, self._parsers, values):
+            if from_csv and value == "":
+                # CSV 沒有 NULL：空字串在可為空的欄位是 NULL，不可為空的文字欄位就是空字串
+                value = "" if not column.nullable and parse is str else None
+            if value is None:
+                if not column.nullable and not column.primary_key:
+                    raise HTTPException(422, f"第 {line} 行：{column.name} 不可為空")
+                out.append(None)
+                continue
+            try:
+                out.append(parse(value))
+            except (TypeError, ValueError) as e:
+                raise HTTPException(422, f"第 {line} 行：{column.name} 格式錯誤（{e}）")
+        return tuple(out)
+
+
+def _decode(number: int, raw: bytes) -> str:
+    line = raw.decode("utf-8").rstrip("\r")
+    # Excel 存的 CSV 開頭有 BOM
+    return line.lstrip("\ufeff") if number == 1 else line
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, str]]:
+    """把分段收到的 body 切成行（行號從 1 開始，略過空行）"""
+    pending = b""
+    number = 0
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for raw in lines:
+            number += 1
+            line = _decode(number, raw)
+            if line.strip():
+                yield number, line
+    if pending.strip():
+        yield number + 1, _decode(number + 1, pending)
+
+
+def _json_line(number: int, line: str) -> dict:
+    try:
+        value = json.loads(line)
+    except ValueError as e:
+        raise HTTPException(422, f"第 {number} 行：不是 JSON（{e}）")
+    if not isinstance(value, dict):
+        raise HTTPException(422, f"第 {number} 行：必須是 JSON 物件")
+    return value
+
+
+async def _records(chunks: AsyncIterator[bytes], table: Optional[str], fmt: str):
+    """逐列產生 (layout, 已轉換的值)；table=None 表示 {"table", "row"} 的多表 NDJSON"""
+    layouts: Dict[Tuple[str, Tuple[str, ...]], _Layout] = {}
+
+    def layout(name: str, fields: Tuple[str, ...]) -> _Layout:
+        found = layouts.get((name, fields))
+        if found is None:
+            found = layouts[(name, fields)] = _Layout(name, fields)
+        return found
+
+    if fmt == CSV:
+        header = None
+        async for number, line in _lines(chunks):
+            values = next(csv.reader([line]))
+            if header is None:
+                header = layout(table, tuple(v.strip() for v in values))
+                continue
+            if len(values) != len(header.fields):
+                raise HTTPException(422, f"第 {number} 行：欄位數 {len(values)} 與表頭 {len(header.fields)} 不符")
+            yield header, header.convert(values, number, from_csv=True)
+        return
+
+    async for number, line in _lines(chunks):
+        row = _json_line(number, line)
+        name = table
+        if name is None:
+            name, row = row.get("table"), row.get("row")
+            if not isinstance(name, str) or not isinstance(row, dict):
+                raise HTTPException(422, f"第 {number} 行：格式應為 {{\"table\": ..., \"row\": {{...}}}}")
+        found = layout(name, tuple(row))
+        yield found, found.convert(list(row.values()), number, from_csv=False)
+
+
+# =========================================================
+# 匯入：寫入
+# =========================================================
+def _is_postgres(session) -> bool:
+    return session.get_bind().dialect.name == "postgresql"
+
+
+async def _clear(session, model) -> None:
+    if _is_postgres(session):
+        await session.execute(text(f'TRUNCATE "{model.__tablename__}"'))
+    else:
+        await session.execute(delete(model))
+
+
+async def _write(session, layout: _Layout, rows: List[tuple]) -> None:
+    try:
+        if _is_postgres(session):
+            # COPY 走同一條連線：與這個交易一起 commit / rollback
+            raw = await (await session.connection()).get_raw_connection()
+            await raw.driver_connection.copy_records_to_table(
+                layout.model.__tablename__, records=rows, columns=list(layout.fields))
+        else:
+            await session.execute(layout.model.__table__.insert(),
+                                  [dict(zip(layout.fields, row)) for row in rows])
+    except IntegrityError as e:
+        raise HTTPException(409, f"{layout.table}：資料衝突（{e.orig}）")
+    except Exception as e:
+        # asyncpg 的例外不經過 SQLAlchemy：23xxx = 違反限制條件
+        if str(getattr(e, "sqlstate", "")).startswith("23"):
+            raise HTTPException(409, f"{layout.table}：資料衝突（{e}）")
+        raise
+
+
+async def _sync_sequence(session, table: str) -> None:
+    """COPY 寫入了指定的 id，Postgres 的序列不會跟著走，調到目前最大值之後"""
+    if not _is_postgres(session) or "id" not in TABLES[table].__table__.columns:
+        return
+    await session.execute(text(
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+        f"COALESCE((SELECT MAX(id) FROM \"{table}\"), 0) + 1, false)"))
+
+
+async def import_rows(session, chunks: AsyncIterator[bytes], table: Optional[str] = None,
+                      fmt: str = NDJSON, mode: str = APPEND) -> Dict:
+    """
+    匯入 body（chunks）；table=None → 多表 NDJSON
+    呼叫端負責 commit；回傳 {mode, tables: {table: 匯入列數}}
+    """
+    if table is not None:
+        model_of(table)
+    # commit 時清理點推到這個交易的 seq：匯入期間已經 commit 的其他寫入也一起要求整批重抓
+    changelog.reset(session)
+
+    counts: Dict[str, int] = {}
+    batch: List[tuple] = []
+    current: Optional[_Layout] = None
+
+    async def flush():
+        if batch:
+            await _write(session, current, batch)
+            counts[current.table] += len(batch)
+            batch.clear()
+
+    async for layout, values in _records(chunks, table, fmt):
+        if layout is not current:
+            await flush()
+            current = layout
+            if layout.table not in counts:
+                counts[layout.table] = 0
+                if mode == REPLACE:
+                    await _clear(session, layout.model)
+        batch.append(values)
+        if len(batch) >= IMPORT_BATCH:
+            await flush()
+    await flush()
+    if table is not None and table not in counts:
+        counts[table] = 0
+        if mode == REPLACE:
+            await _clear(session, TABLES[table])
+
+    await _after_import(session, set(counts), mode)
+    return {"mode": mode, "tables": counts}
+
+
+async def _after_import(session, tables: set, mode: str) -> None:
+    """重算衍生資料、讓快取 / 訂閱者失效"""
+    for table in tables:
+        await _sync_sequence(session, table)
+    keys = [key for table in tables for key in _VERSION_KEYS.get(table, ())]
+    if keys:
+        bump_version(session, *keys)
+    if "product_rules" in tables:
+        # 品項換了：有庫存的補庫存列、虛擬品項的庫存列刪掉（同 PUT /catalog）
+        await catalog.sync_inventory(session)
+    if mode == REPLACE and "inventory" in tables and "inventory_movements" not in tables:
+        # 庫存整張換掉但異動帳沒跟著還原：記一筆期初，查過去時間點的庫存才接得上
+        rows = (await session.execute(select(Inventory.item, Inventory.qty))).all()
+        await ledger.record(session, ledger.OPENING, {item: (None, qty or 0.0) for item, qty in rows}, ref="import")
+    if mode == REPLACE and "inventory_movements" in tables:
+        # 異動帳換掉了：舊快照對應的是舊的異動，留著會讓查過去時間點的庫存算錯
+        await ledger.rebuild_checkpoints(session)
+    if tables & _ROLLUP_SOURCES:
+        await rollups.rebuild(session)
+    if tables & _DEMAND_SOURCES:
+        await demand_model.rebuild(session)
+    events.emit(session, events.RESYNC, {})
@@ -0,0 +1,268 @@
+# weather.py
+"""
+天氣子系統：
+  - WeatherProvider：可替換的天氣來源（Open-Meteo / 固定值 stub）
+  - WeatherService：TTL 快取 + stale-while-revalidate 背景更新 + 逾時回退
+  - 共用 httpx.AsyncClient（連線池），不再每次請求都開新 client
+  - 逐日預報（多日提貨預測用），超出上游預報範圍的日子用 fallback
+"""
+import asyncio
+import os
+import time
+from datetime import date, timedelta
+from typing import Callable, Dict, Optional, Protocol
+
+import httpx
+
+# 門市座標（自行調整）
+STORE_LAT, STORE_LON = 22.989382341539695, 120.20492352698653
+
+OPEN_METEO_URL = "https://api.open-meteo.com/v1/forecast"
+# Open-Meteo 逐日預報最多到 16 天後
+FORECAST_HORIZON_DAYS = 15
+
+# 上游逾時或失敗時使用的天氣
+FALLBACK_LABEL = os.getenv("WEATHER_FALLBACK", "cloudy")
+
+
+def map_weather_code_to_label(code: int) -> str:
+    # Open-Meteo weathercode 簡化對應
+    if code in (0, 1): return "sunny"
+    if code in (2, 3): return "cloudy"
+    if code in (51, 53, 55, 61, 63, 65, 80, 81, 82): return "rain"
+    if code in (95, 96, 99): return "storm"
+    return "cloudy"
+
+
+# =========================================================
+# 共用 HTTP client（連線池）
+# =========================================================
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(5.0, connect=3.0),
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+        )
+    return _http_client
+
+
+async def close_http_client() -> None:
+    global _http_client
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+    _http_client = None
+
+
+# =========================================================
+# Provider 介面
+# =========================================================
+class WeatherProvider(Protocol):
+    async def current_label(self) -> str: ...
+
+    async def daily_labels(self, start: date, end: date) -> Dict[date, str]: ...
+
+
+class OpenMeteoProvider:
+    """Open-Meteo：當前天氣"""
+
+    def __init__(self, lat: float = STORE_LAT, lon: float = STORE_LON):
+        self.lat = lat
+        self.lon = lon
+
+    async def current_label(self) -> str:
+        r = await get_http_client().get(OPEN_METEO_URL, params={
+            "latitude": self.lat,
+            "longitude": self.lon,
+            "current": "weather_code",
+        })
+        r.raise_for_status()
+        code = r.json().get("current", {}).get("weather_code", 2)
+        return map_weather_code_to_label(code)
+
+    async def daily_labels(self, start: date, end: date) -> Dict[date, str]:
+        r = await get_http_client().get(OPEN_METEO_URL, params={
+            "latitude": self.lat,
+            "longitude": self.lon,
+            "daily": "weather_code",
+            "timezone": "Asia/Taipei",
+            "start_date": start.isoformat(),
+            "end_date": end.isoformat(),
+        })
+        r.raise_for_status()
+        daily = r.json().get("daily", {})
+        return {
+            date.fromisoformat(d): map_weather_code_to_label(code if code is not None else 2)
+            for d, code in zip(daily.get("time", []), daily.get("weather_code", []))
+        }
+
+
+class StaticWeatherProvider:
+    """固定回傳同一個天氣（本地開發 / 測試用，不連網）"""
+
+    def __init__(self, label: str = "sunny"):
+        self.label = label
+
+    async def current_label(self) -> str:
+        return self.label
+
+    async def daily_labels(self, start: date, end: date) -> Dict[date, str]:
+        return {start + timedelta(days=i): self.label for i in range((end - start).days + 1)}
+
+
+# =========================================================
+# 快取服務
+# =========================================================
+class WeatherService:
+    """
+    - ttl 內：直接回傳快取
+    - ttl ~ stale_ttl：先回傳舊值，背景更新（stale-while-revalidate）
+    - 沒有可用快取：同步等待上游，但最多等 timeout 秒，失敗回傳 fallback
+    - 上游失敗後 retry_after 秒內不再打（背景更新也一樣）
+    - clock 可換掉（測試用假時鐘）
+    """
+
+    def __init__(self, provider: WeatherProvider, ttl: float = 600.0, stale_ttl: float = 3600.0,
+                 timeout: float = 2.0, fallback: str = FALLBACK_LABEL, retry_after: float = 30.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.provider = provider
+        self.clock = clock
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.timeout = timeout
+        self.fallback = fallback
+        self.retry_after = retry_after
+        self._label: Optional[str] = None
+        self._fetched_at: float = 0.0
+        self._failed_at: float = float("-inf")
+        self._daily: Dict[date, tuple] = {}   # date → (label, fetched_at)
+        self._refresh_task: Optional[asyncio.Future] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop) -> None:
+        """記住主事件迴圈，讓同步（threadpool）呼叫端也能排背景更新"""
+        self._loop = loop
+
+    def set_provider(self, provider: WeatherProvider) -> None:
+        self.provider = provider
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        self._label = None
+        self._fetched_at = 0.0
+        self._failed_at = float("-inf")
+        self._daily.clear()
+
+    def _age(self) -> float:
+        return self.clock() - self._fetched_at
+
+    async def _refresh(self) -> str:
+        try:
+            label = await self.provider.current_label()
+        except Exception:
+            self._failed_at = self.clock()
+            raise
+        self._label = label
+        self._fetched_at = self.clock()
+        return label
+
+    def _start_refresh(self) -> asyncio.Future:
+        # 同一時間只允許一個更新在跑
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh())
+            self._refresh_task.add_done_callback(_consume_exception)
+        return self._refresh_task
+
+    def _backing_off(self) -> bool:
+        return self.clock() - self._failed_at < self.retry_after
+
+    async def get_label(self) -> str:
+        if self._label is not None:
+            age = self._age()
+            if age < self.ttl:
+                return self._label
+            if age < self.stale_ttl:
+                if not self._backing_off():
+                    self._start_refresh()
+                return self._label
+        if self._backing_off():
+            # 上游剛失敗過，先不要每個請求都再打一次
+            return self._label or self.fallback
+        try:
+            return await asyncio.wait_for(asyncio.shield(self._start_refresh()), self.timeout)
+        except Exception:
+            # 上游太慢或失敗：沿用舊值，否則回退
+            return self._label or self.fallback
+
+    def peek_label(self) -> str:
+        """
+        同步版本（不等網路）：回傳目前快取或 fallback，
+        過期時把更新排到主事件迴圈上。
+        """
+        label = self._label
+        if (label is None or self._age() >= self.ttl) and not self._backing_off():
+            if self._loop is not None and self._loop.is_running():
+                asyncio.run_coroutine_threadsafe(self._schedule_refresh(), self._loop)
+        return label or self.fallback
+
+    async def _schedule_refresh(self) -> None:
+        self._start_refresh()
+
+    async def daily_labels(self, start: date, end: date) -> Dict[date, str]:
+        """
+        逐日天氣：只向上游要「今天 ~ 預報範圍」內、快取過期的日子，
+        其餘（過去或太遠的日子、上游失敗）用 fallback
+        """
+        today = date.today()
+        lo, hi = max(start, today), min(end, today + timedelta(days=FORECAST_HORIZON_DAYS))
+        now = self.clock()
+        if lo <= hi:
+            missing = [lo + timedelta(days=i) for i in range((hi - lo).days + 1)
+                       if now - self._daily.get(lo + timedelta(days=i), ("", float("-inf")))[1] >= self.ttl]
+            if missing and now - self._failed_at >= self.retry_after:
+                try:
+                    fetched = await asyncio.wait_for(
+                        self.provider.daily_labels(missing[0], missing[-1]), self.timeout)
+                    for d, label in fetched.items():
+                        self._daily[d] = (label, now)
+                except Exception:
+                    self._failed_at = now
+        # 過期的日子不用一直留著
+        for d in [d for d in self._daily if d < today]:
+            del self._daily[d]
+        out: Dict[date, str] = {}
+        d = start
+        while d <= end:
+            cached = self._daily.get(d)
+            out[d] = cached[0] if cached else self.fallback
+            d += timedelta(days=1)
+        return out
+
+    async def aclose(self) -> None:
+        if self._refresh_task is not None and not self._refresh_task.done():
+            self._refresh_task.cancel()
+        await close_http_client()
+
+
+def _consume_exception(fut: asyncio.Future) -> None:
+    # 背景更新失敗只代表繼續用舊值，不要讓 asyncio 印出 "exception was never retrieved"
+    if not fut.cancelled():
+        fut.exception()
+
+
+def _provider_from_env() -> WeatherProvider:
+    kind = os.getenv("WEATHER_PROVIDER", "open-meteo").lower()
+    if kind == "static":
+        return StaticWeatherProvider(os.getenv("WEATHER_STATIC_LABEL", "sunny"))
+    return OpenMeteoProvider()
+
+
+weather_service = WeatherService(
+    _provider_from_env(),
+    ttl=float(os.getenv("WEATHER_TTL", "600")),
+    stale_ttl=float(os.getenv("WEATHER_STALE_TTL", "3600")),
+    timeout=float(os.getenv("WEATHER_TIMEOUT", "2.0")),
+)
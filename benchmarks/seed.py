@@ -0,0 +1,67 @@
+# seed.py
+"""
+基準測試用的假資料：庫存 / 剩料 / 提貨計畫 / 未完成任務，規模可調
+固定亂數種子，每次產生的資料都一樣
+"""
+import random
+from datetime import date, timedelta
+from typing import List
+
+from sqlalchemy import delete, insert
+
+from db import SessionLocal, Inventory, Leftover, DeliveryPlan, ScheduleTask, bump_version, table_key, SCHEDULE_INPUTS
+from catalog import DEFAULT_PRODUCTS
+
+WEATHERS = ["sunny", "cloudy", "rain", "storm"]
+BATCH = 5000
+
+
+def item_names(n: int) -> List[str]:
+    """前面用真實品項，不夠再補「品項N」"""
+    return (DEFAULT_PRODUCTS + [f"品項{i}" for i in range(len(DEFAULT_PRODUCTS), n)])[:n]
+
+
+async def _insert(session, model, rows) -> None:
+    for k in range(0, len(rows), BATCH):
+        await session.execute(insert(model), rows[k:k + BATCH])
+
+
+async def seed(days: int = 365, items: int = 11, open_tasks: int = 50, end: date = None,
+               rng_seed: int = 42) -> dict:
+    """
+    清掉四張表後重新灌資料：
+      - days 天的剩料與已確認提貨（到 end 前一天為止）
+      - items 個品項的庫存（約一半低於危險量，排程才有事做）
+      - open_tasks 筆未完成任務
+    """
+    rng = random.Random(rng_seed)
+    end = end or date.today()
+    names = item_names(items)
+    first = end - timedelta(days=days)
+
+    inventory = [{"item": name, "qty": round(rng.uniform(0, 10), 1), "danger_level": 5.0, "version": 0}
+                 for name in names]
+    leftovers, plans = [], []
+    for i in range(days):
+        d = first + timedelta(days=i)
+        weather = rng.choice(WEATHERS)
+        for name in names:
+            planned = round(rng.uniform(0.5, 6.0), 1)
+            plans.append({"day": d, "item": name, "planned_qty": planned, "confirmed": True, "weather": weather})
+            leftovers.append({"day": d, "item": name, "qty": round(rng.uniform(0, planned / 2), 1)})
+    tasks = [{"day": end + timedelta(days=rng.randint(1, 14)), "task": f"製作 {name}", "item": name,
+              "qty": float(rng.randint(0, 8)), "done": False}
+             for name in (rng.choice(names) for _ in range(open_tasks))]
+
+    async with SessionLocal() as s:
+        for model in (Inventory, Leftover, DeliveryPlan, ScheduleTask):
+            await s.execute(delete(model))
+        await _insert(s, Inventory, inventory)
+        await _insert(s, Leftover, leftovers)
+        await _insert(s, DeliveryPlan, plans)
+        await _insert(s, ScheduleTask, tasks)
+        bump_version(s, SCHEDULE_INPUTS, *(table_key(t) for t in
+                                                 ("inventory", "leftovers", "delivery_plans", "schedule_tasks")))
+        await s.commit()
+    return {"items": len(inventory), "leftovers": len(leftovers), "delivery_plans": len(plans),
+            "open_tasks": len(tasks)}